@@ -9,9 +9,11 @@ containerized challenge instances using Kubernetes.
 import os
 import sys
 from CTFd.plugins import register_plugin_assets_directory  # pylint: disable=import-error
+from CTFd.plugins.migrations import upgrade                # pylint: disable=import-error
 
 from .challenges import init_chals, deinit_chals, define_k8s_admin
-from .utils import init_db, get_k8s_client, define_k8s_api
+from .utils import init_db, get_k8s_client, define_k8s_api, template_registry
+from .utils.k8s_trace import log_event, log_error
 
 # Import challenge models so they are registered with SQLAlchemy
 from .challenges.k8s_challenge import (
@@ -30,12 +32,16 @@ def load(app):
     if ctfd_templates_dir not in sys.path:
         sys.path.insert(0, ctfd_templates_dir)
 
-    # Create database tables
+    # Create database tables and bring existing ones up to date
     app.db.create_all()
+    upgrade()
 
     # Initialize Kubernetes client
     k8s_client = get_k8s_client()
-    print("ctfd-k8s-challenge: Successfully loaded Kubernetes config.")
+    log_event('kubernetes_config_loaded')
+
+    # Compile all of the object templates up front
+    template_registry.load_all()
 
     # Initialize plugin DB and admin settings
     init_db()
@@ -51,7 +57,7 @@ def load(app):
             # Define Kubernetes API routes
             define_k8s_api(app)
         else:
-            print("ctfd-k8s-challenge: Error initializing challenges. Plugin disabled.")
+            log_error('initializing challenges failed, plugin disabled')
     except Exception as e:
-        print("CTFd-K8S PLUGIN INIT ERROR:", e)
+        log_error(e, stage='plugin_init')
         raise
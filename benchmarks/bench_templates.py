@@ -0,0 +1,99 @@
+"""
+bench_templates
+
+Micro-benchmark for the template registry.
+
+Compares the old per-request path (read the file, compile a new Template, render and
+parse the YAML) against the registry (compiled once, skeleton filled per instance).
+
+Run from the plugin directory: python benchmarks/bench_templates.py
+"""
+import os
+import sys
+import uuid
+import types
+import timeit
+import contextlib
+import importlib.util
+
+import yaml
+from jinja2 import Template
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_NAMES = ('k8s-web', 'k8s-tcp', 'k8s-random-port')
+ITERATIONS = 2000
+
+
+def load_registry_module():
+    """
+    Imports utils/k8s_templates.py directly so CTFd does not need to be installed.
+    Its k8s_trace import, which needs CTFd's cache, gets spans that do nothing.
+    """
+    package = types.ModuleType('k8s_bench')
+    package.__path__ = []
+    tracing = types.ModuleType('k8s_bench.k8s_trace')
+    tracing.span = lambda phase: contextlib.nullcontext()
+    sys.modules.update({'k8s_bench': package, 'k8s_bench.k8s_trace': tracing})
+    spec = importlib.util.spec_from_file_location(
+        'k8s_bench.k8s_templates', os.path.join(PLUGIN_DIR, 'utils', 'k8s_templates.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def instance_options():
+    """
+    Returns template variables shaped like the ones create() builds.
+    """
+    instance_id = str(uuid.uuid4())
+    return {'challenge_id': 1,
+            'challenge_type': 'k8s-web',
+            'team': '',
+            'user': 1,
+            'instance_id': instance_id,
+            'port': 45000,
+            'deployment_name': 'chal-' + instance_id,
+            'challenge_namespace': 'challenges',
+            'container_name': 'registry.example.com/challenge:latest',
+            'challenge_port': 8080,
+            'random_port': 45000,
+            'external_tcp_port': 443,
+            'external_https_port': 443,
+            'tcp_cert_name': 'chal.example.com',
+            'tcp_domain_name': 'chal.example.com',
+            'https_domain_name': 'web.example.com',
+            'registry_data': 'e30='}
+
+
+def old_path(template_name):
+    """
+    The render and parse done for every request before the registry existed.
+    """
+    template_path = os.path.join(PLUGIN_DIR, 'templates', template_name + '.yml.j2')
+    with open(template_path, encoding='utf-8') as t_file:
+        template = Template(t_file.read())
+    return list(yaml.safe_load_all(template.render(instance_options())))
+
+
+def main():
+    """
+    Runs the benchmark and prints the per-call cost for each template.
+    """
+    registry = load_registry_module().TemplateRegistry(os.path.join(PLUGIN_DIR, 'templates'))
+    registry.load_all()
+
+    def new_path(template_name):
+        template = registry.get(template_name)
+        return registry.render_objects(template, instance_options())
+
+    print(f"{'template':<18}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for template_name in TEMPLATE_NAMES:
+        before = timeit.timeit(lambda name=template_name: old_path(name), number=ITERATIONS)
+        after = timeit.timeit(lambda name=template_name: new_path(name), number=ITERATIONS)
+        print(f"{template_name:<18}{before / ITERATIONS * 1e6:>14.1f}"
+              f"{after / ITERATIONS * 1e6:>14.1f}{before / after:>9.1f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
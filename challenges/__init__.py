@@ -15,6 +15,8 @@ from .k8s_web import *
 from .k8s_random_port import *
 from .k8s_admin import define_k8s_admin
 from ..utils import *
+from ..utils.k8s_database import get_config_for_update, invalidate_config
+from ..utils.k8s_trace import log_event, log_error
 
 def init_chals(k8s_client):
     """
@@ -22,34 +24,38 @@ def init_chals(k8s_client):
     Also registers the actual challenge classes.
     """
     config = get_config()
-    print(f"ctfd-k8s-challenge: Debug - challenge_namespace: {config.challenge_namespace}")
+    log_event('init_challenges', challenge_namespace=config.challenge_namespace)
 
     if not config.challenge_namespace:
-        print("ctfd-k8s-challenge: Debug - No challenge_namespace configured, returning False")
+        log_error('no challenge_namespace configured')
         return False
 
-    print("ctfd-k8s-challenge: Debug - Starting deployment of core resources...")
+    log_event('deploy_core_resources')
     
     result = deploy_certificates(k8s_client, config)
-    print(f"ctfd-k8s-challenge: Debug - deploy_certificates result: {result}")
+    log_event('deploy_certificates', result=result)
     
     result = False if not result else deploy_web_gateway(k8s_client, config)
-    print(f"ctfd-k8s-challenge: Debug - deploy_web_gateway result: {result}")
+    log_event('deploy_web_gateway', result=result)
     
     # Skip registry deployment since we're using external registry.psuccso.org
     # result = False if not result else deploy_registry(k8s_client, config)
     
-    result = False if not result else deploy_cleanup_cronjob(k8s_client, config)
-    print(f"ctfd-k8s-challenge: Debug - deploy_cleanup_cronjob result: {result}")
+    # Expired instances are removed by the in-process reaper; the CronJob is optional
+    if config.cleanup_cronjob:
+        result = False if not result else deploy_cleanup_cronjob(k8s_client, config)
+        log_event('deploy_cleanup_cronjob', result=result)
+    else:
+        destroy_cleanup_cronjob(k8s_client, config)
 
     if result:
-        print("ctfd-k8s-challenge: Debug - All resources deployed successfully, registering challenge classes...")
+        log_event('register_challenge_classes')
         CHALLENGE_CLASSES['k8s-tcp'] = K8sTcpChallengeType
         CHALLENGE_CLASSES['k8s-web'] = K8sWebChallengeType
         CHALLENGE_CLASSES['k8s-random-port'] = K8sRandomPortChallengeType
-        print("ctfd-k8s-challenge: Debug - Challenge classes registered successfully")
+        log_event('challenge_classes_registered')
     else:
-        print("ctfd-k8s-challenge: Debug - Resource deployment failed, not registering challenge classes")
+        log_error('deploying core resources failed, challenge classes not registered')
 
     return result
 
@@ -89,8 +95,12 @@ def deploy_registry(k8s_client, config):
     template = get_template('registry')
 
     if not config.registry_password:
-        config.registry_password = str(hashlib.md5(bytes(str(uuid.uuid4()), 'utf-8')).hexdigest())
+        stored_config = get_config_for_update()
+        stored_config.registry_password = str(hashlib.md5(bytes(str(uuid.uuid4()),
+                                                                'utf-8')).hexdigest())
         db.session.commit()
+        invalidate_config()
+        config = get_config()
 
     registry_hash = encrypt_password('ctfd', config.registry_password)
 
@@ -100,9 +110,9 @@ def deploy_registry(k8s_client, config):
 
     if deploy_object(k8s_client, template, options):
         result = True
-        print("ctfd-k8s-challenge: Successfully deployed k8s internal challenge registry.")
+        log_event('registry_deployed')
     else:
-        print("ctfd-k8s-challenge: Error: deploying k8s internal challenge registry failed!")
+        log_error('deploying the internal challenge registry failed')
     return result
 
 def deploy_certificates(k8s_client, config):
@@ -112,7 +122,7 @@ def deploy_certificates(k8s_client, config):
     """
 
     result = True  # No need to deploy separate certificates with nginx-ingress
-    print("ctfd-k8s-challenge: Certificates not needed with nginx-ingress.")
+    log_event('certificates_skipped', reason='handled by nginx-ingress')
     return result
 
 def deploy_web_gateway(k8s_client, config):
@@ -122,7 +132,7 @@ def deploy_web_gateway(k8s_client, config):
     """
 
     result = True  # No need to deploy separate gateway with nginx-ingress
-    print("ctfd-k8s-challenge: Web gateway not needed with nginx-ingress.")
+    log_event('web_gateway_skipped', reason='handled by nginx-ingress')
     return result
 
 def deploy_cleanup_cronjob(k8s_client, config):
@@ -131,31 +141,30 @@ def deploy_cleanup_cronjob(k8s_client, config):
     Note: This is optional and won't prevent the plugin from initializing.
     """
 
-    print(f"ctfd-k8s-challenge: Debug - Deploying cleanup cronjob to namespace: {config.challenge_namespace}")
-    print(f"ctfd-k8s-challenge: Debug - CTFd URL: {config.ctfd_url}")
+    log_event('deploying_cleanup_cronjob', challenge_namespace=config.challenge_namespace,
+              ctfd_url=config.ctfd_url)
     
     try:
         result = False
         template = get_template('clean')
-        print(f"ctfd-k8s-challenge: Debug - Got template: {template is not None}")
+        log_event('cleanup_cronjob_template', found=template is not None)
         
         options = {'ctfd_url': config.ctfd_url,
                    'challenge_namespace': config.challenge_namespace}
-        print(f"ctfd-k8s-challenge: Debug - Template options: {options}")
+        log_event('cleanup_cronjob_options', options=options)
         
         if deploy_object(k8s_client, template, options):
             result = True
-            print("ctfd-k8s-challenge: Successfully deployed cleanup cronjob.")
+            log_event('cleanup_cronjob_deployed')
         else:
-            print("ctfd-k8s-challenge: Warning: deploying cleanup cronjob failed, but continuing...")
+            log_error('deploying the cleanup cronjob failed, continuing without it')
             result = True  # Don't fail the entire initialization
             
     except Exception as e:
-        print(f"ctfd-k8s-challenge: Warning: cleanup cronjob deployment failed with error: {e}")
-        print("ctfd-k8s-challenge: Continuing initialization without cleanup cronjob...")
+        log_error(e, stage='cleanup_cronjob', continuing=True)
         result = True  # Don't fail the entire initialization
     
-    print(f"ctfd-k8s-challenge: Debug - deploy_cleanup_cronjob returning: {result}")
+    log_event('deploy_cleanup_cronjob_result', result=result)
     return result
 
 def destroy_registry(k8s_client, config):
@@ -168,9 +177,9 @@ def destroy_registry(k8s_client, config):
     options = {'registry_namespace': config.registry_namespace}
     if destroy_object(k8s_client, template, options):
         result = True
-        print("ctfd-k8s-challenge: Successfully destroyed k8s internal challenge registry.")
+        log_event('registry_destroyed')
     else:
-        print("ctfd-k8s-challenge: Error: destroying k8s internal challenge registry failed!")
+        log_error('destroying the internal challenge registry failed')
     return result
 
 def destroy_certificates(k8s_client, config):
@@ -180,7 +189,7 @@ def destroy_certificates(k8s_client, config):
     """
 
     result = True  # No need to destroy separate certificates with nginx-ingress
-    print("ctfd-k8s-challenge: Certificates not managed separately with nginx-ingress.")
+    log_event('certificates_skipped', reason='handled by nginx-ingress')
     return result
 
 def destroy_web_gateway(k8s_client, config):
@@ -190,7 +199,7 @@ def destroy_web_gateway(k8s_client, config):
     """
 
     result = True  # No need to destroy separate gateway with nginx-ingress
-    print("ctfd-k8s-challenge: Web gateway not managed separately with nginx-ingress.")
+    log_event('web_gateway_skipped', reason='handled by nginx-ingress')
     return result
 
 def destroy_cleanup_cronjob(k8s_client, config):
@@ -204,7 +213,7 @@ def destroy_cleanup_cronjob(k8s_client, config):
                'challenge_namespace': config.challenge_namespace}
     if destroy_object(k8s_client, template, options):
         result = True
-        print("ctfd-k8s-challenge: Successfully destroyed cleanup cronjob.")
+        log_event('cleanup_cronjob_destroyed')
     else:
-        print("ctfd-k8s-challenge: Error: destroying cleanup cronjob failed!")
+        log_error('destroying the cleanup cronjob failed')
     return result
@@ -5,13 +5,21 @@ This file defines the backend for the Admin interface for the plugin.
 """
 
 import os
-from flask import request, Blueprint, render_template
+from flask import request, Blueprint, render_template, redirect, url_for
 from CTFd.utils.decorators import admins_only         # pylint: disable=import-error
 from CTFd.forms.fields import SubmitField             # pylint: disable=import-error
 from CTFd.forms import BaseForm                       # pylint: disable=import-error
 from CTFd.models import db                            # pylint: disable=import-error
-from wtforms import HiddenField, PasswordField, StringField
-from ..utils import get_config, get_all_challenges
+from wtforms import BooleanField, HiddenField, PasswordField, StringField
+from ..utils import get_config
+from ..utils.k8s_database import (get_warm_pool_counts, get_config_for_update, invalidate_config,
+                                  get_active_instance_stats)
+from ..utils.k8s_provisioner import provisioner
+from ..utils.k8s_shared import get_shared_instances, deploy_shared_instance, restart_shared_instance
+from ..utils.k8s_manage_objects import get_pinned_image
+from ..utils.k8s_prepull import sync_prepull
+from ..utils.k8s_trace import log_error
+from .k8s_challenge import K8sChallenge
 
 
 class K8sConfigForm(BaseForm):  # pylint: disable=too-few-public-methods
@@ -56,9 +64,126 @@ class K8sConfigForm(BaseForm):  # pylint: disable=too-few-public-methods
         "CTFd URL",
         description="The URL that CTFd is accessible from within the cluster."
     )
+    cleanup_cronjob = BooleanField(
+        "Cleanup CronJob",
+        description="Also deploy the CronJob that calls /api/v1/k8s/clean every minute."
+    )
+    teardown_concurrency = StringField(
+        "Teardown Concurrency",
+        description="The number of instances a bulk delete removes in parallel."
+    )
+    provisioning_workers = StringField(
+        "Provisioning Workers",
+        description="The number of instances each CTFd worker deploys in parallel."
+    )
+    reconcile_interval = StringField(
+        "Reconcile Interval",
+        description="Seconds between checks for Kubernetes objects without a tracked instance."
+    )
+    team_instances = BooleanField(
+        "Team Instances",
+        description="In teams mode, share one instance per team instead of one per user."
+    )
+    max_instances = StringField(
+        "Max Instances",
+        description="The number of instances that may run at once, 0 for no limit."
+    )
+    cpu_budget = StringField(
+        "CPU Budget",
+        description="The CPU all instances may request together, e.g. 16 or 500m."
+    )
+    memory_budget = StringField(
+        "Memory Budget",
+        description="The memory all instances may request together, e.g. 32Gi."
+    )
+    prepull_images = BooleanField(
+        "Pre-pull Images",
+        description="Keep the images of visible challenges cached on every node."
+    )
+    build_concurrency = StringField(
+        "Build Concurrency",
+        description="The number of image builds that may run at once, 0 for no limit."
+    )
+    metrics_token = PasswordField(
+        "Metrics Token",
+        description="A bearer token that lets Prometheus read /api/v1/k8s/metrics."
+    )
     submit = SubmitField('Submit')
 
 
+def get_warm_pools():
+    """
+    Returns the warm pool size, fill and hit/miss counts of every challenge using one.
+    """
+    warm_pools = []
+    counts = get_warm_pool_counts()
+    challenges = K8sChallenge.query.filter((K8sChallenge.warm_pool_size > 0) |
+                                           (K8sChallenge.warm_pool_hits > 0) |
+                                           (K8sChallenge.warm_pool_misses > 0)).all()
+    for challenge in challenges:
+        challenge_counts = counts.get(challenge.id, {})
+        warm_pools.append({
+            'challenge_name': challenge.name,
+            'size': challenge.warm_pool_size or 0,
+            'ready': challenge_counts.get('ready', 0),
+            'pending': challenge_counts.get('pending', 0),
+            'hits': challenge.warm_pool_hits or 0,
+            'misses': challenge.warm_pool_misses or 0
+        })
+    return warm_pools
+
+
+def get_builds():
+    """
+    Returns the last image build of every challenge whose build was tracked.
+    """
+    builds = []
+    challenges = K8sChallenge.query.filter(K8sChallenge.build_status.isnot(None)).order_by(
+        K8sChallenge.build_time.desc()).all()
+    for challenge in challenges:
+        builds.append({
+            'challenge_name': challenge.name,
+            'status': challenge.build_status,
+            'time': challenge.build_time,
+            'commit': challenge.build_commit,
+            'image': get_pinned_image(challenge)
+        })
+    return builds
+
+
+def save_config():
+    """
+    Saves the submitted config form and returns the updated config.
+    """
+    config = get_config_for_update()
+    if len(request.form.get('git_credential', "")) > 0:
+        config.git_credential = request.form['git_credential']
+    config.registry_namespace = request.form['registry_namespace']
+    config.challenge_namespace = request.form['challenge_namespace']
+    config.tcp_domain_name = request.form['tcp_domain_name']
+    config.https_domain_name = request.form['https_domain_name']
+    config.external_tcp_port = int(request.form['external_tcp_port'])
+    config.external_https_port = int(request.form['external_https_port'])
+    config.expire_interval = int(request.form['expire_interval'])
+    config.ctfd_url = request.form['ctfd_url']
+    config.cleanup_cronjob = 'cleanup_cronjob' in request.form
+    config.teardown_concurrency = int(request.form['teardown_concurrency'])
+    config.provisioning_workers = int(request.form['provisioning_workers'])
+    config.reconcile_interval = int(request.form['reconcile_interval'])
+    config.team_instances = 'team_instances' in request.form
+    config.max_instances = int(request.form['max_instances'] or 0)
+    config.cpu_budget = request.form['cpu_budget'].strip() or None
+    config.memory_budget = request.form['memory_budget'].strip() or None
+    config.prepull_images = 'prepull_images' in request.form
+    config.build_concurrency = int(request.form['build_concurrency'])
+    if len(request.form.get('metrics_token', "")) > 0:
+        config.metrics_token = request.form['metrics_token']
+
+    db.session.commit()
+    invalidate_config()
+    return config
+
+
 def define_k8s_admin(app):
     """
     Defines the actual route and backend for the admin web UI.
@@ -80,31 +205,49 @@ def define_k8s_admin(app):
     def admin():  # pylint: disable=too-many-branches
         config = get_config()
         form = K8sConfigForm()
-        challenge_instances = []
+        warm_pools = []
+        shared_instances = []
+        builds = []
 
+        # Challenge instances are paged in by the page itself from /api/v1/k8s/instances
         if request.method == "GET":
-            challenge_instances = get_all_challenges()
+            warm_pools = get_warm_pools()
+            shared_instances = get_shared_instances()
+            builds = get_builds()
 
         elif request.method == "POST":
-            if len(request.form.get('git_credential', "")) > 0:
-                config.git_credential = request.form['git_credential']
-            config.registry_namespace = request.form['registry_namespace']
-            config.challenge_namespace = request.form['challenge_namespace']
-            config.tcp_domain_name = request.form['tcp_domain_name']
-            config.https_domain_name = request.form['https_domain_name']
-            config.external_tcp_port = int(request.form['external_tcp_port'])
-            config.external_https_port = int(request.form['external_https_port'])
-            config.expire_interval = int(request.form['expire_interval'])
-            config.ctfd_url = request.form['ctfd_url']
-
-            db.session.commit()
+            config = save_config()
+            provisioner.submit(sync_prepull)
 
         return render_template(
             "ctfd-k8s-challenge/k8s_admin.html",
             config=config,
             form=form,
-            challenge_instances=challenge_instances
+            warm_pools=warm_pools,
+            shared_instances=shared_instances,
+            builds=builds,
+            instance_lookups=get_active_instance_stats()
         )
 
+    @k8s_admin.route("/admin/kubernetes/shared", methods=["POST"])
+    @admins_only
+    def shared():
+        """
+        Changes the replica bounds of a shared instance or restarts its pods.
+        """
+        challenge = K8sChallenge.query.filter_by(id=request.form['challenge_id']).first_or_404()
+        try:
+            if request.form.get('action') == 'restart':
+                restart_shared_instance(challenge.id)
+            else:
+                min_replicas = max(int(request.form['min_replicas']), 1)
+                challenge.min_replicas = min_replicas
+                challenge.max_replicas = max(int(request.form['max_replicas']), min_replicas)
+                db.session.commit()
+                provisioner.submit(deploy_shared_instance, challenge.id)
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+        return redirect(url_for('k8s_admin.admin'))
+
     # Register the blueprint with the main Flask app
     app.register_blueprint(k8s_admin)
@@ -8,8 +8,15 @@ from CTFd.plugins.challenges import BaseChallenge
 from CTFd.utils.user import get_ip                                                        # pylint: disable=import-error
 from CTFd.utils.uploads import delete_file                                                # pylint: disable=import-error
 
-from ..utils import (build_from_repository, delete_challenge_instance,
-                     get_challenge_from_tracker, get_challenge_tracker)
+from ..utils import delete_challenge_instance, get_challenge_from_tracker
+from ..utils.k8s_database import get_tracker_ids
+from ..utils.k8s_teardown import start_teardown_job
+from ..utils.k8s_provisioner import provisioner
+from ..utils.k8s_warm_pool import refill_warm_pool, drain_warm_pool
+from ..utils.k8s_shared import is_shared_challenge, sync_shared_instance, destroy_shared_instance
+from ..utils.k8s_build import get_image, resolve_commit, needs_build, track_build
+from ..utils.k8s_prepull import sync_prepull
+from ..utils.k8s_trace import log_event
 
 class K8sChallengeType(BaseChallenge): #pylint: disable=too-few-public-methods
     """
@@ -34,17 +41,30 @@ class K8sChallengeType(BaseChallenge): #pylint: disable=too-few-public-methods
 		"""
         data = request.form or request.get_json()
 
-        if (('force-rebuild' in data and data['force-rebuild']) or
-             ('repository' in data and data['repository'] != challenge.repository)):
-            try:
-                data['image'] = build_from_repository(data['name'], data['repository'])
-            except Exception as general_exception: # pylint: disable=broad-except
-                print("ERROR: ctfd-k8s-challenges: ", general_exception)
-                return "Error re-building challenge.  Challenge not updated.", 500
+        rebuild = (('force-rebuild' in data and data['force-rebuild']) or
+                   ('repository' in data and data['repository'] != challenge.repository))
+        if rebuild:
+            name = data.get('name', challenge.name)
+            repository = data.get('repository', challenge.repository)
+            commit = resolve_commit(repository)
+            # The image already holds this commit of this repository
+            rebuild = needs_build(challenge, name, repository, commit)
+            if rebuild:
+                data['image'] = get_image(name)
+        was_shared = is_shared_challenge(challenge)
         for attr, value in data.items():
             setattr(challenge, attr, value)
 
         db.session.commit()
+        if rebuild:
+            track_build(challenge.id, commit)
+        if was_shared and not is_shared_challenge(challenge):
+            # Its players were only using the shared instance, which is deleted
+            start_teardown_job('challenge:' + str(challenge.id),
+                               get_tracker_ids(challenge_id=challenge.id))
+        provisioner.submit(refill_warm_pool, challenge.id)
+        provisioner.submit(sync_shared_instance, challenge.id)
+        provisioner.submit(sync_prepull)
         return challenge
 
     @staticmethod
@@ -55,9 +75,11 @@ class K8sChallengeType(BaseChallenge): #pylint: disable=too-few-public-methods
 		:param challenge:
 		:return:
 		"""
-        challenge_tracker = get_challenge_tracker()
-        for challenge in challenge_tracker: #pylint: disable=redefined-argument-from-local
-            delete_challenge_instance(challenge)
+        job_id = start_teardown_job('challenge:' + str(challenge.id),
+                                    get_tracker_ids(challenge_id=challenge.id))
+        log_event('delete_challenge_instances', challenge=challenge.id, job=job_id)
+        drain_warm_pool(challenge.id)
+        destroy_shared_instance(challenge.id)
 
         Fails.query.filter_by(challenge_id=challenge.id).delete()
         Solves.query.filter_by(challenge_id=challenge.id).delete()
@@ -71,6 +93,7 @@ class K8sChallengeType(BaseChallenge): #pylint: disable=too-few-public-methods
         K8sChallenge.query.filter_by(id=challenge.id).delete()
         Challenges.query.filter_by(id=challenge.id).delete()
         db.session.commit()
+        provisioner.submit(sync_prepull)
 
     @staticmethod
     def read(challenge):
@@ -129,14 +152,15 @@ class K8sChallengeType(BaseChallenge): #pylint: disable=too-few-public-methods
 		:return:
 		"""
         data = request.form or request.get_json()
-        try:
-            data['image'] = build_from_repository(data['name'], data['repository'])
-        except Exception as general_exception: # pylint: disable=broad-except
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
-            return "Error building challenge.  Challenge not created.", 500
+        data['image'] = get_image(data['name'])
+        commit = resolve_commit(data['repository'])
         challenge = get_k8s_challenge_class(data)
         db.session.add(challenge)
         db.session.commit()
+        track_build(challenge.id, commit)
+        provisioner.submit(refill_warm_pool, challenge.id)
+        provisioner.submit(sync_shared_instance, challenge.id)
+        provisioner.submit(sync_prepull)
         return challenge
 
     @staticmethod
@@ -146,7 +170,12 @@ class K8sChallengeType(BaseChallenge): #pylint: disable=too-few-public-methods
 		:param request:
 		:return:
 		"""
-        delete_challenge_instance(get_challenge_from_tracker(user.id))
+        # A shared instance is found through the team, so it is deleted once for all members.
+        # An instance of another challenge, e.g. one the team is still working on, stays.
+        challenge_instance = get_challenge_from_tracker(user.id, team.id if team else None,
+                                                        challenge.id)
+        if challenge_instance and challenge_instance.challenge_id == challenge.id:
+            delete_challenge_instance(challenge_instance)
         data = request.form or request.get_json()
         submission = data["submission"].strip()
         solve = Solves(
@@ -168,6 +197,22 @@ class K8sChallenge(Challenges): #pylint: disable=too-few-public-methods
     image = db.Column(db.String(128), index=False)
     repository = db.Column(db.String(128), index=False)
     port = db.Column(db.Integer, index=False)
+    warm_pool_size = db.Column(db.Integer, index=False, default=0)
+    warm_pool_hits = db.Column(db.Integer, index=False, default=0)
+    warm_pool_misses = db.Column(db.Integer, index=False, default=0)
+    team_instance = db.Column(db.Integer, index=False, default=0)
+    max_instances = db.Column(db.Integer, index=False, default=0)
+    shared_instance = db.Column(db.Integer, index=False, default=0)
+    min_replicas = db.Column(db.Integer, index=False, default=1)
+    max_replicas = db.Column(db.Integer, index=False, default=1)
+    build_status = db.Column(db.String(16), index=False)
+    build_time = db.Column(db.Integer, index=False)
+    # Digest of the last successfully built image, which instances are deployed by
+    image_digest = db.Column(db.String(128), index=False)
+    # Commit the digest was built from, so a rebuild of the same commit is skipped
+    image_commit = db.Column(db.String(64), index=False)
+    build_commit = db.Column(db.String(64), index=False)
+    build_job = db.Column(db.String(64), index=False)
 
 class K8sTcpChallenge(K8sChallenge): #pylint: disable=too-few-public-methods
     """
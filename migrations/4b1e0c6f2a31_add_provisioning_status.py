@@ -0,0 +1,38 @@
+# pylint: disable=invalid-name
+"""
+Add provisioning status to the tracker
+
+Revision ID: 4b1e0c6f2a31
+Revises:
+Create Date: 2026-10-18 09:12:44.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "4b1e0c6f2a31"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the tracker status and the provisioning pool size.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge_tracker", names_only=True)
+    if "status" not in columns:
+        op.add_column("k8s_challenge_tracker",
+                      sa.Column("status", sa.String(length=16), nullable=True,
+                                server_default="running"))
+
+    columns = get_columns_for_table(op=op, table_name="k8s_config", names_only=True)
+    if "provisioning_workers" not in columns:
+        op.add_column("k8s_config", sa.Column("provisioning_workers", sa.Integer(), nullable=True))
+
+
+def downgrade(op=None):
+    """
+    Removes the tracker status and the provisioning pool size.
+    """
+    op.drop_column("k8s_challenge_tracker", "status")
+    op.drop_column("k8s_config", "provisioning_workers")
@@ -0,0 +1,35 @@
+# pylint: disable=invalid-name
+"""
+Add warm pool settings and counters to challenges
+
+Revision ID: 9d27c3a8e5f0
+Revises: 4b1e0c6f2a31
+Create Date: 2026-10-18 11:40:02.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "9d27c3a8e5f0"
+down_revision = "4b1e0c6f2a31"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the warm pool size and hit/miss counters.
+    The k8s_warm_instance table itself is created by create_all.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge", names_only=True)
+    for column in ("warm_pool_size", "warm_pool_hits", "warm_pool_misses"):
+        if column not in columns:
+            op.add_column("k8s_challenge",
+                          sa.Column(column, sa.Integer(), nullable=True, server_default="0"))
+
+
+def downgrade(op=None):
+    """
+    Removes the warm pool size and hit/miss counters.
+    """
+    for column in ("warm_pool_size", "warm_pool_hits", "warm_pool_misses"):
+        op.drop_column("k8s_challenge", column)
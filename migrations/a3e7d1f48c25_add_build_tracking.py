@@ -0,0 +1,37 @@
+# pylint: disable=invalid-name
+"""
+Add tracked image builds and the digest instances are deployed by
+
+Revision ID: a3e7d1f48c25
+Revises: f1c6a9d3b472
+Create Date: 2026-10-18 20:52:09.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "a3e7d1f48c25"
+down_revision = "f1c6a9d3b472"
+branch_labels = None
+depends_on = None
+
+NEW_COLUMNS = [sa.Column("build_status", sa.String(16), nullable=True),
+               sa.Column("build_time", sa.Integer(), nullable=True),
+               sa.Column("image_digest", sa.String(128), nullable=True)]
+
+
+def upgrade(op=None):
+    """
+    Adds the build status, build time and image digest to k8s_challenge.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge", names_only=True)
+    for column in NEW_COLUMNS:
+        if column.name not in columns:
+            op.add_column("k8s_challenge", column)
+
+
+def downgrade(op=None):
+    """
+    Removes the build tracking columns.
+    """
+    for column in NEW_COLUMNS:
+        op.drop_column("k8s_challenge", column.name)
@@ -0,0 +1,57 @@
+# pylint: disable=invalid-name
+"""
+Let a team share one instance per challenge instead of one in total
+
+Revision ID: a5d3f7b91c42
+Revises: e4f7a2c9b136
+Create Date: 2026-10-19 14:26:05.000000
+"""
+import sqlalchemy as sa
+
+revision = "a5d3f7b91c42"
+down_revision = "e4f7a2c9b136"
+branch_labels = None
+depends_on = None
+
+# The shared team constraint of each table, before and after.
+CONSTRAINTS = {
+    "k8s_challenge_tracker": ("uq_k8s_challenge_tracker_shared_team",
+                              "uq_k8s_challenge_tracker_shared_team_challenge"),
+    "k8s_admission_queue": ("uq_k8s_admission_queue_shared_team",
+                            "uq_k8s_admission_queue_shared_team_challenge"),
+}
+
+
+def get_constraint_names(op, table):
+    """
+    Returns the names of a table's unique constraints, or None if it does not exist.
+    """
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table(table):
+        return None
+    return {constraint["name"] for constraint in inspector.get_unique_constraints(table)}
+
+
+def upgrade(op=None):
+    """
+    Replaces the unique shared team with a unique shared team and challenge.
+    """
+    for table, (old, new) in CONSTRAINTS.items():
+        names = get_constraint_names(op, table)
+        if names is None or (old not in names and new in names):
+            continue
+        with op.batch_alter_table(table) as batch_op:
+            if old in names:
+                batch_op.drop_constraint(old, type_="unique")
+            if new not in names:
+                batch_op.create_unique_constraint(new, ["shared_team_id", "challenge_id"])
+
+
+def downgrade(op=None):
+    """
+    Restores the unique shared team.
+    """
+    for table, (old, new) in CONSTRAINTS.items():
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint(new, type_="unique")
+            batch_op.create_unique_constraint(old, ["shared_team_id"])
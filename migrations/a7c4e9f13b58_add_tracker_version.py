@@ -0,0 +1,33 @@
+# pylint: disable=invalid-name
+"""
+Add a row version to the challenge tracker
+
+Revision ID: a7c4e9f13b58
+Revises: f5b2d8e61c47
+Create Date: 2026-10-18 17:10:32.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "a7c4e9f13b58"
+down_revision = "f5b2d8e61c47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the version column, which is bumped whenever a tracked instance changes.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge_tracker", names_only=True)
+    if "version" not in columns:
+        op.add_column("k8s_challenge_tracker",
+                      sa.Column("version", sa.Integer(), nullable=True, server_default="1"))
+        op.execute("UPDATE k8s_challenge_tracker SET version = 1 WHERE version IS NULL")
+
+
+def downgrade(op=None):
+    """
+    Removes the version column.
+    """
+    op.drop_column("k8s_challenge_tracker", "version")
@@ -0,0 +1,90 @@
+# pylint: disable=invalid-name
+"""
+Type the tracker's user and team ids and index it for its lookups
+
+Revision ID: b2d6f0a8c914
+Revises: a7c4e9f13b58
+Create Date: 2026-10-18 18:02:47.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "b2d6f0a8c914"
+down_revision = "a7c4e9f13b58"
+branch_labels = None
+depends_on = None
+
+TABLE = "k8s_challenge_tracker"
+# Single column indexes made redundant by the composite ones.
+OLD_INDEXES = {
+    "ix_k8s_challenge_tracker_user_id": ["user_id"],
+    "ix_k8s_challenge_tracker_team_id": ["team_id"],
+    "ix_k8s_challenge_tracker_type": ["type"],
+    "ix_k8s_challenge_tracker_port": ["port"],
+}
+NEW_INDEXES = {
+    "ix_k8s_challenge_tracker_team_revert": ["team_id", "revert_time"],
+    "ix_k8s_challenge_tracker_type_port": ["type", "port", "instance_id"],
+}
+USER_CONSTRAINT = "uq_k8s_challenge_tracker_user"
+
+
+def get_index_names(op):
+    """
+    Returns the names of the tracker's indexes and unique constraints.
+    """
+    inspector = sa.inspect(op.get_bind())
+    names = {index["name"] for index in inspector.get_indexes(TABLE)}
+    names.update(constraint["name"] for constraint in inspector.get_unique_constraints(TABLE))
+    return names
+
+
+def upgrade(op=None):
+    """
+    Turns user_id and team_id into integers, replaces the single column indexes
+    with ones matching the tracker's queries and allows one instance per user.
+    """
+    columns = {column["name"]: column["type"]
+               for column in get_columns_for_table(op=op, table_name=TABLE)}
+    indexes = get_index_names(op)
+
+    for name in OLD_INDEXES:
+        if name in indexes:
+            op.drop_index(name, table_name=TABLE)
+
+    if not isinstance(columns["user_id"], sa.Integer):
+        # Teams were stored as '' outside of teams mode
+        op.execute(f"UPDATE {TABLE} SET team_id = NULL WHERE team_id = '' OR team_id = 'None'")
+        # Keep only the newest instance of users that somehow got two, the
+        # reconciler deletes the Kubernetes objects of the others
+        older = (f"FROM {TABLE} WHERE id NOT IN (SELECT id FROM "
+                 f"(SELECT MAX(id) AS id FROM {TABLE} GROUP BY user_id) AS newest)")
+        for row in op.get_bind().execute(sa.text(
+                f"SELECT id, user_id, team_id, challenge_id, instance_id {older}")):
+            print("ctfd-k8s-challenge: Removing duplicate tracker row", dict(row._mapping)) # pylint: disable=protected-access
+        op.execute(f"DELETE {older}")
+        with op.batch_alter_table(TABLE) as batch_op:
+            for column in ("user_id", "team_id"):
+                batch_op.alter_column(column, existing_type=sa.String(64), type_=sa.Integer(),
+                                      postgresql_using=f"{column}::integer")
+
+    if USER_CONSTRAINT not in indexes:
+        with op.batch_alter_table(TABLE) as batch_op:
+            batch_op.create_unique_constraint(USER_CONSTRAINT, ["user_id"])
+    for name, index_columns in NEW_INDEXES.items():
+        if name not in indexes:
+            op.create_index(name, TABLE, index_columns)
+
+
+def downgrade(op=None):
+    """
+    Restores the string ids and the single column indexes.
+    """
+    for name in NEW_INDEXES:
+        op.drop_index(name, table_name=TABLE)
+    with op.batch_alter_table(TABLE) as batch_op:
+        batch_op.drop_constraint(USER_CONSTRAINT, type_="unique")
+        for column in ("user_id", "team_id"):
+            batch_op.alter_column(column, existing_type=sa.Integer(), type_=sa.String(64))
+    for name, index_columns in OLD_INDEXES.items():
+        op.create_index(name, TABLE, index_columns)
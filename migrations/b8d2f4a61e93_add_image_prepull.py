@@ -0,0 +1,31 @@
+# pylint: disable=invalid-name
+"""
+Add the image pre-pull setting
+
+Revision ID: b8d2f4a61e93
+Revises: a3e7d1f48c25
+Create Date: 2026-10-18 21:12:40.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "b8d2f4a61e93"
+down_revision = "a3e7d1f48c25"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the prepull_images config column.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_config", names_only=True)
+    if "prepull_images" not in columns:
+        op.add_column("k8s_config", sa.Column("prepull_images", sa.Boolean(), nullable=True))
+
+
+def downgrade(op=None):
+    """
+    Removes the prepull_images config column.
+    """
+    op.drop_column("k8s_config", "prepull_images")
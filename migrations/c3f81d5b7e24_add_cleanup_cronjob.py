@@ -0,0 +1,31 @@
+# pylint: disable=invalid-name
+"""
+Add the cleanup CronJob toggle
+
+Revision ID: c3f81d5b7e24
+Revises: 9d27c3a8e5f0
+Create Date: 2026-10-18 13:05:37.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "c3f81d5b7e24"
+down_revision = "9d27c3a8e5f0"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the cleanup_cronjob config column.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_config", names_only=True)
+    if "cleanup_cronjob" not in columns:
+        op.add_column("k8s_config", sa.Column("cleanup_cronjob", sa.Boolean(), nullable=True))
+
+
+def downgrade(op=None):
+    """
+    Removes the cleanup_cronjob config column.
+    """
+    op.drop_column("k8s_config", "cleanup_cronjob")
@@ -0,0 +1,42 @@
+# pylint: disable=invalid-name
+"""
+Add the build commits and jobs and the build concurrency limit
+
+Revision ID: c5e9a2d7f014
+Revises: b8d2f4a61e93
+Create Date: 2026-10-18 21:40:27.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "c5e9a2d7f014"
+down_revision = "b8d2f4a61e93"
+branch_labels = None
+depends_on = None
+
+NEW_COLUMNS = {
+    "k8s_config": [sa.Column("build_concurrency", sa.Integer(), nullable=True)],
+    "k8s_challenge": [sa.Column("image_commit", sa.String(64), nullable=True),
+                      sa.Column("build_commit", sa.String(64), nullable=True),
+                      sa.Column("build_job", sa.String(64), nullable=True)],
+}
+
+
+def upgrade(op=None):
+    """
+    Adds the commit and Job of each challenge's build and the build concurrency limit.
+    """
+    for table, new_columns in NEW_COLUMNS.items():
+        columns = get_columns_for_table(op=op, table_name=table, names_only=True)
+        for column in new_columns:
+            if column.name not in columns:
+                op.add_column(table, column)
+
+
+def downgrade(op=None):
+    """
+    Removes the build commit, Job and concurrency columns.
+    """
+    for table, new_columns in NEW_COLUMNS.items():
+        for column in new_columns:
+            op.drop_column(table, column.name)
@@ -0,0 +1,49 @@
+# pylint: disable=invalid-name
+"""
+Add instances shared by a team
+
+Revision ID: d4a9e2c71f06
+Revises: b2d6f0a8c914
+Create Date: 2026-10-18 18:41:15.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "d4a9e2c71f06"
+down_revision = "b2d6f0a8c914"
+branch_labels = None
+depends_on = None
+
+SHARED_TEAM_CONSTRAINT = "uq_k8s_challenge_tracker_shared_team_challenge"
+
+
+def upgrade(op=None):
+    """
+    Adds the team_instances config and challenge columns and the tracker's shared team.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_config", names_only=True)
+    if "team_instances" not in columns:
+        op.add_column("k8s_config", sa.Column("team_instances", sa.Boolean(), nullable=True))
+
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge", names_only=True)
+    if "team_instance" not in columns:
+        op.add_column("k8s_challenge",
+                      sa.Column("team_instance", sa.Integer(), nullable=True, server_default="0"))
+
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge_tracker", names_only=True)
+    if "shared_team_id" not in columns:
+        with op.batch_alter_table("k8s_challenge_tracker") as batch_op:
+            batch_op.add_column(sa.Column("shared_team_id", sa.Integer(), nullable=True))
+            batch_op.create_unique_constraint(SHARED_TEAM_CONSTRAINT,
+                                              ["shared_team_id", "challenge_id"])
+
+
+def downgrade(op=None):
+    """
+    Removes the team_instances columns and the tracker's shared team.
+    """
+    with op.batch_alter_table("k8s_challenge_tracker") as batch_op:
+        batch_op.drop_constraint(SHARED_TEAM_CONSTRAINT, type_="unique")
+        batch_op.drop_column("shared_team_id")
+    op.drop_column("k8s_challenge", "team_instance")
+    op.drop_column("k8s_config", "team_instances")
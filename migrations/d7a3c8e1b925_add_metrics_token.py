@@ -0,0 +1,31 @@
+# pylint: disable=invalid-name
+"""
+Add the metrics bearer token
+
+Revision ID: d7a3c8e1b925
+Revises: c5e9a2d7f014
+Create Date: 2026-10-18 22:05:51.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "d7a3c8e1b925"
+down_revision = "c5e9a2d7f014"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the metrics_token config column.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_config", names_only=True)
+    if "metrics_token" not in columns:
+        op.add_column("k8s_config", sa.Column("metrics_token", sa.String(128), nullable=True))
+
+
+def downgrade(op=None):
+    """
+    Removes the metrics_token config column.
+    """
+    op.drop_column("k8s_config", "metrics_token")
@@ -0,0 +1,32 @@
+# pylint: disable=invalid-name
+"""
+Add the teardown concurrency setting
+
+Revision ID: e1a4b7c29d63
+Revises: c3f81d5b7e24
+Create Date: 2026-10-18 14:21:10.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "e1a4b7c29d63"
+down_revision = "c3f81d5b7e24"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the teardown_concurrency config column.
+    The k8s_teardown_job table itself is created by create_all.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_config", names_only=True)
+    if "teardown_concurrency" not in columns:
+        op.add_column("k8s_config", sa.Column("teardown_concurrency", sa.Integer(), nullable=True))
+
+
+def downgrade(op=None):
+    """
+    Removes the teardown_concurrency config column.
+    """
+    op.drop_column("k8s_config", "teardown_concurrency")
@@ -0,0 +1,31 @@
+# pylint: disable=invalid-name
+"""
+Add the deletion claim time to the tracker
+
+Revision ID: e4f7a2c9b136
+Revises: d7a3c8e1b925
+Create Date: 2026-10-19 10:12:37.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "e4f7a2c9b136"
+down_revision = "d7a3c8e1b925"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the claimed_at tracker column.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge_tracker", names_only=True)
+    if "claimed_at" not in columns:
+        op.add_column("k8s_challenge_tracker", sa.Column("claimed_at", sa.Integer, nullable=True))
+
+
+def downgrade(op=None):
+    """
+    Removes the claimed_at tracker column.
+    """
+    op.drop_column("k8s_challenge_tracker", "claimed_at")
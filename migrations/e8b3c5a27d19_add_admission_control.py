@@ -0,0 +1,47 @@
+# pylint: disable=invalid-name
+"""
+Add the admission control limits and the tracked instances' resource requests
+
+Revision ID: e8b3c5a27d19
+Revises: d4a9e2c71f06
+Create Date: 2026-10-18 19:26:03.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "e8b3c5a27d19"
+down_revision = "d4a9e2c71f06"
+branch_labels = None
+depends_on = None
+
+NEW_COLUMNS = {
+    "k8s_config": [sa.Column("max_instances", sa.Integer(), nullable=True),
+                   sa.Column("cpu_budget", sa.String(16), nullable=True),
+                   sa.Column("memory_budget", sa.String(16), nullable=True)],
+    "k8s_challenge": [sa.Column("max_instances", sa.Integer(), nullable=True,
+                                server_default="0")],
+    "k8s_challenge_tracker": [sa.Column("cpu_request", sa.Integer(), nullable=True,
+                                        server_default="0"),
+                              sa.Column("memory_request", sa.Integer(), nullable=True,
+                                        server_default="0")],
+}
+
+
+def upgrade(op=None):
+    """
+    Adds the capacity limits and the resource requests admission control counts.
+    """
+    for table, new_columns in NEW_COLUMNS.items():
+        columns = get_columns_for_table(op=op, table_name=table, names_only=True)
+        for column in new_columns:
+            if column.name not in columns:
+                op.add_column(table, column)
+
+
+def downgrade(op=None):
+    """
+    Removes the admission control columns.
+    """
+    for table, new_columns in NEW_COLUMNS.items():
+        for column in new_columns:
+            op.drop_column(table, column.name)
@@ -0,0 +1,37 @@
+# pylint: disable=invalid-name
+"""
+Add challenges that share one autoscaled instance between all players
+
+Revision ID: f1c6a9d3b472
+Revises: e8b3c5a27d19
+Create Date: 2026-10-18 20:14:38.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "f1c6a9d3b472"
+down_revision = "e8b3c5a27d19"
+branch_labels = None
+depends_on = None
+
+NEW_COLUMNS = [sa.Column("shared_instance", sa.Integer(), nullable=True, server_default="0"),
+               sa.Column("min_replicas", sa.Integer(), nullable=True, server_default="1"),
+               sa.Column("max_replicas", sa.Integer(), nullable=True, server_default="1")]
+
+
+def upgrade(op=None):
+    """
+    Adds the shared instance mode and its replica bounds to k8s_challenge.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_challenge", names_only=True)
+    for column in NEW_COLUMNS:
+        if column.name not in columns:
+            op.add_column("k8s_challenge", column)
+
+
+def downgrade(op=None):
+    """
+    Removes the shared instance columns.
+    """
+    for column in NEW_COLUMNS:
+        op.drop_column("k8s_challenge", column.name)
@@ -0,0 +1,31 @@
+# pylint: disable=invalid-name
+"""
+Add the reconcile interval setting
+
+Revision ID: f5b2d8e61c47
+Revises: e1a4b7c29d63
+Create Date: 2026-10-18 16:02:45.000000
+"""
+import sqlalchemy as sa
+from CTFd.plugins.migrations import get_columns_for_table # pylint: disable=import-error
+
+revision = "f5b2d8e61c47"
+down_revision = "e1a4b7c29d63"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    """
+    Adds the reconcile_interval config column.
+    """
+    columns = get_columns_for_table(op=op, table_name="k8s_config", names_only=True)
+    if "reconcile_interval" not in columns:
+        op.add_column("k8s_config", sa.Column("reconcile_interval", sa.Integer(), nullable=True))
+
+
+def downgrade(op=None):
+    """
+    Removes the reconcile_interval config column.
+    """
+    op.drop_column("k8s_config", "reconcile_interval")
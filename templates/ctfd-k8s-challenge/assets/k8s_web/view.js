@@ -36,10 +36,98 @@ CTFd._internal.challenge.submit = function(preview) {
   });
 };
 
+// One event stream and one countdown are shared by every challenge modal opened on the page
+window.k8sInstance = window.k8sInstance || {events: null, unavailable: false, countdown: null, challengeId: null,
+                                             status: null, etag: null};
+
+function k8s_events_live() {
+  var events = window.k8sInstance.events;
+  return events !== null && events.readyState === EventSource.OPEN;
+}
+
+function k8s_subscribe(id) {
+  window.k8sInstance.challengeId = id;
+  if (!window.EventSource || window.k8sInstance.events !== null || window.k8sInstance.unavailable) {
+    return;
+  }
+  var events = new EventSource('/api/v1/k8s/events');
+  var refresh = function() {
+    if ($('#k8s_container').length) {
+      get_k8s_status(window.k8sInstance.challengeId);
+    }
+  };
+  // Catch up on anything that changed while the stream was connecting
+  events.addEventListener('open', refresh);
+  events.addEventListener('k8s-instance', refresh);
+  events.addEventListener('error', function() {
+    if (events.readyState === EventSource.CLOSED) {
+      // Events are turned off, so fall back to polling /api/v1/k8s/status
+      window.k8sInstance.events = null;
+      window.k8sInstance.unavailable = true;
+    }
+  });
+  window.k8sInstance.events = events;
+}
+
+function k8s_fetch_status(callback) {
+  // The status of every challenge comes in one response that is only sent again when it changed
+  var headers = {};
+  if (window.k8sInstance.etag !== null) {
+    headers['If-None-Match'] = window.k8sInstance.etag;
+  }
+  $.ajax({url: '/api/v1/k8s/status', headers: headers}).done(function(result, textStatus, xhr) {
+    if (xhr.status !== 304 || window.k8sInstance.status === null) {
+      window.k8sInstance.status = result;
+      window.k8sInstance.etag = xhr.getResponseHeader('ETag');
+    }
+    callback(window.k8sInstance.status);
+  });
+}
+
 function get_k8s_status(id) {
-  $.get("/api/v1/k8s/get?challenge_id="+id, function(result) {
+  k8s_subscribe(id);
+  k8s_fetch_status(function(status) {
+    var result = status.Challenges[id];
+    if (result === undefined) {
+      $.get("/api/v1/k8s/get?challenge_id="+id, function(result) {
+        render_k8s_status(id, result);
+      });
+    } else {
+      render_k8s_status(id, result);
+    }
+  });
+}
+
+function render_k8s_status(id, result) {
     if (result.InstanceRunning) {
         if (result.ThisChallengeInstance) {
+          var queued = result.InstanceStatus === 'queued';
+          var starting = result.InstanceStatus === 'pending' ||
+            (result.InstanceStatus === 'running' && result.InstanceReady === false);
+          if (queued || starting || result.InstanceStatus === 'failed') {
+            if (queued || starting) {
+              if (queued) {
+                $('#k8s_countdown').html('Waiting for a free slot, position ' + result.QueuePosition + ' in the queue...')
+              } else {
+                $('#k8s_countdown').html('Instance is starting...')
+              }
+              if (!k8s_events_live()) {
+                setTimeout(function() {
+                  if ($('#k8s_container').length) {
+                    get_k8s_status(id);
+                  }
+                }, 3000);
+              }
+            } else {
+              $('#k8s_countdown').html('Instance failed to start.  Stop it and try again.')
+            }
+            $('#k8s_countdown').css('display', 'block')
+            $('#k8s_connection').css('display', 'none')
+            $('#k8s_start').css('display', 'none')
+            $('#k8s_stop').css('display', 'inline-block')
+            $('#k8s_extend').css('display', 'none')
+            return;
+          }
           connectionPort = result.ConnectionPort
           connectionURL = result.ConnectionURL + ':' + String(connectionPort)
           expireTime = result.ExpireTime
@@ -47,7 +135,8 @@ function get_k8s_status(id) {
           $('#k8s_connection_link').attr('href', connectionURL)
           $('#k8s_connection').css('display', 'block')
           var countDownDate = new Date(parseInt(result.ExpireTime) * 1000);
-          var countDownIntervalID = setInterval(function() {
+          clearInterval(window.k8sInstance.countdown);
+          window.k8sInstance.countdown = setInterval(function() {
               var now = new Date().getTime();
               var distance = countDownDate - now;
               var minutes = Math.floor((distance % (1000 * 60 * 60)) / (1000 * 60));
@@ -57,7 +146,7 @@ function get_k8s_status(id) {
               }
               $('#k8s_countdown').html('Instance expires in ' + minutes + ':' + seconds);
               if (distance < 0) {
-                  clearInterval(countDownIntervalID);
+                  clearInterval(window.k8sInstance.countdown);
                   $('#k8s_start').css('display', 'block')
                   $('#k8s_stop').css('display', 'none')
                   $('#k8s_connection').css('display', 'none')
@@ -86,5 +175,4 @@ function get_k8s_status(id) {
         $('#k8s_countdown').css('display', 'none')
         $('#k8s_extend').css('display', 'none')
       }
-  });
 };
@@ -6,6 +6,9 @@ This module implements the functions that interact with k8s and the db.
 from .k8s_manage_objects import *
 from .k8s_database import (init_db, get_config, get_challenge_from_tracker,
                             get_challenge_tracker, get_all_challenges)
+from .k8s_templates import template_registry
 from .k8s_build import build_from_repository
-from .k8s_client import get_k8s_client, get_k8s_v1_client
-from .k8s_api import define_k8s_api, delete_challenge_instance
+from .k8s_client import (get_k8s_client, get_k8s_v1_client, get_k8s_apps_client,
+                         get_k8s_networking_client, get_k8s_custom_client)
+from .k8s_api import define_k8s_api
+from .k8s_instances import delete_challenge_instance
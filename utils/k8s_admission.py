@@ -0,0 +1,351 @@
+"""
+k8s_admission
+
+Starts challenge instances only while the cluster has room for them.
+
+The limits are the number of tracked instances (globally and per challenge) and a
+CPU and memory budget, counted from the resource requests of the rendered
+instance templates.  When any limit is configured, new instances wait in the
+k8s_admission_queue table and one worker at a time admits them.  The queue is
+served in arrival order, except that the next instance goes to the team with the
+fewest running instances, so one busy team cannot hold back everyone else.  An
+instance's expiry time starts when it is admitted.
+"""
+import uuid
+import threading
+from decimal import Decimal
+
+from kubernetes.utils import parse_quantity
+
+from .k8s_background import BackgroundThread, acquire_lock, release_lock
+from .k8s_client import get_k8s_client, get_k8s_v1_client
+from .k8s_manage_objects import (get_template, get_instance_options, get_instance_resources,
+                                 add_ingress_port, delete_ingress_port, destroy_instance)
+from .k8s_database import (get_config, get_challenge_by_id, insert_challenge_into_tracker,
+                           get_expired_challenge_of_user, get_tracker_usage, get_owner_key,
+                           enqueue_instance, get_queued_instances, remove_queued_instance,
+                           get_queue_size, get_shared_instance_id)
+from .k8s_instances import provision_challenge_instance
+from .k8s_provisioner import provisioner
+from .k8s_reaper import reaper
+from .k8s_teardown import teardown_instance
+from .k8s_ports import port_allocator, PortExhaustedError
+from .k8s_events import publish_instance_event
+from .k8s_trace import span, set_trace_fields, log_error
+from .k8s_warm_pool import claim_warm_instance, label_claimed_instance
+from .k8s_shared import is_shared_challenge
+
+ADMIT_INTERVAL = 2
+LOCK_KEY = 'ctfd_k8s_challenge_admission_lock'
+# Longest an admission round may hold the lock if its worker dies.
+LOCK_TIMEOUT = 60
+
+
+def get_capacity_limits(config):
+    """
+    Returns the configured instance count, CPU (millicores) and memory (MiB) limits.
+    A limit that is not set is None.
+    """
+    limits = {'instances': config.max_instances or None, 'cpu': None, 'memory': None}
+    # Quantities such as 500m or 8Gi, in cores and bytes
+    for name, quantity, unit in (('cpu', config.cpu_budget, Decimal('0.001')),
+                                 ('memory', config.memory_budget, 2**20)):
+        if quantity:
+            try:
+                limits[name] = int(parse_quantity(quantity) / unit)
+            except ValueError as general_exception:
+                log_error(general_exception)
+    return limits
+
+
+def admission_enabled(config):
+    """
+    Returns True if any capacity limit is configured.
+    """
+    return any(limit is not None for limit in get_capacity_limits(config).values())
+
+
+def fits(usage, limits, cpu_request, memory_request):
+    """
+    Returns True if one more instance with these requests stays within the limits.
+    """
+    return ((limits['instances'] is None or usage['instances'] < limits['instances']) and
+            (limits['cpu'] is None or usage['cpu'] + cpu_request <= limits['cpu']) and
+            (limits['memory'] is None or usage['memory'] + memory_request <= limits['memory']))
+
+
+def challenge_full(usage, challenge):
+    """
+    Returns True if the challenge already runs as many instances as it may.
+    """
+    cap = int(getattr(challenge, 'max_instances', 0) or 0)
+    return 0 < cap <= usage['challenges'].get(challenge.id, 0)
+
+
+def track_instance(options, expire_interval, status):
+    """
+    Inserts a new instance into the tracker, first tearing down the user's
+    expired instance if the reaper has not deleted it yet.
+    Returns None if the user already has an instance.
+    """
+    tracked = insert_challenge_into_tracker(options, expire_interval, status=status)
+    if tracked is None:
+        expired = get_expired_challenge_of_user(options['user'], options['shared_team'],
+                                                options['challenge_id'])
+        if expired and teardown_instance(expired.id, 'expired') == '':
+            tracked = insert_challenge_into_tracker(options, expire_interval, status=status)
+    return tracked
+
+
+def discard_untracked_instance(config, options, warm):
+    """
+    Gives back what was set aside for an instance that could not be tracked.
+    """
+    if warm:
+        destroy_instance(get_k8s_client(), config.challenge_namespace, options['instance_id'])
+    if options['port'] is not None:
+        delete_ingress_port(get_k8s_v1_client(), config, options['port'])
+        port_allocator.release(options['port'])
+
+
+def start_instance(challenge, config, owner):
+    """
+    Takes a warm instance or deploys a new one for the owner ('user', 'team' and
+    'shared_team') and tracks it.
+    Returns None if the owner already has an instance, and raises
+    PortExhaustedError when no random port is free.
+    """
+    port = None
+    with span('claim_warm'):
+        warm_instance = claim_warm_instance(challenge)
+    if warm_instance:
+        instance_id = warm_instance['instance_id']
+    else:
+        instance_id = str(uuid.uuid4())
+    set_trace_fields(instance_id=instance_id, warm=warm_instance is not None)
+
+    if challenge.type == 'k8s-random-port':
+        with span('allocate_port'):
+            port = port_allocator.allocate(instance_id)
+            if not add_ingress_port(get_k8s_v1_client(), config, port):
+                port_allocator.release(port)
+                raise RuntimeError('The ingress port of the instance could not be opened')
+
+    with span('options'):
+        options = get_instance_options(challenge, config, instance_id, port)
+        options.update(owner)
+        options['cpu_request'], options['memory_request'] = get_instance_resources(
+            get_template(challenge.type), options)
+
+    with span('track'):
+        tracked = track_instance(options, config.expire_interval,
+                                 'running' if warm_instance else 'pending')
+    if tracked is None:
+        # Another request created an instance for the owner first
+        discard_untracked_instance(config, options, warm_instance is not None)
+        return None
+
+    if warm_instance:
+        provisioner.submit(label_claimed_instance, options)
+    else:
+        provisioner.submit(provision_challenge_instance, options)
+    reaper.schedule(tracked.id, tracked.revert_time)
+    with span('publish'):
+        publish_instance_event(options['user'], challenge.id, tracked.status,
+                               team_id=tracked.shared_team_id)
+    return tracked
+
+
+def join_shared_instance(challenge, config, owner):
+    """
+    Records the owner as a player of a shared challenge's instance.
+    Returns None if the owner already has an instance.
+    """
+    options = get_instance_options(challenge, config, get_shared_instance_id(challenge.id))
+    options.update(owner)
+    tracked = track_instance(options, config.expire_interval, 'running')
+    if tracked is not None:
+        reaper.schedule(tracked.id, tracked.revert_time)
+        publish_instance_event(options['user'], challenge.id, tracked.status,
+                               team_id=tracked.shared_team_id)
+    return tracked
+
+
+def request_instance(challenge, config, owner):
+    """
+    Starts an instance straight away when no capacity limit is set, otherwise
+    queues it and admits whatever fits.  Players of a shared challenge take no
+    capacity and join its instance at once.
+    Returns None if the owner already has an instance or is already waiting.
+    """
+    if is_shared_challenge(challenge):
+        return join_shared_instance(challenge, config, owner)
+    if not admission_enabled(config):
+        return start_instance(challenge, config, owner)
+
+    options = get_instance_options(challenge, config, 'admission', 0)
+    options.update(owner)
+    options['cpu_request'], options['memory_request'] = get_instance_resources(
+        get_template(challenge.type), options)
+    queued = enqueue_instance(options)
+    if queued is None:
+        return None
+    publish_instance_event(owner['user'], challenge.id, 'queued', team_id=owner['shared_team'])
+    # Admitting may start other players' instances, which is left to the background thread
+    admission.wake()
+    return queued
+
+
+def get_queue_order(waiting, usage):
+    """
+    Sorts queued instances into the order they are admitted in: owners with the
+    fewest instances first, then by arrival.
+    """
+    return sorted(waiting, key=lambda queued: (
+        usage['owners'].get(get_owner_key(queued.user_id, queued.team_id), 0), queued.id))
+
+
+def get_queue_position(queued):
+    """
+    Returns the 1-based position of a queued instance.
+    """
+    ordered = get_queue_order(get_queued_instances(), get_tracker_usage())
+    for position, waiting in enumerate(ordered, start=1):
+        if waiting.id == queued.id:
+            return position
+    return None
+
+
+def publish_queue_positions(waiting, usage):
+    """
+    Tells everyone still waiting their new position in the queue.
+    """
+    for position, queued in enumerate(get_queue_order(waiting, usage), start=1):
+        publish_instance_event(queued.user_id, queued.challenge_id, 'queued',
+                               team_id=queued.shared_team_id, position=position)
+
+
+def leave_queue(queued):
+    """
+    Removes an instance from the admission queue before it was admitted.
+    Returns False if it was no longer queued.
+    """
+    if not remove_queued_instance(queued.id):
+        return False
+    publish_instance_event(queued.user_id, queued.challenge_id, 'deleted',
+                           team_id=queued.shared_team_id)
+    publish_queue_positions(get_queued_instances(), get_tracker_usage())
+    return True
+
+
+def _admit(queued, challenge, config, usage):
+    """
+    Starts a queued instance and counts it in the usage.
+    Returns False if it has to keep waiting for a free port.
+    """
+    owner = {'user': queued.user_id, 'team': queued.team_id or '',
+             'shared_team': queued.shared_team_id}
+    try:
+        tracked = start_instance(challenge, config, owner)
+    except PortExhaustedError as exhausted:
+        log_error(exhausted, challenge=challenge.id)
+        return False
+    except Exception as general_exception: # pylint: disable=broad-except
+        log_error(general_exception, challenge=challenge.id)
+        tracked = None
+        publish_instance_event(queued.user_id, queued.challenge_id, 'failed',
+                               team_id=queued.shared_team_id)
+
+    remove_queued_instance(queued.id)
+    if tracked is not None:
+        owner_key = get_owner_key(queued.user_id, queued.team_id)
+        usage['instances'] += 1
+        usage['cpu'] += tracked.cpu_request or 0
+        usage['memory'] += tracked.memory_request or 0
+        usage['challenges'][challenge.id] = usage['challenges'].get(challenge.id, 0) + 1
+        usage['owners'][owner_key] = usage['owners'].get(owner_key, 0) + 1
+    return True
+
+
+def admit_queued():
+    """
+    Admits queued instances until the next one in line does not fit.
+    Instances of a challenge that is at its own cap are skipped, not waited for.
+    Returns the number of instances that left the queue.
+    """
+    token = acquire_lock(LOCK_KEY, LOCK_TIMEOUT)
+    if token is None:
+        return 0
+    try:
+        config = get_config()
+        limits = get_capacity_limits(config)
+        usage = get_tracker_usage()
+        waiting = get_queued_instances()
+        challenges = {}
+        admitted = 0
+
+        while waiting:
+            next_queued = None
+            for queued in get_queue_order(waiting, usage):
+                if queued.challenge_id not in challenges:
+                    challenges[queued.challenge_id] = get_challenge_by_id(queued.challenge_id)
+                challenge = challenges[queued.challenge_id]
+                if challenge is not None and challenge_full(usage, challenge):
+                    continue
+                next_queued = queued
+                break
+
+            if next_queued is None:
+                break
+            challenge = challenges[next_queued.challenge_id]
+            if challenge is None:
+                # The challenge was deleted while the instance waited
+                remove_queued_instance(next_queued.id)
+            elif not fits(usage, limits, next_queued.cpu_request or 0,
+                          next_queued.memory_request or 0):
+                break
+            elif not _admit(next_queued, challenge, config, usage):
+                break
+            waiting.remove(next_queued)
+            admitted += 1
+
+        if admitted:
+            # Everyone still waiting moved up
+            publish_queue_positions(waiting, usage)
+        return admitted
+    finally:
+        release_lock(LOCK_KEY, token)
+
+
+class AdmissionController(BackgroundThread):
+    """
+    A background thread that admits queued instances as capacity frees up.
+    """
+    thread_name = 'ctfd-k8s-admission'
+
+    def __init__(self):
+        super().__init__()
+        self._wake = threading.Event()
+
+    def wake(self):
+        """
+        Has the admission thread check the queue now instead of at its next interval.
+        """
+        self._wake.set()
+
+    def _run(self):
+        """
+        Checks the queue every ADMIT_INTERVAL seconds, or when woken, and admits what fits.
+        """
+        while True:
+            self._wake.wait(ADMIT_INTERVAL)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    if get_queue_size():
+                        admit_queued()
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+
+
+admission = AdmissionController()
@@ -4,31 +4,183 @@ k8s_api
 The actual API to create and delete challenge instances.
 This implements additional routes to /api/v1/k8s
 """
-import uuid
-import base64
-import random
+import hmac
+import hashlib
 import urllib.parse
 from datetime import datetime
 from CTFd.utils.config import is_teams_mode                              # pylint: disable=import-error
 from CTFd.utils.dates import unix_time        # pylint: disable=import-error
 from CTFd.utils.user import get_current_team, get_current_user, is_admin # pylint: disable=import-error
 from CTFd.utils.decorators import admins_only, authed_only, ratelimit    # pylint: disable=import-error
-from flask import request, Blueprint, redirect          # pylint: disable=import-error
+from CTFd.utils import get_app_config                   # pylint: disable=import-error
+from flask import (request, Blueprint, redirect, Response, # pylint: disable=import-error
+                   jsonify)
 
-from .k8s_client import get_k8s_client, get_k8s_v1_client
-from .k8s_manage_objects import (get_template, deploy_object, destroy_object,
-                                 add_ingress_port, delete_ingress_port)
 from .k8s_database import (get_config, get_challenge_from_tracker, get_challenge_by_id,
-                           check_if_port_in_use, insert_challenge_into_tracker,
-                           get_challenge_tracker, get_expired_challenges,
-                           extend_challenge_time, remove_challenge_from_tracker)
+                           get_tracker_ids, extend_challenge_time, get_instance_page,
+                           get_config_version, get_visible_challenge_ids, get_queued_instance,
+                           get_team_instances)
+from .k8s_instances import delete_challenge_instance
+from .k8s_provisioner import provisioner
+from .k8s_reaper import reaper
+from .k8s_teardown import init_teardown, start_teardown_job, get_teardown_status
+from .k8s_ports import port_allocator, PortExhaustedError
+from .k8s_admission import admission, request_instance, leave_queue, get_queue_position
+from .k8s_watch import instance_states
+from .k8s_reconciler import reconciler, reconcile, get_reconcile_report
+from .k8s_events import event_streams, publish_instance_event, publish_ready_event
+from .k8s_warm_pool import refill_all_warm_pools
+from .k8s_shared import sync_all_shared_instances
+from .k8s_build import resume_build_tracking
+from .k8s_prepull import sync_prepull, get_prepull_status
+from .k8s_metrics import LatencyTimer, render_metrics
+from .k8s_trace import trace, span, log_error, request_profiles, get_profiles
+
+K8S_CHALLENGE_TYPES = ('k8s-tcp', 'k8s-web', 'k8s-random-port')
+
+
+def get_current_team_id():
+    """
+    Returns the current user's team id in teams mode, otherwise None.
+    """
+    if is_teams_mode():
+        team = get_current_team()
+        return team.id if team else None
+    return None
+
+
+def is_team_instance(challenge, config):
+    """
+    Returns True if instances of the challenge are shared by a team, which is
+    set globally in the config or for the challenge.
+    """
+    return bool(config.team_instances or getattr(challenge, 'team_instance', 0))
+
+
+def get_challenge_url(challenge):
+    """
+    Returns the challenge board URL that opens a challenge.
+    """
+    return (request.referrer + '#' +
+            urllib.parse.quote_plus(challenge.name) + '-' + str(challenge.id))
+
+
+def reuse_or_replace_instance(current, challenge):
+    """
+    Decides what creating an instance of a challenge does about the current one.
+    Returns the response to send, or None once a failed instance was deleted.
+    """
+    if current.status != 'failed':
+        if current.shared_team_id and current.challenge_id == challenge.id:
+            # A teammate already started the instance the team shares
+            return redirect(get_challenge_url(challenge)), 302
+        return "User already has a challenge instance running", 200
+    delete_challenge_instance(current)
+    return None
 
-def define_k8s_api(app): #pylint: disable=too-many-statements
+
+def get_waiting_response(queued, challenge):
+    """
+    Returns the response to creating an instance while one is already queued.
+    """
+    if queued.challenge_id == challenge.id:
+        return redirect(get_challenge_url(challenge)), 302
+    return "User is already waiting for a challenge instance", 200
+
+
+def get_instance_information(challenge, challenge_id, state, config, now):
+    """
+    Returns what the challenge view shows for a challenge, given the user's
+    tracked instance (or None) and its state from the watch cache.
+    """
+    information = {'InstanceRunning': False,
+                   'ThisChallengeInstance': False,
+                   'InstanceStatus': None,
+                   'InstanceReady': None,
+                   'ExpireTime': 0}
+
+    if challenge:
+        if challenge.challenge_id == challenge_id:
+            if challenge.chal_type == 'k8s-web':
+                information['ConnectionURL'] = str('https://chal-' +
+                                                challenge.instance_id + '.' +
+                                                config.https_domain_name)
+            else:
+                information['ConnectionURL'] = str('chal-' + challenge.instance_id +
+                                                    '.' + config.tcp_domain_name)
+            information['ConnectionPort'] = challenge.port
+            information['InstanceRunning'] = True
+            information['ThisChallengeInstance'] = True
+            information['InstanceStatus'] = challenge.status
+            # Comes from the watch cache; None until it has synced
+            if state is not None:
+                information['InstanceReady'] = state['ready']
+            information['ExpireTime'] = int(challenge.revert_time)
+            remaining = information['ExpireTime'] - now
+            information['ExtendAvailable'] = 0 < remaining < config.expire_interval/2
+        else:
+            information['InstanceRunning'] = True
+    return information
+
+
+def get_queued_information(queued, challenge_id, position):
+    """
+    Returns what the challenge view shows for a challenge while the user's
+    instance waits in the admission queue.
+    """
+    information = get_instance_information(None, challenge_id, None, None, 0)
+    information['InstanceRunning'] = True
+    if queued.challenge_id == challenge_id:
+        information['ThisChallengeInstance'] = True
+        information['InstanceStatus'] = 'queued'
+        information['QueuePosition'] = position
+    return information
+
+
+def get_status_etag(user_id, instances, config, now, #pylint: disable=too-many-arguments
+                    *, challenge_ids, queued=None):
+    """
+    Returns the ETag of a user's batched status.
+    It changes with the version of the tracker rows shown, given as (row, state) pairs,
+    and anything derived from outside them, or with the queue entry and its position
+    (queued) while an instance waits.
+    """
+    tracked = []
+    for challenge, state in instances:
+        remaining = int(challenge.revert_time) - now
+        tracked.append((challenge.id, challenge.version,
+                        state['ready'] if state is not None else None,
+                        0 < remaining < config.expire_interval/2))
+    key = repr((user_id, tracked, queued, get_config_version(), challenge_ids))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def define_k8s_api(app): #pylint: disable=too-many-statements,too-many-locals
     """
     Implements all of the methods for the API as well as registering it with CTFd.
     """
     k8s_api = Blueprint('k8s_api', __name__, template_folder='templates', static_folder='assets')
 
+    provisioner.init_app(app, get_config().provisioning_workers)
+    port_allocator.rebuild()
+    init_teardown(app)
+    reaper.init_app(app)
+    instance_states.init_app(app)
+    reconciler.init_app(app)
+    admission.init_app(app)
+    instance_states.add_ready_listener(publish_ready_event)
+
+    @k8s_api.before_app_request
+    def start_background_tasks():
+        """
+        Makes sure the expiry reaper, the instance watches, the reconciler and
+        admission control run in this worker process.
+        """
+        reaper.ensure_started()
+        instance_states.ensure_started()
+        reconciler.ensure_started()
+        admission.ensure_started()
+
     @k8s_api.route("/api/v1/k8s/create", methods=["POST"])
     @authed_only
     @ratelimit(method="POST", limit=20, interval=300, key_prefix="rl")
@@ -37,74 +189,48 @@ def define_k8s_api(app): #pylint: disable=too-many-statements
         Creates a challenge instance using the challenge ID.
         """
         try:
-            user_current_challenge = get_challenge_from_tracker(get_current_user().id)
-
-            if user_current_challenge:
-                return "User already has a challenge instance running", 200
-
-            options = {}
-            config = get_config()
-
-            options['challenge_id'] = request.form['challenge_id']
-
-            if is_teams_mode():
-                options['team'] = get_current_team().id
-            else:
-                options['team'] = ''
-
-            options['user'] = get_current_user().id
-
-            challenge = get_challenge_by_id(options['challenge_id'])
-
-            options['challenge_type'] = challenge.type
-            options['instance_id'] = str(uuid.uuid4())
-
-            if options['challenge_type'] == 'k8s-random-port':
-                test_port = random.randint(40000, 50000)
-                while not check_if_port_in_use(test_port):
-                    test_port = random.randint(40000, 50000)
-                if add_ingress_port(get_k8s_v1_client(), config, test_port):
-                    options['port'] = test_port
-                else:
-                    return "Error while creating challenge", 500
-            elif options['challenge_type'] == 'k8s-tcp':
-                options['port'] = int(config.external_tcp_port)
-            elif options['challenge_type'] == 'k8s-web':
-                options['port'] = int(config.external_https_port)
-
-            options['deployment_name'] = 'chal-' + options['instance_id']
-            options['challenge_namespace'] = config.challenge_namespace
-            options['container_name'] = challenge.image
-            options['challenge_port'] = challenge.port
-            options['random_port'] = int(options['port'])
-            # Removed istio_namespace and istio_ingress_name since we're using nginx-ingress
-            options['external_tcp_port'] = int(config.external_tcp_port)
-            options['external_https_port'] = int(config.external_https_port)
-            options['tcp_cert_name'] = config.tcp_domain_name
-            options['tcp_domain_name'] = config.tcp_domain_name
-            options['https_domain_name'] = config.https_domain_name
-
-            registry_auth = base64.b64encode(str('ctfd:'+
-                                    config.registry_password).encode('ascii')).decode('ascii')
-            options['registry_data'] = base64.b64encode(str('{"auths":{"chal-registry.' +
-                                                    config.https_domain_name +
-                                                    '":{"username":"ctfd","password":"' +
-                                                    config.registry_password +
-                                                    '","auth":"' +
-                                                    registry_auth +
-                                                    '"}' + '}' +
-                                                    '}').encode('ascii')).decode('ascii')
-
-            challenge_template = get_template(options['challenge_type'])
-
-            if deploy_object(get_k8s_client(), challenge_template, options):
-                insert_challenge_into_tracker(options, config.expire_interval)
-
-                redirect_url = (request.referrer + '#' +
-                                urllib.parse.quote_plus(challenge.name) + '-' + str(challenge.id))
-                return redirect(redirect_url), 302
+            with trace('create', profile=True, user=get_current_user().id,
+                       challenge=request.form.get('challenge_id')) as current, \
+                    LatencyTimer('create') as timer:
+                with span('lookup'):
+                    team_id = get_current_team_id()
+                    config = get_config()
+                    challenge = get_challenge_by_id(request.form['challenge_id'])
+                    timer.challenge_type = challenge.type
+
+                    user_current_challenge = get_challenge_from_tracker(get_current_user().id,
+                                                                        team_id, challenge.id)
+                current.set_fields({'team': team_id, 'challenge_type': challenge.type})
+                if user_current_challenge:
+                    response = reuse_or_replace_instance(user_current_challenge, challenge)
+                    if response:
+                        current.set_fields({'outcome': 'existing'})
+                        return response
+
+                queued = get_queued_instance(get_current_user().id, team_id, challenge.id)
+                if queued:
+                    current.set_fields({'outcome': 'waiting'})
+                    return get_waiting_response(queued, challenge)
+
+                owner = {'user': get_current_user().id,
+                         'team': team_id if team_id is not None else '',
+                         'shared_team': team_id if team_id is not None and
+                                        is_team_instance(challenge, config) else None}
+                try:
+                    with span('request_instance'):
+                        started = request_instance(challenge, config, owner)
+                except PortExhaustedError as exhausted:
+                    log_error(exhausted)
+                    return "No ports are available for a new instance, try again later", 503
+                if started is None:
+                    # Another request created or queued an instance for the user first
+                    current.set_fields({'outcome': 'duplicate'})
+                    return "User already has a challenge instance running", 200
+
+                current.set_fields({'outcome': started.status})
+                return redirect(get_challenge_url(challenge)), 302
         except Exception as general_exception: # pylint: disable=broad-except
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
+            log_error(general_exception)
 
         return "Error while creating challenge", 500
 
@@ -116,42 +242,89 @@ def define_k8s_api(app): #pylint: disable=too-many-statements
         Gets the information for a specified challenge instance.
         """
         try:
-            information = {'InstanceRunning': False,
-                           'ThisChallengeInstance': False,
-                           'ExpireTime': 0}
-
-            challenge = get_challenge_from_tracker(get_current_user().id)
+            team_id = get_current_team_id()
+            challenge_id = int(request.args.get('challenge_id'))
+            challenge = get_challenge_from_tracker(get_current_user().id, team_id, challenge_id)
+            queued = None if challenge else get_queued_instance(get_current_user().id, team_id,
+                                                                 challenge_id)
+            if queued:
+                return get_queued_information(queued, challenge_id,
+                                              get_queue_position(queued)), 200
+            state = instance_states.get(challenge.instance_id) if challenge else None
+            information = get_instance_information(challenge, challenge_id,
+                                                   state, get_config(),
+                                                   unix_time(datetime.utcnow()))
+            return information, 200
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
 
-            if challenge:
-                challenge_id = int(request.args.get('challenge_id'))
-                if challenge.challenge_id == challenge_id:
-                    config = get_config()
+        return "Error retrieving info", 500
 
-                    if challenge.chal_type == 'k8s-web':
-                        information['ConnectionURL'] = str('https://chal-' +
-                                                        challenge.instance_id + '.' +
-                                                        config.https_domain_name)
-                    else:
-                        information['ConnectionURL'] = str('chal-' + challenge.instance_id +
-                                                            '.' + config.tcp_domain_name)
-                    information['ConnectionPort'] = challenge.port
-                    information['InstanceRunning'] = True
-                    information['ThisChallengeInstance'] = True
-                    information['ExpireTime'] = int(challenge.revert_time)
-                    if (information['ExpireTime'] - unix_time(datetime.utcnow())
-                        < config.expire_interval/2) and (
-                        information['ExpireTime'] - unix_time(datetime.utcnow()) > 0):
-                        information['ExtendAvailable'] = True
+    @k8s_api.route("/api/v1/k8s/status", methods=["GET"])
+    @authed_only
+    @ratelimit(method="GET", limit=300, interval=300, key_prefix="rl")
+    def status(): #pylint: disable=too-many-locals
+        """
+        Gets the information of every k8s challenge for the user in one response.
+        Answers 304 when the If-None-Match ETag is still current.
+        """
+        try:
+            user_id = get_current_user().id
+            team_id = get_current_team_id()
+            # The user's own instance, and the team's instance of each challenge they share
+            challenge = get_challenge_from_tracker(user_id)
+            shared = {row.challenge_id: row
+                      for row in (get_team_instances(team_id) if team_id else [])}
+            queued = None if challenge else get_queued_instance(user_id, team_id)
+            position = get_queue_position(queued) if queued else None
+            rows = {row.id: row for row in [challenge, *shared.values()] if row}
+            states = {row_id: instance_states.get(row.instance_id)
+                      for row_id, row in rows.items()}
+            config = get_config()
+            now = unix_time(datetime.utcnow())
+            challenge_ids = get_visible_challenge_ids(K8S_CHALLENGE_TYPES)
+
+            etag = get_status_etag(user_id, [(row, states[row_id]) for row_id, row in rows.items()],
+                                   config, now, challenge_ids=challenge_ids,
+                                   queued=(queued.id, position) if queued else None)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                information = {}
+                for challenge_id in challenge_ids:
+                    tracked = challenge if challenge and challenge.challenge_id == challenge_id \
+                        else shared.get(challenge_id, challenge)
+                    # A teammate's queued instance only holds up its own challenge
+                    if tracked is None and queued and (queued.user_id == user_id or
+                                                       queued.challenge_id == challenge_id):
+                        information[str(challenge_id)] = get_queued_information(
+                            queued, challenge_id, position)
                     else:
-                        information['ExtendAvailable'] = False
-                else:
-                    information['InstanceRunning'] = True
-            return information, 200
+                        information[str(challenge_id)] = get_instance_information(
+                            tracked, challenge_id, states[tracked.id] if tracked else None,
+                            config, now)
+                response = jsonify({'Challenges': information})
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
         except Exception as general_exception: # pylint: disable=broad-except
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
+            log_error(general_exception)
 
         return "Error retrieving info", 500
 
+    @k8s_api.route("/api/v1/k8s/events", methods=["GET"])
+    @authed_only
+    @ratelimit(method="GET", limit=150, interval=60, key_prefix="rl")
+    def events():
+        """
+        Streams the lifecycle changes of the user's instances as server-sent events.
+        """
+        if get_app_config("SERVER_SENT_EVENTS") is False:
+            return "", 204
+
+        return Response(event_streams.subscribe(get_current_user().id),
+                        mimetype="text/event-stream")
+
     @k8s_api.route("/api/v1/k8s/delete", methods=["POST"])
     @authed_only
     @ratelimit(method="POST", limit=20, interval=300, key_prefix="rl")
@@ -160,21 +333,38 @@ def define_k8s_api(app): #pylint: disable=too-many-statements
         Deletes the user's or if admin the specified user's instance.
         """
         try:
-            if is_admin() and 'user_id' in request.form:
-                user_id = request.form['user_id']
-            else:
-                user_id = get_current_user().id
-
-            challenge = get_challenge_from_tracker(user_id)
-
-            if challenge and challenge.challenge_id == int(request.form['challenge_id']):
-                if delete_challenge_instance(challenge):
+            with trace('delete', profile=True, user=get_current_user().id,
+                       challenge=request.form.get('challenge_id')) as current, \
+                    LatencyTimer('delete') as timer:
+                with span('lookup'):
+                    if is_admin() and 'user_id' in request.form:
+                        user_id = request.form['user_id']
+                        team_id = None
+                    else:
+                        user_id = get_current_user().id
+                        team_id = get_current_team_id()
+
+                    challenge_id = int(request.form['challenge_id'])
+                    challenge = get_challenge_from_tracker(user_id, team_id, challenge_id)
+                    queued = None if challenge else get_queued_instance(user_id, team_id,
+                                                                        challenge_id)
+                    timer.challenge_type = challenge.chal_type if challenge else None
+
+                if queued:
+                    # Leaving the admission queue
+                    if queued.challenge_id == challenge_id:
+                        leave_queue(queued)
+                    current.set_fields({'outcome': 'left_queue'})
+                    return redirect(request.referrer), 302
+                if challenge and challenge.challenge_id == challenge_id:
+                    if delete_challenge_instance(challenge):
+                        return redirect(request.referrer), 302
+                else:
+                    current.set_fields({'outcome': 'no_instance'})
                     return redirect(request.referrer), 302
-            else:
-                return redirect(request.referrer), 302
 
         except Exception as general_exception: # pylint: disable=broad-except
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
+            log_error(general_exception)
 
         return "Error while deleting challenges", 500
 
@@ -182,39 +372,127 @@ def define_k8s_api(app): #pylint: disable=too-many-statements
     @admins_only
     def delete_all():
         """
-        Deletes all challenge instances.
+        Starts deleting all challenge instances and returns the teardown job id.
         Only for admins.
         """
         try:
-            challenge_tracker = get_challenge_tracker()
-            success = True
+            return {'job_id': start_teardown_job('all', get_tracker_ids())}, 202
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
 
-            for challenge in challenge_tracker:
-                if not delete_challenge_instance(challenge):
-                    success = False
+        return "Error while deleting challenges", 500
 
-            if success:
-                return redirect(request.referrer), 302
+    @k8s_api.route("/api/v1/k8s/instances", methods=["GET"])
+    @admins_only
+    def instances():
+        """
+        Returns one page of the active challenge instances.
+        Only for admins.
+        """
+        try:
+            filters = {name: request.args.get(name, '').strip()
+                       for name in ('challenge', 'user', 'team', 'type')}
+            page = get_instance_page(page=request.args.get('page', 1, type=int),
+                                     per_page=request.args.get('per_page', 50, type=int),
+                                     sort=request.args.get('sort', 'timestamp'),
+                                     order=request.args.get('order', 'desc'),
+                                     filters=filters)
+            for instance in page['instances']:
+                instance['pod'] = instance_states.get(instance['instance_id'])
+            return page, 200
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+
+        return "Error while listing challenge instances", 500
 
+    @k8s_api.route("/api/v1/k8s/teardown/<job_id>", methods=["GET"])
+    @admins_only
+    def teardown_status(job_id):
+        """
+        Returns the progress of a teardown job.
+        Only for admins.
+        """
+        status = get_teardown_status(job_id)
+        if status is None:
+            return "Teardown job not found", 404
+        return status, 200
+
+    @k8s_api.route("/api/v1/k8s/reconcile", methods=["GET", "POST"])
+    @admins_only
+    def reconcile_cluster():
+        """
+        Returns the drift counts of the last reconcile, or reconciles now on POST.
+        Only for admins.
+        """
+        try:
+            if request.method == "POST":
+                return reconcile(), 200
+            return get_reconcile_report() or {}, 200
         except Exception as general_exception: # pylint: disable=broad-except
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
+            log_error(general_exception)
 
-        return "Error while deleting challenges", 500
+        return "Error while reconciling challenge instances", 500
+
+    @k8s_api.route("/api/v1/k8s/metrics", methods=["GET"])
+    def metrics():
+        """
+        Returns the plugin's metrics in the Prometheus text format.
+        Only for admins, or for scrapers sending the metrics token as a bearer token.
+        """
+        token = get_config().metrics_token
+        authorization = request.headers.get('Authorization', '')
+        if not is_admin() and not (token and hmac.compare_digest(
+                authorization.encode('utf-8'), ('Bearer ' + token).encode('utf-8'))):
+            return "Forbidden", 403
+        try:
+            return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+
+        return "Error while collecting metrics", 500
+
+    @k8s_api.route("/api/v1/k8s/prepull", methods=["GET"])
+    @admins_only
+    def prepull_status():
+        """
+        Returns which challenge images are pulled on each node.
+        Only for admins.
+        """
+        try:
+            return get_prepull_status(), 200
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+
+        return "Error while reading the image pre-pull status", 500
+
+    @k8s_api.route("/api/v1/k8s/profile", methods=["GET", "POST"])
+    @admins_only
+    def profile():
+        """
+        Returns the last request profiles, or profiles the next 'requests' create
+        and delete requests on POST.
+        Only for admins.
+        """
+        try:
+            if request.method == "POST":
+                request_profiles(int(request.form.get('requests', 0)))
+            return get_profiles(), 200
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+
+        return "Error while profiling requests", 500
 
     @k8s_api.route("/api/v1/k8s/clean", methods=["GET"])
     @ratelimit(method="GET", limit=20, interval=300, key_prefix="rl")
     def clean():
         """
-        Removes all expired challenges.
+        Starts removing all expired challenges and returns the teardown job id.
         Unauthenticated
         """
         try:
-            challenges = get_expired_challenges()
-            for challenge in challenges:
-                delete_challenge_instance(challenge)
-            return "", 200
+            return {'job_id': start_teardown_job('expired', get_tracker_ids(expired=True))}, 202
         except Exception as general_exception: # pylint: disable=broad-except
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
+            log_error(general_exception)
 
         return "An error occurred while cleaning.", 500
 
@@ -226,41 +504,31 @@ def define_k8s_api(app): #pylint: disable=too-many-statements
         Extends a challenge instance's remaining time.
         """
         try:
-            challenge = get_challenge_from_tracker(get_current_user().id)
-
-            if challenge:
-                if challenge.challenge_id == int(request.form['challenge_id']):
-                    if extend_challenge_time(challenge):
-                        chal = get_challenge_by_id(int(request.form['challenge_id']))
-                        redirect_url = (request.referrer + '#' +
-                                        urllib.parse.quote_plus(chal.name) + '-' + str(chal.id))
-                        return redirect(redirect_url), 302
+            with LatencyTimer('extend') as timer:
+                challenge = get_challenge_from_tracker(get_current_user().id, get_current_team_id(),
+                                                       int(request.form['challenge_id']))
+                timer.challenge_type = challenge.chal_type if challenge else None
+
+                if challenge:
+                    if challenge.challenge_id == int(request.form['challenge_id']):
+                        if extend_challenge_time(challenge):
+                            reaper.schedule(challenge.id, challenge.revert_time)
+                            publish_instance_event(challenge.user_id, challenge.challenge_id,
+                                                   'extended', team_id=challenge.shared_team_id,
+                                                   expire_time=int(challenge.revert_time))
+                            chal = get_challenge_by_id(int(request.form['challenge_id']))
+                            return redirect(get_challenge_url(chal)), 302
 
-            return redirect(request.referrer), 302
+                return redirect(request.referrer), 302
 
         except Exception as general_exception: # pylint: disable=broad-except
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
+            log_error(general_exception)
 
         return "An error occurred while extending.", 500
 
     app.register_blueprint(k8s_api)
 
-def delete_challenge_instance(challenge):
-    """
-    Deletes a challenge instance.
-    """
-    deleted = False
-    options = {}
-    config = get_config()
-
-    options['deployment_name'] = 'chal-' + str(challenge.instance_id)
-    options['challenge_namespace'] = config.challenge_namespace
-    # Removed istio_namespace since we're using nginx-ingress
-    challenge_template = get_template(challenge.chal_type)
-    if destroy_object(get_k8s_client(), challenge_template, options):
-        if challenge.chal_type == 'k8s-random-port':
-            delete_ingress_port(get_k8s_v1_client(), config, challenge.port)
-        remove_challenge_from_tracker(challenge.id)
-        deleted = True
-
-    return deleted
+    refill_all_warm_pools()
+    sync_all_shared_instances()
+    resume_build_tracking()
+    provisioner.submit(sync_prepull)
@@ -0,0 +1,110 @@
+"""
+k8s_apply
+
+Deploys rendered objects with server-side apply.
+
+Every object is sent as a single idempotent PATCH owned by the plugin's field
+manager, so deploying never has to read an object first or fall back from
+create to patch when it already exists.
+"""
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .k8s_client import get_typed_api
+from .k8s_trace import span, log_error, run_in_context
+from .k8s_manage_custom_resources import (apply_custom_object_from_yaml, FIELD_MANAGER,
+                                          APPLY_CONTENT_TYPE)
+
+APPLY_WORKERS = 16
+# These have to exist before the objects that live in or use them are applied.
+ORDERED_KINDS = ('Namespace', 'CustomResourceDefinition')
+
+_executor_lock = threading.Lock()
+_executor_state = {'executor': None, 'pid': None}
+
+
+def is_custom_object(yaml_object):
+    """
+    Returns True for objects that are not served by a typed API of the client.
+    """
+    api_name = yaml_object['apiVersion']
+    return 'cert-manager' in api_name or 'istio' in api_name
+
+
+def apply_object(k8s_client, yaml_object):
+    """
+    Applies a single object with server-side apply.
+    """
+    if is_custom_object(yaml_object):
+        return apply_custom_object_from_yaml(k8s_client, yaml_object)
+
+    # get group and version from apiVersion
+    group, _, version = yaml_object['apiVersion'].partition('/')
+    if version == '':
+        version = group
+        group = 'core'
+    group = ''.join(group.rsplit('.k8s.io', 1))
+    group = ''.join(word.capitalize() for word in group.split('.'))
+    k8s_api = get_typed_api(f"{group}{version.capitalize()}Api", k8s_client)
+
+    kind = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', yaml_object['kind'])
+    kind = re.sub('([a-z0-9])([A-Z])', r'\1_\2', kind).lower()
+    name = yaml_object['metadata']['name']
+    namespace = yaml_object['metadata'].get('namespace')
+
+    if namespace is not None and hasattr(k8s_api, f"patch_namespaced_{kind}"):
+        return getattr(k8s_api, f"patch_namespaced_{kind}")(
+            name, namespace, yaml_object, field_manager=FIELD_MANAGER, force=True,
+            _content_type=APPLY_CONTENT_TYPE)
+    return getattr(k8s_api, f"patch_{kind}")(
+        name, yaml_object, field_manager=FIELD_MANAGER, force=True,
+        _content_type=APPLY_CONTENT_TYPE)
+
+
+def _get_executor():
+    """
+    Returns the thread pool used to apply objects, creating one per process.
+    """
+    if _executor_state['pid'] != os.getpid():
+        with _executor_lock:
+            # Threads do not survive a fork, so every worker process gets its own pool
+            if _executor_state['pid'] != os.getpid():
+                _executor_state['executor'] = ThreadPoolExecutor(
+                    max_workers=APPLY_WORKERS, thread_name_prefix='ctfd-k8s-apply')
+                _executor_state['pid'] = os.getpid()
+    return _executor_state['executor']
+
+
+def _apply_or_report(k8s_client, yaml_object):
+    """
+    Applies an object and returns whether it succeeded.
+    """
+    name = yaml_object['kind'] + '/' + yaml_object['metadata']['name']
+    try:
+        with span('apply:' + name):
+            apply_object(k8s_client, yaml_object)
+        return True
+    except Exception as general_exception: # pylint: disable=broad-except
+        log_error(general_exception, object=name)
+    return False
+
+
+def apply_objects(k8s_client, yaml_objects):
+    """
+    Applies all objects, sending those that do not depend on each other concurrently.
+    Returns True if every object was applied.
+    """
+    ordered = [obj for obj in yaml_objects if obj['kind'] in ORDERED_KINDS]
+    unordered = [obj for obj in yaml_objects if obj['kind'] not in ORDERED_KINDS]
+
+    results = [_apply_or_report(k8s_client, obj) for obj in ordered]
+    if len(unordered) == 1:
+        results.append(_apply_or_report(k8s_client, unordered[0]))
+    else:
+        # Each object is applied in the caller's trace, so its time counts as a phase
+        futures = [_get_executor().submit(run_in_context(_apply_or_report), k8s_client, obj)
+                   for obj in unordered]
+        results.extend(future.result() for future in futures)
+    return all(results)
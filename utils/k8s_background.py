@@ -0,0 +1,81 @@
+"""
+k8s_background
+
+The base of the plugin's per-process background threads and the cache locks
+that let one worker at a time run a round of their work.
+
+Threads do not survive the fork of a worker process, so each thread remembers
+the process it was started in and ensure_started() starts it again in every
+worker.  A round's lock lives in CTFd's cache with a timeout in case its worker
+dies, and is only released by the round that holds it.
+"""
+import os
+import uuid
+import threading
+
+from CTFd.cache import cache                  # pylint: disable=import-error
+
+
+class BackgroundThread:
+    """
+    A daemon thread that runs _run() once in every worker process.
+    """
+    thread_name = 'ctfd-k8s-background'
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        """
+        Starts the thread for this process.
+        """
+        self.app = app
+        self.ensure_started()
+
+    def ensure_started(self):
+        """
+        Starts the thread if it is not running in this process.
+        """
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.thread_name,
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """
+        The work of the thread, which runs until the process exits.
+        """
+        raise NotImplementedError
+
+
+def uses_redis():
+    """
+    Returns True if CTFd's cache is Redis, which is shared by every worker and
+    can increment and publish atomically.
+    """
+    return 'redis' in type(cache.cache).__name__.lower()
+
+
+def acquire_lock(key, timeout):
+    """
+    Takes a lock shared by every worker for at most timeout seconds.
+    Returns the token to release it with, or None if another round holds it.
+    """
+    token = uuid.uuid4().hex
+    return token if cache.add(key, token, timeout=timeout) else None
+
+
+def release_lock(key, token):
+    """
+    Releases a lock unless it timed out and another round has taken it since.
+    """
+    if cache.get(key) == token:
+        cache.delete(key)
@@ -2,29 +2,160 @@
 k8s_build
 
 Defines how challenge container images are built and stored in the registry.
+
+A build is a kaniko Job.  The commit a build would use is resolved first, and a
+challenge whose image already holds that commit is not built again.  Builds wait
+in a queue until fewer than build_concurrency build Jobs run, and each one is
+followed to completion on its own thread, which records the result and the
+digest of the pushed image on the challenge.  Instances are then deployed by
+that digest, so nodes that already have the image start them without asking
+the registry again.  kaniko keeps its layer cache in the registry, so a build
+only runs the Dockerfile steps whose inputs changed.
 """
 
+import os
+import re
 import base64
+import subprocess
+import time
+import threading
+import uuid
+
+import kubernetes as k8s
+
+from CTFd.cache import cache                  # pylint: disable=import-error
 
+from .k8s_background import acquire_lock, release_lock
 from .k8s_manage_objects import get_template, deploy_object
-from .k8s_database import get_config
-from .k8s_client import get_k8s_client
+from .k8s_database import (get_config, get_challenge_by_id, set_build_status,
+                           get_building_challenge_ids, get_queued_build_ids)
+from .k8s_client import get_k8s_client, get_k8s_v1_client, get_k8s_batch_client
+from .k8s_provisioner import provisioner
+from .k8s_warm_pool import drain_warm_pool, refill_warm_pool
+from .k8s_shared import deploy_shared_instance
+from .k8s_prepull import sync_prepull
+from .k8s_trace import trace, log_event, log_error
+
+REGISTRY = 'registry.psuccso.org'
+BUILD_LABEL = 'app=ctfd-k8s-build'
+# Builds still running after this long are recorded as failed.
+BUILD_TIMEOUT = 3600
+WATCH_TIMEOUT = 300
+RETRY_INTERVAL = 5
+QUEUE_INTERVAL = 5
+DEFAULT_BUILD_CONCURRENCY = 2
+GIT_TIMEOUT = 30
+DIGEST_PREFIX = 'sha256:'
+COMMIT_PATTERN = re.compile('[0-9a-f]{40}')
+# Job names are label values, which are at most 63 characters.
+MAX_JOB_NAME = 63
+BUILD_LOCK_KEY = 'ctfd_k8s_challenge_build_{}'
+DISPATCH_LOCK_KEY = 'ctfd_k8s_challenge_build_dispatch_lock'
+DISPATCH_LOCK_TIMEOUT = 60
+
+
+def get_image_name(challenge_name):
+    """
+    Returns the name a challenge's image and build Job are derived from.
+    """
+    return challenge_name.replace(" ", "-").lower().strip()
+
+
+def get_image(challenge_name):
+    """
+    Returns the tag a challenge's image is pushed to.
+    """
+    return REGISTRY + '/' + get_image_name(challenge_name) + ':latest'
+
+
+def get_build_job_name(challenge_name):
+    """
+    Returns a new Job name for a build, unique so that builds never collide.
+    """
+    suffix = '-' + uuid.uuid4().hex[:8]
+    prefix = ('builder-' + get_image_name(challenge_name))[:MAX_JOB_NAME - len(suffix)]
+    return prefix.rstrip('-.') + suffix
+
+
+def split_repository(repository):
+    """
+    Splits a kaniko git context such as github.com/org/repo.git#refs/heads/main
+    into the repository, the ref (HEAD if none is given) and a pinned commit.
+    """
+    parts = repository.split('#')
+    ref = parts[1] if len(parts) > 1 and parts[1] else 'HEAD'
+    commit = parts[2] if len(parts) > 2 and parts[2] else None
+    return parts[0], ref, commit
+
+
+def resolve_commit(repository):
+    """
+    Returns the commit the repository's ref points at, or None if it could not
+    be resolved, in which case the challenge is always built.
+    """
+    url, ref, commit = split_repository(repository)
+    if commit:
+        return commit
+    if COMMIT_PATTERN.fullmatch(ref):
+        return ref
+
+    config = get_config()
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if config.git_user and config.git_credential:
+        # Passed through the environment, as the command line is visible to every
+        # process on the host; the header is only sent to the repository's host
+        credentials = base64.b64encode((config.git_user + ':' +
+                                        config.git_credential).encode('utf-8')).decode('ascii')
+        env.update({'GIT_CONFIG_COUNT': '1',
+                    'GIT_CONFIG_KEY_0': 'http.https://' + url.split('/')[0] + '/.extraHeader',
+                    'GIT_CONFIG_VALUE_0': 'Authorization: Basic ' + credentials})
+    try:
+        listing = subprocess.run(['git', 'ls-remote', 'https://' + url, ref],
+                                 capture_output=True, text=True, timeout=GIT_TIMEOUT,
+                                 check=True, env=env).stdout
+    except (OSError, subprocess.SubprocessError):
+        log_error('could not resolve ref', url=url, ref=ref)
+        return None
+
+    for line in listing.splitlines():
+        sha, _, name = line.partition('\t')
+        if name == ref or name.endswith('/' + ref):
+            return sha
+    log_error('no such ref', url=url, ref=ref)
+    return None
 
 
+def needs_build(challenge, challenge_name, repository, commit):
+    """
+    Returns False if the challenge's image already holds the commit of the
+    repository, or a build of it is already on its way.
+    """
+    if commit is None or challenge is None:
+        return True
+    if challenge.repository != repository or challenge.image != get_image(challenge_name):
+        return True
+    if challenge.build_status in ('queued', 'building'):
+        return challenge.build_commit != commit
+    return not (challenge.image_digest and challenge.image_commit == commit)
+
 
-def build_from_repository(challenge_name, repository):
+def build_from_repository(challenge_name, repository, commit=None, job_name=None):
     """
-    Builds a challenge from a git repository and pushes it to the external registry.
+    Starts a kaniko Job that builds a challenge from a git repository, at the
+    given commit if there is one, and pushes it to the external registry.
+    Returns True if the Job was created; track_build() follows the build itself.
     """
-    challenge_name = challenge_name.replace(" ", "-").lower().strip()
+    challenge_name = get_image_name(challenge_name)
 
     config = get_config()
 
-    image = 'registry.psuccso.org/' + challenge_name + ':latest'
+    url, ref, pinned = split_repository(repository)
+    if commit and not pinned and ref != commit:
+        repository = url + '#' + ref + '#' + commit
 
     registry_auth = base64.b64encode(str('robot$rancher:'+
                                         config.registry_password).encode('ascii')).decode('ascii')
-    registry_data = base64.b64encode(str('{"auths":{"registry.psuccso.org' +
+    registry_data = base64.b64encode(str('{"auths":{"' + REGISTRY +
                                             '":{"username":"robot$rancher","password":"' +
                                             config.registry_password +
                                             '","auth":"' +
@@ -34,19 +165,214 @@ def build_from_repository(challenge_name, repository):
     git_user = base64.b64encode(str(config.git_user).encode('ascii')).decode('ascii')
     git_password_encoded = base64.b64encode(str(config.git_credential).encode('ascii')).decode('ascii')
 
-    template = get_template('build')
     options = { 'challenge_name': challenge_name,
                 'challenge_repo': repository,
+                'job_name': job_name or get_build_job_name(challenge_name),
                 'registry_namespace': config.registry_namespace,
                 'https_domain_name': config.https_domain_name,
                 'git_credential': git_password_encoded,
                 'git_user': git_user,
                 'registry_data': registry_data}
 
-    print("Building challenge...")
-    if deploy_object(get_k8s_client(), template, options):
-        print("Build succeeded")
+    # The repository is left out of the log line, as its URL may hold credentials
+    with trace('build', challenge=challenge_name, commit=commit,
+               job=options['job_name']) as current:
+        started = deploy_object(get_k8s_client(), get_template('build'), options)
+        current.set_fields({'outcome': 'started' if started else 'failed'})
+    return started
+
+
+def get_job_result(job):
+    """
+    Returns 'succeeded' or 'failed' for a finished build Job, otherwise None.
+    """
+    for condition in job.status.conditions or []:
+        if condition.status != 'True':
+            continue
+        if condition.type == 'Complete':
+            return 'succeeded'
+        if condition.type == 'Failed':
+            return 'failed'
+    return None
+
+
+def get_pushed_digest(job_name, namespace):
+    """
+    Returns the digest kaniko wrote to the termination message of a build, or None.
+    """
+    pods = get_k8s_v1_client().list_namespaced_pod(namespace,
+                                                   label_selector='job-name=' + job_name)
+    for pod in pods.items:
+        for status in pod.status.container_statuses or []:
+            terminated = status.state.terminated if status.state else None
+            message = (terminated.message or '').strip() if terminated else ''
+            if terminated and terminated.exit_code == 0 and message.startswith(DIGEST_PREFIX):
+                return message
+    return None
+
+
+def wait_for_build(job_name, namespace):
+    """
+    Watches a build Job until it finishes.
+    Returns its result, or 'failed' if the Job is gone or the build timed out.
+    """
+    batch = get_k8s_batch_client()
+    deadline = time.monotonic() + BUILD_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            # The watch starts with the Job's current state, so a finished Job is seen at once
+            watch = k8s.watch.Watch()
+            seen = False
+            for event in watch.stream(batch.list_namespaced_job, namespace,
+                                      field_selector='metadata.name=' + job_name,
+                                      timeout_seconds=WATCH_TIMEOUT):
+                seen = True
+                result = get_job_result(event['object'])
+                if event['type'] == 'DELETED' or result is not None:
+                    watch.stop()
+                    return result or 'failed'
+            if not seen and not batch.list_namespaced_job(
+                    namespace, field_selector='metadata.name=' + job_name).items:
+                log_error('build job does not exist', job=job_name)
+                return 'failed'
+        except k8s.client.rest.ApiException as general_exception:
+            log_error(general_exception)
+            time.sleep(RETRY_INTERVAL)
+    return 'failed'
+
+
+def count_running_builds(namespace):
+    """
+    Returns the number of build Jobs in the namespace that have not finished.
+    """
+    jobs = get_k8s_batch_client().list_namespaced_job(namespace, label_selector=BUILD_LABEL)
+    return sum(get_job_result(job) is None for job in jobs.items)
+
+
+def dispatch_builds():
+    """
+    Starts queued builds in the order they were queued while fewer than
+    build_concurrency build Jobs run.  Only one worker dispatches at a time.
+    Returns the number of builds started.
+    """
+    token = acquire_lock(DISPATCH_LOCK_KEY, DISPATCH_LOCK_TIMEOUT)
+    if token is None:
+        return 0
+    try:
+        config = get_config()
+        limit = (DEFAULT_BUILD_CONCURRENCY if config.build_concurrency is None
+                 else config.build_concurrency)
+        queued = get_queued_build_ids()
+        running = count_running_builds(config.registry_namespace) if queued and limit > 0 else 0
+        started = 0
+        for challenge_id in queued:
+            if 0 < limit <= running:
+                break
+            challenge = get_challenge_by_id(challenge_id)
+            job_name = get_build_job_name(challenge.name)
+            if build_from_repository(challenge.name, challenge.repository,
+                                     challenge.build_commit, job_name):
+                set_build_status(challenge_id, 'building', job_name=job_name)
+                running += 1
+                started += 1
+            else:
+                set_build_status(challenge_id, 'failed')
+        return started
+    finally:
+        release_lock(DISPATCH_LOCK_KEY, token)
+
+
+def get_build_job(challenge_id):
+    """
+    Returns the name of a challenge's running build Job, None while the build
+    is queued, or '' if the challenge has no build to follow.
+    """
+    challenge = get_challenge_by_id(challenge_id)
+    if challenge is None or challenge.build_status not in ('queued', 'building'):
+        return ''
+    if challenge.build_status == 'queued':
+        return None
+    # Builds started before Job names were recorded used a fixed name
+    return challenge.build_job or 'builder-' + get_image_name(challenge.name)
+
+
+def finish_build(challenge_id, job_name, namespace):
+    """
+    Waits for a challenge's build and records its result and image digest.
+    A new digest replaces the warm pool and rolls the shared instance and the
+    pre-pulled images onto it.
+    """
+    result = wait_for_build(job_name, namespace)
+    digest = get_pushed_digest(job_name, namespace) if result == 'succeeded' else None
+    if result == 'succeeded' and digest is None:
+        log_error('build job reported no image digest', job=job_name)
+
+    challenge = get_challenge_by_id(challenge_id)
+    changed = digest is not None and challenge is not None and challenge.image_digest != digest
+    if not set_build_status(challenge_id, result, digest, job_name=job_name):
+        log_event('build_replaced', challenge=challenge_id, job=job_name)
+        return result
+    log_event('build_finished', challenge=challenge_id, job=job_name, result=result,
+              digest=digest)
+    if changed:
+        drain_warm_pool(challenge_id)
+        provisioner.submit(refill_warm_pool, challenge_id)
+        provisioner.submit(deploy_shared_instance, challenge_id)
+        provisioner.submit(sync_prepull)
+    return result
+
+
+def track_build(challenge_id, commit=None):
+    """
+    Queues a build of a challenge's image at the commit and follows it on a
+    background thread.
+    """
+    set_build_status(challenge_id, 'queued', commit=commit)
+    _start_build_thread(challenge_id, False)
+
+
+def resume_build_tracking():
+    """
+    Follows the builds that were queued or still running when their worker stopped.
+    """
+    for challenge_id in get_building_challenge_ids():
+        _start_build_thread(challenge_id, True)
+
+
+def _start_build_thread(challenge_id, resuming):
+    """
+    Runs the build on its own thread so the caller does not wait for it: the
+    thread waits for the build to leave the queue and then runs finish_build().
+    A resumed build is only followed by the first worker to claim it.
+    """
+    lock_key = BUILD_LOCK_KEY.format(challenge_id)
+    if resuming:
+        token = acquire_lock(lock_key, BUILD_TIMEOUT)
+        if token is None:
+            return
     else:
-        print("Build failed.")
+        # A new build takes over from any thread still following an older one
+        token = uuid.uuid4().hex
+        cache.set(lock_key, token, timeout=BUILD_TIMEOUT)
+    app = provisioner.app
+
+    def run():
+        try:
+            job_name = None
+            while job_name is None:
+                # A new app context each round, so the challenge is read fresh
+                with app.app_context():
+                    dispatch_builds()
+                    job_name = get_build_job(challenge_id)
+                if job_name is None:
+                    time.sleep(QUEUE_INTERVAL)
+            if job_name:
+                with app.app_context():
+                    finish_build(challenge_id, job_name, get_config().registry_namespace)
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+        finally:
+            with app.app_context():
+                release_lock(lock_key, token)
 
-    return image
+    threading.Thread(target=run, name='ctfd-k8s-build', daemon=True).start()
@@ -1,27 +1,206 @@
 """
 k8s_client
 
-Implements functions that make it easier to get the kubeconfig.
+Implements a process-wide pool of Kubernetes API clients.
+
+Loading the kubeconfig and building an ApiClient is expensive (it re-reads the
+service account token and opens new TLS connections to the apiserver), so every
+worker process keeps one shared ApiClient and hands out typed API objects that
+reuse its urllib3 connection pool.
 """
 import os
+import time
+import threading
 import kubernetes as k8s
 
+from .k8s_trace import log_error
+
+SERVICE_TOKEN_FILENAME = '/var/run/secrets/kubernetes.io/serviceaccount/token'
+DEFAULT_CONNECTION_POOL_SIZE = '32'
+TOKEN_CHECK_INTERVAL = 10
+
+
+class ListenedRESTClient:
+    """
+    Wraps the REST client of an ApiClient to tell listeners about every request.
+    """
+
+    def __init__(self, rest_client, listeners):
+        self._rest_client = rest_client
+        self._listeners = listeners
+
+    def __getattr__(self, name):
+        return getattr(self._rest_client, name)
+
+    def request(self, method, url, *args, **kwargs):
+        """
+        Sends a request and then calls each listener with the method, URL,
+        headers and whether the request failed.
+        """
+        failed = True
+        try:
+            response = self._rest_client.request(method, url, *args, **kwargs)
+            failed = getattr(response, 'status', 200) >= 400
+            return response
+        finally:
+            for listener in self._listeners:
+                try:
+                    listener(method, url, kwargs.get('headers'), failed)
+                except Exception as general_exception: # pylint: disable=broad-except
+                    log_error(general_exception)
+
+
+class K8sClientManager: #pylint: disable=too-many-instance-attributes
+    """
+    Holds the shared ApiClient for this worker process along with typed API objects.
+    """
+
+    def __init__(self, pool_size=None):
+        self.pool_size = pool_size or int(os.getenv('K8S_CHALLENGES_CONNECTION_POOL_SIZE',
+                                                    DEFAULT_CONNECTION_POOL_SIZE))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._api_client = None
+        self._apis = {}
+        self._token_stamp = None
+        self._token_checked = 0
+        self._request_listeners = []
+
+    def _build(self):
+        """
+        Loads the kubeconfig once and builds the shared ApiClient.
+        """
+        configuration = k8s.client.Configuration()
+        if 'KUBERNETES_PORT' in os.environ:
+            k8s.config.load_incluster_config(client_configuration=configuration,
+                                             try_refresh_token=False)
+            self._token_stamp = self._stat_token()
+            self._token_checked = time.monotonic()
+            configuration.refresh_api_key_hook = self._refresh_token
+        else:
+            k8s.config.load_kube_config(client_configuration=configuration)
+        configuration.connection_pool_maxsize = self.pool_size
+
+        self._api_client = k8s.client.ApiClient(configuration)
+        self._api_client.rest_client = ListenedRESTClient(self._api_client.rest_client,
+                                                          self._request_listeners)
+        self._apis = {}
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _stat_token():
+        """
+        Returns a stamp that changes whenever the projected token file is rotated.
+        """
+        try:
+            stat = os.stat(SERVICE_TOKEN_FILENAME)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _refresh_token(self, configuration):
+        """
+        Re-reads the service account token, but only when the kubelet has rotated it.
+        """
+        now = time.monotonic()
+        if now - self._token_checked < TOKEN_CHECK_INTERVAL:
+            return
+        self._token_checked = now
+
+        stamp = self._stat_token()
+        if stamp is None or stamp == self._token_stamp:
+            return
+
+        with open(SERVICE_TOKEN_FILENAME, encoding='utf-8') as token_file:
+            token = token_file.read().strip()
+        if token:
+            configuration.api_key['BearerToken'] = 'bearer ' + token
+            self._token_stamp = stamp
+
+    def api_client(self):
+        """
+        Returns the shared ApiClient, building it on first use in this process.
+        """
+        if self._api_client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._api_client is None or self._pid != os.getpid():
+                    self._build()
+        return self._api_client
+
+    def api(self, api_class):
+        """
+        Returns a cached typed API object (e.g. CoreV1Api) bound to the shared client.
+        """
+        if isinstance(api_class, str):
+            api_class = getattr(k8s.client, api_class)
+        api_client = self.api_client()
+        api = self._apis.get(api_class)
+        if api is None:
+            api = api_class(api_client)
+            self._apis[api_class] = api
+        return api
+
+    def add_request_listener(self, listener):
+        """
+        Registers a function called after every API request with the method,
+        URL, headers and whether it failed.
+        """
+        self._request_listeners.append(listener)
+
+    def reset(self):
+        """
+        Drops the shared client so the next call rebuilds it from the kubeconfig.
+        """
+        with self._lock:
+            self._api_client = None
+            self._apis = {}
+
+
+client_manager = K8sClientManager()
+
+
 def get_k8s_client():
     """
-    Gets a normal Kubernetes client.
+    Gets the shared Kubernetes ApiClient.
     """
-    if 'KUBERNETES_PORT' in os.environ:
-        k8s.config.load_incluster_config()
-    else:
-        k8s.config.load_kube_config()
-    return k8s.client.ApiClient()
+    return client_manager.api_client()
 
 def get_k8s_v1_client():
     """
-    Gets a v1 Kubernetes client.
+    Gets the shared v1 Kubernetes client.
+    """
+    return client_manager.api(k8s.client.CoreV1Api)
+
+def get_k8s_apps_client():
+    """
+    Gets the shared apps/v1 Kubernetes client.
+    """
+    return client_manager.api(k8s.client.AppsV1Api)
+
+def get_k8s_networking_client():
+    """
+    Gets the shared networking.k8s.io/v1 Kubernetes client.
+    """
+    return client_manager.api(k8s.client.NetworkingV1Api)
+
+def get_k8s_custom_client():
+    """
+    Gets the shared custom objects Kubernetes client.
+    """
+    return client_manager.api(k8s.client.CustomObjectsApi)
+
+def get_k8s_batch_client():
+    """
+    Gets the shared batch/v1 Kubernetes client.
+    """
+    return client_manager.api(k8s.client.BatchV1Api)
+
+def get_typed_api(api_class, api_client=None):
+    """
+    Returns a typed API object, reusing the shared one unless a different ApiClient is given.
     """
-    if 'KUBERNETES_PORT' in os.environ:
-        k8s.config.load_incluster_config()
-    else:
-        k8s.config.load_kube_config()
-    return k8s.client.CoreV1Api()
+    if api_client is None or api_client is client_manager.api_client():
+        return client_manager.api(api_class)
+    if isinstance(api_class, str):
+        api_class = getattr(k8s.client, api_class)
+    return api_class(api_client)
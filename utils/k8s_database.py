@@ -1,18 +1,49 @@
+# pylint: disable=too-many-lines
 """
 k8s_database
 
 Creates wrapper functions around most database operations.
 """
 
-from math import floor
+import json
+import time
+import uuid
+import threading
+from math import ceil, floor
+from types import SimpleNamespace
 from datetime import datetime
 
-from CTFd.models import db, Challenges, Users # pylint: disable=import-error
+from CTFd.cache import cache                  # pylint: disable=import-error
+from CTFd.models import db, Challenges, Teams, Users # pylint: disable=import-error
 from CTFd.utils.dates import unix_time        # pylint: disable=import-error
-from sqlalchemy import text, inspect          # pylint: disable=import-error
+from sqlalchemy import inspect, func, or_, and_, case # pylint: disable=import-error
+from sqlalchemy.exc import IntegrityError     # pylint: disable=import-error
 
 
 from .k8s_config import read_config_file
+from .k8s_trace import log_event
+
+MAX_INSTANCES_PER_PAGE = 500
+CONFIG_VERSION_KEY = 'ctfd_k8s_challenge_config_version'
+# How long a worker trusts its config snapshot before checking the version stamp again.
+CONFIG_CHECK_INTERVAL = 1
+ACTIVE_INSTANCE_KEY = 'ctfd_k8s_challenge_active_instances_{}'
+ACTIVE_VERSION_KEY = 'ctfd_k8s_challenge_active_version_{}'
+ACTIVE_STATS_KEY = 'ctfd_k8s_challenge_active_stats_{}'
+# How long a user without an instance is remembered, as nothing else bounds it.
+NO_INSTANCE_TIMEOUT = 300
+# How often a worker adds its active instance cache hits and misses to the shared counters.
+STATS_FLUSH_INTERVAL = 10
+QUEUE_SIZE_KEY = 'ctfd_k8s_challenge_queue_size'
+# Instance id of the one Deployment a shared challenge runs for every player.
+SHARED_INSTANCE_PREFIX = 'shared-'
+# The teardown result of an instance another worker holds the deletion claim on.
+CLAIMED_ELSEWHERE = 'Already being deleted by another worker'
+
+_config_lock = threading.Lock()
+_config_cache = {'config': None, 'version': None, 'checked': 0}
+_stats_lock = threading.Lock()
+_active_stats = {'hits': 0, 'misses': 0, 'flushed': 0}
 
 def init_db():
     """
@@ -21,45 +52,95 @@ def init_db():
 
     existing_config = K8sConfig.query.filter_by(id=1).first()
     if not existing_config:
-        print("ctfd-k8s-challenge: Creating blank config.")
+        log_event('config_created')
         existing_config = K8sConfig()
     file_config = read_config_file()
     if file_config:
-        print("ctfd-k8s-challenge: Reading config from file.")
+        log_event('config_read_from_file')
         columns = [column.name for column in inspect(K8sConfig).c]
         for column in columns:
             if column in file_config and getattr(existing_config, column) != file_config[column]:
                 setattr(existing_config, column, file_config[column])
     db.session.add(existing_config)
     db.session.commit()
+    invalidate_config()
 
 
 def get_config():
     """
-    Returns the config dictionary.
+    Returns the config.
+
+    This is a read-only snapshot held in memory.  It is reloaded from the database
+    only when the version stamp in CTFd's cache changes, which invalidate_config()
+    does whenever the config is written.  Use get_config_for_update() to change it.
+    """
+    now = time.monotonic()
+    config = _config_cache['config']
+    if config is not None and now - _config_cache['checked'] < CONFIG_CHECK_INTERVAL:
+        return config
+
+    version = cache.get(CONFIG_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(CONFIG_VERSION_KEY, version, timeout=0)
+
+    with _config_lock:
+        if _config_cache['config'] is None or _config_cache['version'] != version:
+            stored_config = K8sConfig.query.filter_by(id=1).first()
+            _config_cache['config'] = SimpleNamespace(**{
+                column.key: getattr(stored_config, column.key)
+                for column in inspect(K8sConfig).column_attrs})
+            _config_cache['version'] = version
+        _config_cache['checked'] = now
+
+    return _config_cache['config']
+
+def get_config_for_update():
+    """
+    Returns the config row so it can be changed.
+    Call invalidate_config() after committing the changes.
     """
     return K8sConfig.query.filter_by(id=1).first()
 
+def get_config_version():
+    """
+    Returns the version stamp of the config snapshot returned by get_config().
+    """
+    return _config_cache['version']
+
+def invalidate_config():
+    """
+    Makes every worker reload the config on its next get_config().
+    """
+    cache.set(CONFIG_VERSION_KEY, uuid.uuid4().hex, timeout=0)
+    with _config_lock:
+        _config_cache['config'] = None
+
 def get_expired_challenges():
     """
     Returns a list of expired challenge objects.
     """
     expire_time = int(unix_time(datetime.utcnow()))
-    query_str = 'revert_time<' + str(expire_time)
-    return K8sChallengeTracker.query.filter(text(query_str)).order_by(text('revert_time')).all()
+    return K8sChallengeTracker.query.filter(K8sChallengeTracker.revert_time < expire_time).order_by(
+        K8sChallengeTracker.revert_time).all()
 
 def extend_challenge_time(challenge):
     """
     Extends the challenge time by half the time if the challenge is eligible for extension.
+    The check is part of the update, so the challenge can be a cached snapshot.
     """
-    extended = False
     config = get_config()
-    if challenge.revert_time - unix_time(datetime.utcnow()) < config.expire_interval/2 and (
-       challenge.revert_time - unix_time(datetime.utcnow()) > 0):
+    now = unix_time(datetime.utcnow())
+    extended = K8sChallengeTracker.query.filter(
+        K8sChallengeTracker.id == challenge.id,
+        K8sChallengeTracker.revert_time < now + config.expire_interval/2,
+        K8sChallengeTracker.revert_time > now).update(
+            {'revert_time': K8sChallengeTracker.revert_time + floor(config.expire_interval/2),
+             'version': _next_version()}, synchronize_session=False) > 0
+    db.session.commit()
+    if extended:
         challenge.revert_time = challenge.revert_time + floor(config.expire_interval/2)
-        db.session.add(challenge)
-        db.session.commit()
-        extended = True
+        invalidate_active_instance(challenge.user_id, challenge.shared_team_id)
     return extended
 
 def get_challenge_tracker():
@@ -68,57 +149,361 @@ def get_challenge_tracker():
     """
     return K8sChallengeTracker.query.all()
 
-def get_challenge_from_tracker(current_user_id):
+def get_challenge_from_tracker(current_user_id, team_id=None, challenge_id=None):
+    """
+    Returns a user's current challenge from the tracker, which is their own
+    instance or else an instance shared by their team.  A team shares one instance
+    per challenge, so given a challenge id the team's instance of that challenge
+    comes first, and the team's instances of other challenges are left out.
+
+    This is a read-only snapshot of the tracker row, or None.  It is kept in CTFd's
+    cache until the instance expires and is dropped whenever the row changes,
+    through a version stamp per user and team like the one of the config.
+    """
+    rows = _get_active_rows('user_' + str(current_user_id),
+                            K8sChallengeTracker.user_id == int(current_user_id))
+    challenge = rows[0] if rows else None
+    if team_id and (challenge is None or challenge_id is not None and
+                    challenge.challenge_id != int(challenge_id)):
+        shared = [row for row in get_team_instances(team_id)
+                  if challenge_id is None or row.challenge_id == int(challenge_id)]
+        if shared:
+            challenge = shared[0]
+    return challenge
+
+def get_team_instances(team_id):
+    """
+    Returns snapshots of the unexpired instances a team shares, one per challenge,
+    soonest expiring first.
+    """
+    return _get_active_rows('team_' + str(team_id),
+                            K8sChallengeTracker.shared_team_id == int(team_id))
+
+def _get_active_rows(owner, criterion):
     """
-    Returns a user's current challenge from the tracker.
+    Returns the cached snapshots of an owner's unexpired tracker rows.
     """
     expire_time = int(unix_time(datetime.utcnow()))
-    query_str = 'revert_time>' + str(expire_time)
-    return K8sChallengeTracker.query.filter_by(
-        user_id=current_user_id).filter(text(query_str)).order_by(text('revert_time')).first()
+    version_key = ACTIVE_VERSION_KEY.format(owner)
+    version, entry = cache.get_many(version_key, ACTIVE_INSTANCE_KEY.format(owner))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, timeout=0):
+            version = cache.get(version_key)
+
+    if entry is not None and entry['version'] == version and all(
+            row['revert_time'] > expire_time for row in entry['rows']):
+        _count_active_lookup(hit=True)
+        return [SimpleNamespace(**row) for row in entry['rows']]
+
+    _count_active_lookup(hit=False)
+    challenges = K8sChallengeTracker.query.filter(
+        criterion, K8sChallengeTracker.revert_time > expire_time).order_by(
+            K8sChallengeTracker.revert_time).all()
+    rows = [{column.key: getattr(challenge, column.key)
+             for column in inspect(K8sChallengeTracker).column_attrs}
+            for challenge in challenges]
+    timeout = NO_INSTANCE_TIMEOUT
+    if rows:
+        timeout = max(int(rows[0]['revert_time'] - expire_time), 1)
+    cache.set(ACTIVE_INSTANCE_KEY.format(owner), {'version': version, 'rows': rows},
+              timeout=timeout)
+    return [SimpleNamespace(**row) for row in rows]
+
+def invalidate_active_instance(user_id, team_id=None):
+    """
+    Drops the cached current challenge of a user, and of a team sharing it, in every worker.
+    """
+    if user_id is not None:
+        cache.set(ACTIVE_VERSION_KEY.format('user_' + str(user_id)), uuid.uuid4().hex, timeout=0)
+    if team_id is not None:
+        cache.set(ACTIVE_VERSION_KEY.format('team_' + str(team_id)), uuid.uuid4().hex, timeout=0)
+
+def _get_tracker_owners(*criterion):
+    """
+    Returns the user and shared team of the matching tracker rows.
+    """
+    return db.session.query(K8sChallengeTracker.user_id,
+                            K8sChallengeTracker.shared_team_id).filter(*criterion).distinct().all()
+
+def _count_active_lookup(hit):
+    """
+    Counts an active instance cache hit or miss, adding them to the shared
+    counters at most every STATS_FLUSH_INTERVAL seconds.
+    """
+    now = time.monotonic()
+    with _stats_lock:
+        _active_stats['hits' if hit else 'misses'] += 1
+        if now - _active_stats['flushed'] < STATS_FLUSH_INTERVAL:
+            return
+        counts = {'hits': _active_stats['hits'], 'misses': _active_stats['misses']}
+        _active_stats.update({'hits': 0, 'misses': 0, 'flushed': now})
+    _flush_active_stats(counts)
+
+def _flush_active_stats(counts):
+    """
+    Adds hit and miss counts to the counters shared by every worker.
+    """
+    for name, count in counts.items():
+        if count:
+            cache.cache.inc(ACTIVE_STATS_KEY.format(name), count)
+
+def get_active_instance_stats():
+    """
+    Returns the active instance cache hits, misses and hit rate of all workers.
+    """
+    with _stats_lock:
+        counts = {'hits': _active_stats['hits'], 'misses': _active_stats['misses']}
+        _active_stats.update({'hits': 0, 'misses': 0, 'flushed': time.monotonic()})
+    _flush_active_stats(counts)
+
+    hits, misses = cache.get_many(ACTIVE_STATS_KEY.format('hits'),
+                                  ACTIVE_STATS_KEY.format('misses'))
+    hits, misses = int(hits or 0), int(misses or 0)
+    return {'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else None}
+
+def get_expired_challenge_of_user(user_id, team_id=None, challenge_id=None):
+    """
+    Returns an expired challenge of a user, or the team's expired instance of the
+    challenge when they share instances, that is still in the tracker, or None.
+    """
+    owner = K8sChallengeTracker.user_id == int(user_id)
+    if team_id:
+        owner = or_(owner, and_(K8sChallengeTracker.shared_team_id == int(team_id),
+                                K8sChallengeTracker.challenge_id == int(challenge_id)))
+    return K8sChallengeTracker.query.filter(
+        owner, K8sChallengeTracker.revert_time <= int(unix_time(datetime.utcnow()))).first()
+
+def get_team_member_ids(team_id):
+    """
+    Returns the ids of a team's members.
+    """
+    return [user_id for (user_id,) in
+            db.session.query(Users.id).filter(Users.team_id == int(team_id)).all()]
+
+def get_tracked_challenge(tracker_id):
+    """
+    Returns a challenge from the tracker by its id.
+    """
+    return K8sChallengeTracker.query.filter_by(id=tracker_id).first()
+
+def get_visible_challenge_ids(challenge_types):
+    """
+    Returns the ids of the visible challenges of the given types.
+    """
+    return [challenge_id for (challenge_id,) in db.session.query(Challenges.id).filter(
+        Challenges.type.in_(challenge_types), Challenges.state == 'visible').order_by(
+            Challenges.id).all()]
+
+def get_tracked_challenge_by_instance(instance_id):
+    """
+    Returns the tracked challenge with the given instance id.
+    """
+    return K8sChallengeTracker.query.filter_by(instance_id=instance_id).first()
+
+def _contains_pattern(text):
+    """
+    Returns a LIKE pattern matching text anywhere, with its wildcards escaped.
+    """
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+def _instance_listing_query(filters=None):
+    """
+    Returns the query joining tracked instances with their user, team and challenge names.
+    Users, teams and challenges that no longer exist give a name of None.
+    """
+    query = db.session.query(K8sChallengeTracker,
+                             Users.name.label('user_name'),
+                             Teams.name.label('team_name'),
+                             Challenges.name.label('challenge_name'))
+    query = query.outerjoin(Users, K8sChallengeTracker.user_id == Users.id)
+    query = query.outerjoin(Teams, K8sChallengeTracker.team_id == Teams.id)
+    query = query.outerjoin(Challenges, K8sChallengeTracker.challenge_id == Challenges.id)
+
+    filters = filters or {}
+    if filters.get('challenge'):
+        query = query.filter(Challenges.name.ilike(
+            _contains_pattern(filters['challenge']), escape='\\'))
+    if filters.get('user'):
+        query = query.filter(Users.name.ilike(
+            _contains_pattern(filters['user']), escape='\\'))
+    if filters.get('team'):
+        query = query.filter(Teams.name.ilike(
+            _contains_pattern(filters['team']), escape='\\'))
+    if filters.get('type'):
+        query = query.filter(K8sChallengeTracker.chal_type == filters['type'])
+    return query
+
+def _instance_info(row):
+    """
+    Turns a row of the instance listing query into a dictionary for the admin page.
+    """
+    chal = row.K8sChallengeTracker
+    return {
+        'id': chal.challenge_id,
+        'tracker_id': chal.id,
+        'instance_id': chal.instance_id,
+        'type': chal.chal_type,
+        'user_id': chal.user_id,
+        'user': row.user_name,
+        'team_id': chal.team_id,
+        'team': row.team_name,
+        'challenge_name': row.challenge_name,
+        'status': chal.status,
+        'timestamp': chal.timestamp,
+        'revert_time': chal.revert_time
+    }
 
 def get_all_challenges():
     """
     Returns a list of all challenges with proper names and users for the admin page.
     """
-    challenges = []
+    return [_instance_info(row) for row in _instance_listing_query().all()]
 
-    tracker = get_challenge_tracker()
+def get_instance_page(page=1, per_page=50, sort='timestamp', order='desc', filters=None):
+    """
+    Returns one page of the tracked instances for the admin page.
+    Sorting and filtering by challenge, user, team and type happen in the database.
+    """
+    sort_columns = {
+        'instance_id': K8sChallengeTracker.instance_id,
+        'user': Users.name,
+        'team': Teams.name,
+        'challenge': Challenges.name,
+        'type': K8sChallengeTracker.chal_type,
+        'status': K8sChallengeTracker.status,
+        'timestamp': K8sChallengeTracker.timestamp,
+        'revert_time': K8sChallengeTracker.revert_time
+    }
+    sort_column = sort_columns.get(sort, K8sChallengeTracker.timestamp)
+    sort_column = sort_column.asc() if order == 'asc' else sort_column.desc()
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), MAX_INSTANCES_PER_PAGE)
 
-    for chal in tracker:
-        info = {
-            'id': chal.challenge_id,
-            'instance_id': chal.instance_id,
-            'user_id': chal.user_id,
-            'user': Users.query.filter_by(id=chal.user_id).first().name,
-            'challenge_name': Challenges.query.filter_by(id=chal.challenge_id).first().name
-        }
-        challenges.append(info)
+    query = _instance_listing_query(filters)
+    total = query.order_by(None).count()
+    rows = query.order_by(sort_column, K8sChallengeTracker.id) \
+                .limit(per_page).offset((page - 1) * per_page).all()
 
-    return challenges
+    return {
+        'instances': [_instance_info(row) for row in rows],
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': max(ceil(total / per_page), 1)
+    }
 
-def insert_challenge_into_tracker(options, expire_time):
+def insert_challenge_into_tracker(options, expire_time, status='running'):
     """
     Inserts a new challenge into the tracker.
+    Returns None if the user already has a challenge in the tracker, or the team
+    already shares an instance of this challenge.
     """
     challenge = K8sChallengeTracker()
     challenge.chal_type = options['challenge_type']
-    challenge.team_id = options['team']
+    challenge.team_id = options['team'] or None
     challenge.user_id = options['user']
+    challenge.shared_team_id = options.get('shared_team')
     challenge.challenge_id = options['challenge_id']
     challenge.timestamp = unix_time(datetime.utcnow())
     challenge.revert_time = unix_time(datetime.utcnow()) + expire_time
     challenge.instance_id = options['instance_id']
     challenge.port = options['port']
+    challenge.status = status
+    challenge.cpu_request = options.get('cpu_request', 0)
+    challenge.memory_request = options.get('memory_request', 0)
     db.session.add(challenge)
+    try:
+        db.session.flush()
+        # CTFd does not run migrations on SQLite, so tables created before the unique
+        # constraints may lack them; there the flush holds the write lock for the check
+        owner = K8sChallengeTracker.user_id == challenge.user_id
+        if challenge.shared_team_id is not None:
+            owner = or_(owner, and_(
+                K8sChallengeTracker.shared_team_id == challenge.shared_team_id,
+                K8sChallengeTracker.challenge_id == challenge.challenge_id))
+        if db.session.query(K8sChallengeTracker.id).filter(
+                owner, K8sChallengeTracker.id != challenge.id).first() is not None:
+            db.session.rollback()
+            return None
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    invalidate_active_instance(challenge.user_id, challenge.shared_team_id)
+    return challenge
+
+def _next_version():
+    """
+    Returns the SQL expression that bumps a tracker row's version.
+    """
+    return func.coalesce(K8sChallengeTracker.version, 0) + 1
+
+def set_challenge_status(instance_id, status):
+    """
+    Sets the provisioning status of a challenge instance.
+    Returns False if the instance is no longer in the tracker.
+    """
+    updated = K8sChallengeTracker.query.filter_by(instance_id=instance_id).update(
+        {'status': status, 'version': _next_version()}, synchronize_session=False)
     db.session.commit()
+    for user_id, team_id in _get_tracker_owners(K8sChallengeTracker.instance_id == instance_id):
+        invalidate_active_instance(user_id, team_id)
+    return updated > 0
 
 def remove_challenge_from_tracker(instance_id):
     """
     Removes a challenge from the tracker by the id.
     """
+    owners = _get_tracker_owners(K8sChallengeTracker.id == instance_id)
     K8sChallengeTracker.query.filter_by(id=instance_id).delete()
     db.session.commit()
+    # Only after the commit, or another worker could cache the row again
+    for user_id, team_id in owners:
+        invalidate_active_instance(user_id, team_id)
+
+def claim_challenge_for_deletion(tracker_id, now, lease):
+    """
+    Marks a challenge as being deleted for lease seconds.
+    Returns False if another worker is already deleting it and its lease has not run out.
+    """
+    claimed = K8sChallengeTracker.query.filter(
+        K8sChallengeTracker.id == tracker_id,
+        or_(K8sChallengeTracker.status != 'deleting',
+            K8sChallengeTracker.claimed_at.is_(None),
+            K8sChallengeTracker.claimed_at < now - lease)).update(
+                {'status': 'deleting', 'claimed_at': now, 'version': _next_version()},
+                synchronize_session=False)
+    db.session.commit()
+    if claimed:
+        for user_id, team_id in _get_tracker_owners(K8sChallengeTracker.id == tracker_id):
+            invalidate_active_instance(user_id, team_id)
+    return claimed > 0
+
+def release_deletion_claim(tracker_id, status):
+    """
+    Gives up the deletion claim on a challenge and puts back the status it had.
+    """
+    K8sChallengeTracker.query.filter_by(id=tracker_id, status='deleting').update(
+        {'status': status, 'claimed_at': None, 'version': _next_version()},
+        synchronize_session=False)
+    db.session.commit()
+    for user_id, team_id in _get_tracker_owners(K8sChallengeTracker.id == tracker_id):
+        invalidate_active_instance(user_id, team_id)
+
+def get_stale_deletion_ids(stale_before):
+    """
+    Returns the tracker ids of challenges whose deletion claim ran out before
+    stale_before, left behind by a worker that died while deleting them.
+    """
+    rows = db.session.query(K8sChallengeTracker.id).filter(
+        K8sChallengeTracker.status == 'deleting',
+        or_(K8sChallengeTracker.claimed_at.is_(None),
+            K8sChallengeTracker.claimed_at < stale_before)).all()
+    return [row.id for row in rows]
 
 def get_challenge_by_id(challenge_id):
     """
@@ -126,17 +511,431 @@ def get_challenge_by_id(challenge_id):
     """
     return Challenges.query.filter_by(id=challenge_id).first()
 
-def check_if_port_in_use(port):
+def get_owner_key(user_id, team_id):
+    """
+    Returns who an instance counts against when sharing capacity: the team, or
+    the user outside of teams mode.
+    """
+    return 'team_' + str(team_id) if team_id else 'user_' + str(user_id)
+
+def get_tracker_usage():
+    """
+    Returns the number of tracked instances, their CPU (millicores) and memory (MiB)
+    requests and the number of instances per challenge and per owner.
+    Players of shared challenges have no instance of their own and are not counted.
+    """
+    own_instance = ~K8sChallengeTracker.instance_id.startswith(SHARED_INSTANCE_PREFIX)
+    count, cpu, memory = db.session.query(
+        func.count(K8sChallengeTracker.id),
+        func.coalesce(func.sum(K8sChallengeTracker.cpu_request), 0),
+        func.coalesce(func.sum(K8sChallengeTracker.memory_request), 0)).filter(own_instance).one()
+    challenges = dict(db.session.query(K8sChallengeTracker.challenge_id,
+                                       func.count(K8sChallengeTracker.id)).filter(
+                                           own_instance).group_by(
+                                           K8sChallengeTracker.challenge_id).all())
+    owners = {}
+    for team_id, user_id, owner_count in db.session.query(
+            K8sChallengeTracker.team_id, K8sChallengeTracker.user_id,
+            func.count(K8sChallengeTracker.id)).filter(own_instance).group_by(
+                K8sChallengeTracker.team_id, K8sChallengeTracker.user_id).all():
+        owner = get_owner_key(user_id, team_id)
+        owners[owner] = owners.get(owner, 0) + owner_count
+    return {'instances': count, 'cpu': int(cpu), 'memory': int(memory),
+            'challenges': challenges, 'owners': owners}
+
+def get_instance_counts(now):
+    """
+    Returns the number of tracked instances per challenge and state, where the
+    state is 'expired' once an instance is past its expiry time and its status
+    before that, as (challenge id, name, type, state, count) rows.
+    """
+    state = case((K8sChallengeTracker.revert_time <= now, 'expired'),
+                 else_=K8sChallengeTracker.status)
+    return db.session.query(K8sChallengeTracker.challenge_id, Challenges.name, Challenges.type,
+                            state, func.count(K8sChallengeTracker.id)).join(
+                                Challenges, Challenges.id == K8sChallengeTracker.challenge_id
+                            ).group_by(K8sChallengeTracker.challenge_id, Challenges.name,
+                                       Challenges.type, state).all()
+
+def get_oldest_expiry(now):
+    """
+    Returns the earliest expiry time of the tracked instances that have expired, or None.
+    """
+    return db.session.query(func.min(K8sChallengeTracker.revert_time)).filter(
+        K8sChallengeTracker.revert_time <= now).scalar()
+
+def enqueue_instance(options):
+    """
+    Adds an instance to the admission queue.
+    Returns None if the user, or the team for this challenge when it is shared,
+    is already waiting.
+    """
+    queued = K8sAdmissionQueue()
+    queued.user_id = options['user']
+    queued.team_id = options['team'] or None
+    queued.shared_team_id = options.get('shared_team')
+    queued.challenge_id = options['challenge_id']
+    queued.chal_type = options['challenge_type']
+    queued.cpu_request = options.get('cpu_request', 0)
+    queued.memory_request = options.get('memory_request', 0)
+    queued.timestamp = unix_time(datetime.utcnow())
+    db.session.add(queued)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    _update_queue_size()
+    return queued
+
+def get_queued_instances():
+    """
+    Returns every instance waiting for admission, oldest first.
+    """
+    return K8sAdmissionQueue.query.order_by(K8sAdmissionQueue.id).all()
+
+def get_queued_instance(user_id, team_id=None, challenge_id=None):
+    """
+    Returns the queued instance of a user, or of the team they share instances with.
+    Given a challenge id, only the team's queued instance of that challenge counts.
+    """
+    if not get_queue_size():
+        return None
+    owner = K8sAdmissionQueue.user_id == int(user_id)
+    if team_id:
+        shared = K8sAdmissionQueue.shared_team_id == int(team_id)
+        if challenge_id is not None:
+            shared = and_(shared, K8sAdmissionQueue.challenge_id == int(challenge_id))
+        owner = or_(owner, shared)
+    return K8sAdmissionQueue.query.filter(owner).first()
+
+def remove_queued_instance(queued_id):
+    """
+    Removes an instance from the admission queue.
+    Returns False if it was no longer queued.
+    """
+    removed = K8sAdmissionQueue.query.filter_by(id=queued_id).delete()
+    db.session.commit()
+    _update_queue_size()
+    return removed > 0
+
+def get_queue_size():
+    """
+    Returns the number of queued instances, kept in CTFd's cache so that
+    lookups can skip the queue while it is empty.
+    """
+    size = cache.get(QUEUE_SIZE_KEY)
+    if size is None:
+        size = _update_queue_size()
+    return size
+
+def _update_queue_size():
+    """
+    Stores the number of queued instances in CTFd's cache and returns it.
+    """
+    size = db.session.query(func.count(K8sAdmissionQueue.id)).scalar()
+    cache.set(QUEUE_SIZE_KEY, size, timeout=0)
+    return size
+
+def get_tracked_ports(challenge_type):
+    """
+    Returns the ports used by the instances of a challenge type in the tracker.
+    """
+    rows = db.session.query(K8sChallengeTracker.port, K8sChallengeTracker.instance_id).filter_by(
+        chal_type=challenge_type).all()
+    return dict(rows)
+
+def get_port_reservations():
+    """
+    Returns all port reservations.
+    """
+    return K8sPortReservation.query.all()
+
+def get_port_reservation_count():
+    """
+    Returns the number of reserved ports.
+    """
+    return K8sPortReservation.query.count()
+
+def reserve_port(port, instance_id):
+    """
+    Reserves a port for an instance.
+    Returns False if the port is already reserved.
+    """
+    reservation = K8sPortReservation()
+    reservation.port = port
+    reservation.instance_id = instance_id
+    reservation.timestamp = unix_time(datetime.utcnow())
+    db.session.add(reservation)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+def release_port_reservation(port):
+    """
+    Removes the reservation of a port.
+    """
+    K8sPortReservation.query.filter_by(port=port).delete()
+    db.session.commit()
+
+def get_warm_instances(challenge_id):
+    """
+    Returns the warm pool instances of a challenge.
+    """
+    return K8sWarmInstance.query.filter_by(challenge_id=challenge_id).order_by(
+        K8sWarmInstance.slot).all()
+
+def get_warm_instance_ids():
+    """
+    Returns the instance ids of every warm pool instance.
+    """
+    return {instance_id for (instance_id,) in
+            db.session.query(K8sWarmInstance.instance_id).all()}
+
+def get_warm_pool_counts():
+    """
+    Returns the number of warm instances per challenge and status.
+    """
+    counts = {}
+    rows = db.session.query(K8sWarmInstance.challenge_id, K8sWarmInstance.status,
+                            func.count(K8sWarmInstance.id)).group_by(
+                                K8sWarmInstance.challenge_id, K8sWarmInstance.status).all()
+    for challenge_id, status, count in rows:
+        counts.setdefault(challenge_id, {})[status] = count
+    return counts
+
+def get_warm_pool_challenge_ids(challenge_types):
+    """
+    Returns the ids of the challenges that have a warm pool configured.
+    """
+    challenges = Challenges.query.filter(Challenges.type.in_(challenge_types)).all()
+    return [challenge.id for challenge in challenges if getattr(challenge, 'warm_pool_size', 0)]
+
+def get_shared_instance_id(challenge_id):
+    """
+    Returns the instance id of a shared challenge's Deployment.
+    """
+    return SHARED_INSTANCE_PREFIX + str(challenge_id)
+
+def is_shared_instance(instance_id):
+    """
+    Returns True if the instance id is the Deployment of a shared challenge.
+    """
+    return str(instance_id).startswith(SHARED_INSTANCE_PREFIX)
+
+def get_shared_challenge_ids(challenge_types):
+    """
+    Returns the ids of the challenges that run one shared instance.
+    """
+    challenges = Challenges.query.filter(Challenges.type.in_(challenge_types)).all()
+    return [challenge.id for challenge in challenges if getattr(challenge, 'shared_instance', 0)]
+
+def get_shared_player_counts():
+    """
+    Returns the number of players using each shared instance, keyed by instance id.
+    """
+    return dict(db.session.query(K8sChallengeTracker.instance_id,
+                                 func.count(K8sChallengeTracker.id)).filter(
+                                     K8sChallengeTracker.instance_id.startswith(
+                                         SHARED_INSTANCE_PREFIX)).group_by(
+                                     K8sChallengeTracker.instance_id).all())
+
+def set_build_status(challenge_id, status, image_digest=None, commit=None, job_name=None):
+    """
+    Records the state of a challenge's image build: the commit it builds when
+    it is queued, its Job once it started and, once it succeeded, the digest of
+    the pushed image.
+    Returns False if a newer build of the challenge replaced the given Job.
+    """
+    challenge = get_challenge_by_id(challenge_id)
+    if challenge is None:
+        return False
+    if status == 'queued':
+        challenge.build_commit = commit
+        challenge.build_job = None
+    elif status == 'building':
+        challenge.build_job = job_name
+    elif job_name is not None and challenge.build_job != job_name:
+        return False
+    challenge.build_status = status
+    challenge.build_time = unix_time(datetime.utcnow())
+    if image_digest:
+        challenge.image_digest = image_digest
+        challenge.image_commit = challenge.build_commit
+    db.session.commit()
+    return True
+
+def get_building_challenge_ids():
+    """
+    Returns the ids of the challenges whose image build is queued or has not finished.
+    """
+    return [challenge.id for challenge in Challenges.query.all()
+            if getattr(challenge, 'build_status', None) in ('queued', 'building')]
+
+def get_queued_build_ids():
+    """
+    Returns the ids of the challenges whose image build waits for a free build
+    slot, in the order they were queued.
+    """
+    queued = [challenge for challenge in Challenges.query.all()
+              if getattr(challenge, 'build_status', None) == 'queued']
+    return [challenge.id for challenge in sorted(
+        queued, key=lambda challenge: (challenge.build_time or 0, challenge.id))]
+
+def reserve_warm_slot(options, slot):
+    """
+    Reserves a slot in a challenge's warm pool for a new instance.
+    Returns False if another worker already filled the slot.
+    """
+    warm_instance = K8sWarmInstance()
+    warm_instance.challenge_id = options['challenge_id']
+    warm_instance.slot = slot
+    warm_instance.instance_id = options['instance_id']
+    warm_instance.chal_type = options['challenge_type']
+    warm_instance.port = options['port']
+    warm_instance.status = 'pending'
+    warm_instance.timestamp = unix_time(datetime.utcnow())
+    db.session.add(warm_instance)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+def set_warm_instance_status(instance_id, status):
     """
-    Checks if a specific TCP port is being used.
+    Sets the status of a warm instance.
+    Returns False if the instance is no longer in the pool.
     """
-    available = False
-    query = K8sChallengeTracker.query.filter_by(port=port).first()
+    updated = K8sWarmInstance.query.filter_by(instance_id=instance_id).update({'status': status})
+    db.session.commit()
+    return updated > 0
 
-    if not query:
-        available = True
+def take_warm_instance(challenge_id):
+    """
+    Removes a ready instance from a challenge's warm pool and returns its details.
+    The delete is conditional so two workers can never take the same instance.
+    """
+    candidates = K8sWarmInstance.query.filter_by(challenge_id=challenge_id,
+                                                 status='ready').order_by(
+                                                     K8sWarmInstance.timestamp).all()
+    for candidate in candidates:
+        warm_instance = {'instance_id': candidate.instance_id, 'port': candidate.port}
+        if K8sWarmInstance.query.filter_by(id=candidate.id, status='ready').delete() > 0:
+            db.session.commit()
+            return warm_instance
+        db.session.rollback()
+    return None
 
-    return available
+def remove_warm_instance(instance_id):
+    """
+    Removes a warm instance from the pool.
+    """
+    K8sWarmInstance.query.filter_by(instance_id=instance_id).delete()
+    db.session.commit()
+
+def record_warm_pool_result(challenge, hit):
+    """
+    Counts a warm pool hit or miss for a challenge.
+    """
+    column = 'warm_pool_hits' if hit else 'warm_pool_misses'
+    setattr(challenge, column, func.coalesce(getattr(type(challenge), column), 0) + 1)
+    db.session.commit()
+
+def get_tracker_ids(challenge_id=None, expired=False):
+    """
+    Returns the tracker ids of all instances, optionally only those of one challenge
+    or only the expired ones.
+    """
+    query = db.session.query(K8sChallengeTracker.id)
+    if challenge_id is not None:
+        query = query.filter(K8sChallengeTracker.challenge_id == challenge_id)
+    if expired:
+        query = query.filter(K8sChallengeTracker.revert_time < int(unix_time(datetime.utcnow())))
+    return [tracker_id for (tracker_id,) in query.all()]
+
+def get_tracker_instance_ids(tracker_ids, batch_size=500):
+    """
+    Returns the distinct instance ids of the given tracker ids that still exist.
+    """
+    tracker_ids = list(tracker_ids)
+    instance_ids = set()
+    for start in range(0, len(tracker_ids), batch_size):
+        instance_ids.update(instance_id for (instance_id,) in db.session.query(
+            K8sChallengeTracker.instance_id).filter(
+                K8sChallengeTracker.id.in_(tracker_ids[start:start + batch_size])).all())
+    return sorted(instance_ids)
+
+def create_teardown_job(job_id, scope, tracker_ids):
+    """
+    Records a new teardown job for the given tracker ids.
+    """
+    now = unix_time(datetime.utcnow())
+    job = K8sTeardownJob()
+    job.id = job_id
+    job.scope = scope
+    job.status = 'running'
+    job.instance_ids = json.dumps(tracker_ids)
+    job.results = json.dumps({})
+    job.total = len(tracker_ids)
+    job.succeeded = 0
+    job.failed = 0
+    job.created = now
+    job.updated = now
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def get_teardown_job(job_id):
+    """
+    Returns a teardown job by its id.
+    """
+    return K8sTeardownJob.query.filter_by(id=job_id).first()
+
+def save_teardown_progress(job_id, results, status):
+    """
+    Stores the per-instance results of a teardown job.
+    Results map the tracker id to an empty string on success or to the error.
+    Instances another worker is deleting count as deleted.
+    """
+    succeeded = len([error for error in results.values()
+                     if not error or error == CLAIMED_ELSEWHERE])
+    K8sTeardownJob.query.filter_by(id=job_id).update({
+        'results': json.dumps(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'status': status,
+        'updated': unix_time(datetime.utcnow())})
+    db.session.commit()
+
+def claim_stale_teardown_job(job_id, updated):
+    """
+    Takes over a teardown job whose worker stopped updating it.
+    Returns False if another worker took it over first.
+    """
+    claimed = K8sTeardownJob.query.filter_by(id=job_id, status='running', updated=updated).update(
+        {'updated': unix_time(datetime.utcnow())})
+    db.session.commit()
+    return claimed > 0
+
+def get_stale_teardown_jobs(stale_before):
+    """
+    Returns the running teardown jobs that have not made progress since stale_before.
+    """
+    return K8sTeardownJob.query.filter(K8sTeardownJob.status == 'running',
+                                       K8sTeardownJob.updated < stale_before).all()
+
+def remove_old_teardown_jobs(before):
+    """
+    Removes finished teardown jobs created before the given time.
+    """
+    K8sTeardownJob.query.filter(K8sTeardownJob.status == 'done',
+                                K8sTeardownJob.created < before).delete()
+    db.session.commit()
 
 class K8sConfig(db.Model): #pylint: disable=too-few-public-methods
     """
@@ -156,17 +955,102 @@ class K8sConfig(db.Model): #pylint: disable=too-few-public-methods
     external_https_port = db.Column("external_https_port", db.Integer, index=False)
     expire_interval = db.Column("expire_interval", db.Integer, index=False)
     ctfd_url = db.Column("ctfd_url", db.String(64), index=False)
+    cleanup_cronjob = db.Column("cleanup_cronjob", db.Boolean, index=False, default=False)
+    teardown_concurrency = db.Column("teardown_concurrency", db.Integer, index=False)
+    provisioning_workers = db.Column("provisioning_workers", db.Integer, index=False)
+    reconcile_interval = db.Column("reconcile_interval", db.Integer, index=False)
+    team_instances = db.Column("team_instances", db.Boolean, index=False, default=False)
+    max_instances = db.Column("max_instances", db.Integer, index=False)
+    cpu_budget = db.Column("cpu_budget", db.String(16), index=False)
+    memory_budget = db.Column("memory_budget", db.String(16), index=False)
+    prepull_images = db.Column("prepull_images", db.Boolean, index=False, default=False)
+    build_concurrency = db.Column("build_concurrency", db.Integer, index=False)
+    metrics_token = db.Column("metrics_token", db.String(128), index=False)
 
 class K8sChallengeTracker(db.Model): #pylint: disable=too-few-public-methods,too-many-instance-attributes
     """
 	K8s Container Tracker. This model stores the users/teams active containers.
 	"""
+    __table_args__ = (
+        # A user has at most one instance, and this also serves the lookup of it
+        db.UniqueConstraint('user_id', name='uq_k8s_challenge_tracker_user'),
+        # Set only for instances shared by a team, so a team shares one per challenge
+        db.UniqueConstraint('shared_team_id', 'challenge_id',
+                            name='uq_k8s_challenge_tracker_shared_team_challenge'),
+        db.Index('ix_k8s_challenge_tracker_team_revert', 'team_id', 'revert_time'),
+        db.Index('ix_k8s_challenge_tracker_type_port', 'type', 'port', 'instance_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    chal_type = db.Column("type", db.String(64), index=True)
-    team_id = db.Column("team_id", db.String(64), index=True)
-    user_id = db.Column("user_id", db.String(64), index=True)
+    chal_type = db.Column("type", db.String(64), index=False)
+    team_id = db.Column("team_id", db.Integer, index=False)
+    user_id = db.Column("user_id", db.Integer, index=False)
+    shared_team_id = db.Column("shared_team_id", db.Integer, index=False)
     challenge_id = db.Column("challenge_id", db.Integer, index=True)
     timestamp = db.Column("timestamp", db.Integer, index=True)
     revert_time = db.Column("revert_time", db.Integer, index=True)
     instance_id = db.Column("instance_id", db.String(64), index=True)
-    port = db.Column("port", db.Integer, index=True)
+    port = db.Column("port", db.Integer, index=False)
+    status = db.Column("status", db.String(16), index=False, default='running')
+    # Bumped on every change so clients can tell whether an instance changed
+    version = db.Column("version", db.Integer, index=False, default=1)
+    # Resource requests of the instance in millicores and MiB, counted by admission control
+    cpu_request = db.Column("cpu_request", db.Integer, index=False, default=0)
+    memory_request = db.Column("memory_request", db.Integer, index=False, default=0)
+    # When a worker claimed the instance for deletion; the claim lapses after a lease
+    claimed_at = db.Column("claimed_at", db.Integer, index=False)
+
+class K8sAdmissionQueue(db.Model): #pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+	K8s Admission Queue. This model stores instances waiting for cluster capacity.
+	"""
+    __table_args__ = (
+        db.UniqueConstraint('user_id', name='uq_k8s_admission_queue_user'),
+        db.UniqueConstraint('shared_team_id', 'challenge_id',
+                            name='uq_k8s_admission_queue_shared_team_challenge'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column("user_id", db.Integer, index=False)
+    team_id = db.Column("team_id", db.Integer, index=False)
+    shared_team_id = db.Column("shared_team_id", db.Integer, index=False)
+    challenge_id = db.Column("challenge_id", db.Integer, index=False)
+    chal_type = db.Column("type", db.String(64), index=False)
+    cpu_request = db.Column("cpu_request", db.Integer, index=False)
+    memory_request = db.Column("memory_request", db.Integer, index=False)
+    timestamp = db.Column("timestamp", db.Integer, index=False)
+
+class K8sWarmInstance(db.Model): #pylint: disable=too-few-public-methods
+    """
+	K8s Warm Instance. This model stores idle instances that are ready to be claimed.
+	"""
+    __table_args__ = (db.UniqueConstraint('challenge_id', 'slot'),)
+    id = db.Column(db.Integer, primary_key=True)
+    challenge_id = db.Column("challenge_id", db.Integer, index=True)
+    slot = db.Column("slot", db.Integer, index=False)
+    chal_type = db.Column("type", db.String(64), index=False)
+    instance_id = db.Column("instance_id", db.String(64), index=True)
+    port = db.Column("port", db.Integer, index=False)
+    status = db.Column("status", db.String(16), index=False)
+    timestamp = db.Column("timestamp", db.Integer, index=False)
+
+class K8sPortReservation(db.Model): #pylint: disable=too-few-public-methods
+    """
+	K8s Port Reservation. This model stores which random ports are in use.
+	"""
+    port = db.Column("port", db.Integer, primary_key=True, autoincrement=False)
+    instance_id = db.Column("instance_id", db.String(64), index=False)
+    timestamp = db.Column("timestamp", db.Integer, index=False)
+
+class K8sTeardownJob(db.Model): #pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+	K8s Teardown Job. This model stores the progress of bulk instance deletions.
+	"""
+    id = db.Column(db.String(36), primary_key=True)
+    scope = db.Column("scope", db.String(64), index=False)
+    status = db.Column("status", db.String(16), index=True)
+    instance_ids = db.Column("instance_ids", db.Text, index=False)
+    results = db.Column("results", db.Text, index=False)
+    total = db.Column("total", db.Integer, index=False)
+    succeeded = db.Column("succeeded", db.Integer, index=False)
+    failed = db.Column("failed", db.Integer, index=False)
+    created = db.Column("created", db.Integer, index=False)
+    updated = db.Column("updated", db.Integer, index=False)
@@ -32,6 +32,8 @@ import yaml
 
 from kubernetes import client
 
+from .k8s_client import get_typed_api
+from .k8s_trace import log_event, log_error
 
 def delete_from_yaml(k8s_client, yaml_file=None, yaml_objects=None, verbose=False,
                      namespace="default", **kwargs):
@@ -75,7 +77,7 @@ def delete_from_yaml(k8s_client, yaml_file=None, yaml_objects=None, verbose=Fals
         except FailToDeleteError as failure:
             for general_exception in failure.api_exceptions:
                 if general_exception.status != 404:
-                    print(failure)
+                    log_error(failure)
 
 
 
@@ -140,7 +142,7 @@ def delete_from_yaml_single_item(k8s_client,
     # python class name convention
     group = "".join(word.capitalize() for word in group.split('.'))
     func = "{0}{1}Api".format(group, version.capitalize()) # pylint: disable=consider-using-f-string
-    k8s_api = getattr(client, func)(k8s_client)
+    k8s_api = get_typed_api(func, k8s_client)
     kind = yml_document["kind"]
     kind = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', kind)
     kind = re.sub('([a-z0-9])([A-Z])', r'\1_\2', kind).lower()
@@ -162,10 +164,8 @@ def delete_from_yaml_single_item(k8s_client,
             body=client.V1DeleteOptions(propagation_policy="Background",
                                         grace_period_seconds=5), **kwargs)
     if verbose:
-        msg = "{0} deleted.".format(kind) # pylint: disable=consider-using-f-string
-        if hasattr(res, 'status'):
-            msg += " status='{0}'".format(str(res.status)) # pylint: disable=consider-using-f-string
-        print(msg)
+        log_event('deleted', kind=kind,
+                  status=str(res.status) if hasattr(res, 'status') else None)
 
 
 class FailToDeleteError(Exception):
@@ -0,0 +1,145 @@
+"""
+k8s_events
+
+Publishes challenge instance lifecycle changes to their owner.
+
+Every worker keeps the queues of its open /api/v1/k8s/events streams by user,
+and an event is only put into the queues of the user it is for.  With Redis as
+CTFd's cache, events are published on one Redis channel and a listener thread
+in every worker hands them to its streams; with any other cache, which only
+works with a single worker, they are handed over directly.  CTFd's own events
+manager is not used, as it puts every message into the queue of every open
+stream whatever channel it was published on.
+"""
+import json
+import time
+import threading
+from queue import Queue, Empty, Full
+
+from CTFd.cache import cache                  # pylint: disable=import-error
+
+from .k8s_background import BackgroundThread, uses_redis
+from .k8s_database import get_tracked_challenge_by_instance, get_team_member_ids
+from .k8s_trace import log_error
+
+EVENT_TYPE = 'k8s-instance'
+EVENTS_CHANNEL = 'ctfd-k8s-challenge-events'
+READY_EVENT_KEY = 'ctfd_k8s_challenge_ready_{}'
+# Keeps idle streams from being closed by proxies.
+PING_INTERVAL = 15
+# Events a stream can fall behind by before further ones are dropped.
+STREAM_QUEUE_SIZE = 100
+RETRY_INTERVAL = 5
+
+
+class EventStreams(BackgroundThread):
+    """
+    The open event streams of this worker, and the thread that receives
+    events from Redis for them.
+    """
+    thread_name = 'ctfd-k8s-events'
+
+    def __init__(self):
+        super().__init__()
+        self._streams = {}
+        self._streams_lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """
+        Yields a user's events as server-sent events, with a ping while there are none.
+        """
+        if uses_redis():
+            self.ensure_started()
+        queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+        with self._streams_lock:
+            self._streams.setdefault(int(user_id), set()).add(queue)
+        try:
+            while True:
+                try:
+                    event = queue.get(timeout=PING_INTERVAL)
+                except Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield 'event: ' + EVENT_TYPE + '\ndata: ' + json.dumps(event) + '\n\n'
+        finally:
+            with self._streams_lock:
+                streams = self._streams.get(int(user_id), set())
+                streams.discard(queue)
+                if not streams:
+                    self._streams.pop(int(user_id), None)
+
+    def publish(self, user_id, event):
+        """
+        Sends an event to the open streams of a user in every worker.
+        """
+        if uses_redis():
+            cache.cache._write_client.publish( # pylint: disable=protected-access
+                EVENTS_CHANNEL, json.dumps({'user_id': int(user_id), 'event': event}))
+        else:
+            self.deliver(user_id, event)
+
+    def deliver(self, user_id, event):
+        """
+        Puts an event into the queues of a user's streams in this worker.
+        """
+        with self._streams_lock:
+            queues = list(self._streams.get(int(user_id), ()))
+        for queue in queues:
+            try:
+                queue.put_nowait(event)
+            except Full:
+                pass
+
+    def _run(self):
+        """
+        Hands the events published on Redis to the streams of this worker.
+        """
+        while True:
+            pubsub = None
+            try:
+                pubsub = cache.cache._write_client.pubsub() # pylint: disable=protected-access
+                pubsub.subscribe(EVENTS_CHANNEL)
+                while True:
+                    message = pubsub.get_message(ignore_subscribe_messages=True,
+                                                 timeout=PING_INTERVAL)
+                    if message and message['type'] == 'message':
+                        published = json.loads(message['data'])
+                        self.deliver(published['user_id'], published['event'])
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+                time.sleep(RETRY_INTERVAL)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+
+event_streams = EventStreams()
+
+
+def publish_instance_event(user_id, challenge_id, event, team_id=None, **data):
+    """
+    Tells a user, or every member of the team sharing the instance, that their
+    instance of a challenge changed.
+    The event is one of queued, pending, running, failed, ready, extended, expired or deleted.
+    Needs an app context.
+    """
+    user_ids = get_team_member_ids(team_id) if team_id else [user_id]
+    data.update({'challenge_id': int(challenge_id), 'event': event})
+    for member_id in user_ids:
+        if not member_id:
+            continue
+        try:
+            event_streams.publish(member_id, data)
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+
+
+def publish_ready_event(instance_id):
+    """
+    Tells the owner of a tracked instance that its pod is ready.
+    Every worker watches the cluster, so only the first one to see it publishes.
+    """
+    challenge = get_tracked_challenge_by_instance(instance_id)
+    if challenge and cache.add(READY_EVENT_KEY.format(instance_id), 1, timeout=60):
+        publish_instance_event(challenge.user_id, challenge.challenge_id, 'ready',
+                               team_id=challenge.shared_team_id)
@@ -0,0 +1,71 @@
+"""
+k8s_instances
+
+Deploys and deletes individual challenge instances.
+"""
+from .k8s_client import get_k8s_client, get_k8s_v1_client
+from .k8s_manage_objects import get_template, deploy_instance, destroy_instance, delete_ingress_port
+from .k8s_database import (get_config, remove_challenge_from_tracker, set_challenge_status,
+                           is_shared_instance)
+from .k8s_ports import port_allocator
+from .k8s_events import publish_instance_event
+from .k8s_metrics import LatencyTimer
+from .k8s_trace import trace, span
+
+def provision_challenge_instance(options):
+    """
+    Deploys a pending challenge instance and records whether it succeeded.
+    Runs in the background provisioning pool.
+    """
+    with trace('provision', instance_id=options['instance_id'], user=options['user'] or None,
+               team=options['team'] or None, challenge=options['challenge_id']) as current:
+        with LatencyTimer('provision', options['challenge_type']):
+            challenge_template = get_template(options['challenge_type'])
+            deployed = deploy_instance(get_k8s_client(), challenge_template, options)
+
+        status = 'running' if deployed else 'failed'
+        with span('track'):
+            tracked = set_challenge_status(options['instance_id'], status)
+        if tracked:
+            with span('publish'):
+                publish_instance_event(options['user'], options['challenge_id'], status,
+                                       team_id=options.get('shared_team'))
+        else:
+            # The instance was stopped while it was being deployed
+            status = 'stopped'
+            destroy_instance(get_k8s_client(), options['challenge_namespace'],
+                             options['instance_id'])
+            if options['challenge_type'] == 'k8s-random-port':
+                delete_ingress_port(get_k8s_v1_client(), get_config(), options['port'])
+        current.set_fields({'outcome': status})
+
+    return deployed
+
+def delete_challenge_instance(challenge, destroy=True, event='deleted'):
+    """
+    Deletes a challenge instance and tells its owner with the given event.
+    Pass destroy=False when its Kubernetes objects were already deleted in bulk.
+    A player of a shared challenge only gives up their place, the instance stays.
+    """
+    deleted = False
+    with trace('delete_challenge_instance', instance_id=challenge.instance_id,
+               user=challenge.user_id, challenge=challenge.challenge_id) as current:
+        with span('lookup'):
+            config = get_config()
+            destroy = destroy and not is_shared_instance(challenge.instance_id)
+
+        if not destroy or destroy_instance(get_k8s_client(), config.challenge_namespace,
+                                           challenge.instance_id):
+            if challenge.chal_type == 'k8s-random-port':
+                with span('release_port'):
+                    delete_ingress_port(get_k8s_v1_client(), config, challenge.port)
+                    port_allocator.release(challenge.port)
+            with span('untrack'):
+                remove_challenge_from_tracker(challenge.id)
+            with span('publish'):
+                publish_instance_event(challenge.user_id, challenge.challenge_id, event,
+                                       team_id=challenge.shared_team_id)
+            deleted = True
+        current.set_fields({'outcome': event if deleted else 'failed'})
+
+    return deleted
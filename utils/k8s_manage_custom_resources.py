@@ -5,38 +5,18 @@ Pulled from GitHub to manage custom resources efficiently.
 """
 # Pulled from https://github.com/kubernetes-client/python/issues/740#issuecomment-1002368049
 import kubernetes as k8s
-def get_custom_api(api_client) ->  k8s.client.CustomObjectsApi:
-    """
-    Returns a custom objects api for k8s.
-    """
-    return k8s.client.CustomObjectsApi(api_client)
-
 
-def patch_custom_object_from_yaml(api_client, yaml_object: dict, #pylint: disable=too-many-arguments
-                                  group: str, version: str, namespace: str,
-                                  name: str, plural: str):
-    """
-    Patches a custom object using a yaml definition.
-    """
-    return get_custom_api(api_client).patch_namespaced_custom_object(group,
-                                                           version,
-                                                           namespace,
-                                                           plural,
-                                                           name,
-                                                           yaml_object)
+from .k8s_client import get_typed_api
+from .k8s_trace import log_error
 
+FIELD_MANAGER = 'ctfd-k8s-challenge'
+APPLY_CONTENT_TYPE = 'application/apply-patch+yaml'
 
-def create_custom_object_from_yaml(api_client, yaml_object: dict, #pylint: disable=too-many-arguments
-                                   group: str, version: str, namespace: str,
-                                plural: str):
+def get_custom_api(api_client) ->  k8s.client.CustomObjectsApi:
     """
-    Creates a custom object using a yaml definition.
+    Returns a custom objects api for k8s.
     """
-    return get_custom_api(api_client).create_namespaced_custom_object(group,
-                                                            version,
-                                                            namespace,
-                                                            plural,
-                                                            yaml_object)
+    return get_typed_api(k8s.client.CustomObjectsApi, api_client)
 
 
 def apply_custom_object_from_yaml(api_client, yaml_object: dict, #pylint: disable=too-many-arguments
@@ -47,6 +27,7 @@ def apply_custom_object_from_yaml(api_client, yaml_object: dict, #pylint: disabl
                                   plural: str = None):
     """
     Actually applies a custom object from yaml.
+    This is a single server-side apply request, so it creates or updates the object.
     """
     if not name:
         name = yaml_object['metadata']['name']
@@ -58,17 +39,9 @@ def apply_custom_object_from_yaml(api_client, yaml_object: dict, #pylint: disabl
         namespace = yaml_object['metadata']['namespace']
     if not plural:
         plural = yaml_object['kind'].lower() + 's'
-    try:
-        get_custom_api(api_client).get_namespaced_custom_object(group,
-                                        version, namespace, plural, name)
-        patch_custom_object_from_yaml(api_client, yaml_object, group,
-                                        version, namespace, name, plural)
-    except k8s.client.rest.ApiException as general_exception:
-        if general_exception.status == 404:
-            create_custom_object_from_yaml(api_client, yaml_object, group,
-                                                version, namespace, plural)
-        else:
-            print("ERROR: ctfd-k8s-challenges: ", general_exception)
+    return get_custom_api(api_client).patch_namespaced_custom_object(
+        group, version, namespace, plural, name, yaml_object,
+        field_manager=FIELD_MANAGER, force=True, _content_type=APPLY_CONTENT_TYPE)
 
 def delete_custom_object_from_yaml(api_client, yaml_object: dict, #pylint: disable=too-many-arguments
                                   group: str = None,
@@ -90,9 +63,8 @@ def delete_custom_object_from_yaml(api_client, yaml_object: dict, #pylint: disab
     if not plural:
         plural = yaml_object['kind'].lower() + 's'
     try:
-        get_custom_api(api_client).get_namespaced_custom_object(group, version,
-                                                        namespace, plural, name)
         get_custom_api(api_client).delete_namespaced_custom_object(group, version,
                                                         namespace, plural, name)
     except k8s.client.rest.ApiException as general_exception:
-        print("ERROR: ctfd-k8s-challenges: ", general_exception)
+        if general_exception.status != 404:
+            log_error(general_exception)
@@ -4,56 +4,216 @@ k8s_manage_objects
 The code where objects are templated from yaml and deployed to k8s.
 """
 
-import yaml
-from jinja2 import Template
+import base64
+from math import ceil
 import kubernetes as k8s
+from kubernetes.utils import parse_quantity
 
+from .k8s_client import get_typed_api
 from .k8s_delete_from_yaml import delete_from_yaml
-from .k8s_manage_custom_resources import (apply_custom_object_from_yaml,
-                                          delete_custom_object_from_yaml)
+from .k8s_apply import apply_object, apply_objects
+from .k8s_manage_custom_resources import delete_custom_object_from_yaml
+from .k8s_templates import template_registry
+from .k8s_trace import trace, span, log_event, log_error
+
+INSTANCE_LABEL = 'ctfd-k8s-challenge/instance'
+CHALLENGE_LABEL = 'ctfd-k8s-challenge/challenge'
+# Kinds an instance template creates, as (API class, deletecollection method).
+INSTANCE_COLLECTIONS = (
+    (k8s.client.AppsV1Api, 'delete_collection_namespaced_deployment'),
+    (k8s.client.CoreV1Api, 'delete_collection_namespaced_service'),
+    (k8s.client.NetworkingV1Api, 'delete_collection_namespaced_ingress'),
+    (k8s.client.CoreV1Api, 'delete_collection_namespaced_secret'),
+)
 
 def get_template(template_name):
     """
-    Returns the template yaml from the name.
+    Returns the compiled template from the name.
+    """
+    with span('get_template'):
+        return template_registry.get(template_name)
+
+
+def get_pinned_image(challenge):
+    """
+    Returns the challenge's image by the digest of its last successful build,
+    or by its tag until a build was tracked.
+    """
+    digest = getattr(challenge, 'image_digest', None)
+    if not digest:
+        return challenge.image
+    repository, _, tag = challenge.image.rpartition(':')
+    if not repository or '/' in tag:
+        repository = challenge.image
+    return repository.split('@')[0] + '@' + digest
+
+
+def get_image_pull_policy(challenge):
+    """
+    Returns the pull policy for the challenge's image.
+    A digest never points at different content, so a cached copy is always current.
+    """
+    return 'IfNotPresent' if getattr(challenge, 'image_digest', None) else 'Always'
+
+
+def get_registry_data(config):
+    """
+    Returns the dockerconfigjson that lets pods pull from the challenge registry.
+    """
+    registry_auth = base64.b64encode(str('ctfd:'+
+                            config.registry_password).encode('ascii')).decode('ascii')
+    return base64.b64encode(str('{"auths":{"chal-registry.' +
+                                config.https_domain_name +
+                                '":{"username":"ctfd","password":"' +
+                                config.registry_password +
+                                '","auth":"' +
+                                registry_auth +
+                                '"}' + '}' +
+                                '}').encode('ascii')).decode('ascii')
+
+
+def get_instance_options(challenge, config, instance_id, port=None):
+    """
+    Returns the template variables for an instance of a challenge.
     """
-    import os
-    
-    # Get the directory where this plugin is located
-    plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    template_path = os.path.join(plugin_dir, 'templates', template_name + '.yml.j2')
+    options = {}
+    options['challenge_id'] = challenge.id
+    options['challenge_type'] = challenge.type
+    options['instance_id'] = instance_id
+    options['team'] = ''
+    options['user'] = ''
+    options['shared_team'] = None
 
-    template = ''
+    if options['challenge_type'] == 'k8s-tcp':
+        port = int(config.external_tcp_port)
+    elif options['challenge_type'] == 'k8s-web':
+        port = int(config.external_https_port)
+    options['port'] = port
 
-    with open(template_path, encoding='utf-8') as t_file:
-        template = t_file.read()
+    options['deployment_name'] = 'chal-' + instance_id
+    options['challenge_namespace'] = config.challenge_namespace
+    options['container_name'] = get_pinned_image(challenge)
+    options['image_pull_policy'] = get_image_pull_policy(challenge)
+    options['challenge_port'] = challenge.port
+    options['random_port'] = int(port)
+    # Removed istio_namespace and istio_ingress_name since we're using nginx-ingress
+    options['external_tcp_port'] = int(config.external_tcp_port)
+    options['external_https_port'] = int(config.external_https_port)
+    options['tcp_cert_name'] = config.tcp_domain_name
+    options['tcp_domain_name'] = config.tcp_domain_name
+    options['https_domain_name'] = config.https_domain_name
 
-    return Template(template)
+    options['registry_data'] = get_registry_data(config)
+    return options
 
+def get_instance_resources(template, template_variables):
+    """
+    Returns the CPU (millicores) and memory (MiB) an instance requests, summed over
+    the containers of its Deployments.  A limit counts where no request is set, as
+    Kubernetes then requests the limit.
+    """
+    cpu = memory = 0
+    for yaml_file in template_registry.render_objects(template, template_variables):
+        if yaml_file['kind'] != 'Deployment':
+            continue
+        replicas = yaml_file['spec'].get('replicas', 1)
+        for container in yaml_file['spec']['template']['spec'].get('containers', []):
+            resources = container.get('resources') or {}
+            requests = dict(resources.get('limits') or {})
+            requests.update(resources.get('requests') or {})
+            cpu += replicas * parse_quantity(requests.get('cpu', 0)) * 1000
+            memory += replicas * parse_quantity(requests.get('memory', 0)) / 2**20
+    return int(ceil(cpu)), int(ceil(memory))
 
 def deploy_object(k8s_client, template, template_variables):
     """
-    Deploys the object to kubernetes.
+    Deploys the object to kubernetes with server-side apply.
     """
-    spec = template.render(template_variables)
+    with trace('deploy_object', template=template.name,
+               instance_id=template_variables.get('instance_id')) as current:
+        dep = template_registry.render_objects(template, template_variables)
+        result = apply_objects(k8s_client, dep)
+        current.set_fields({'outcome': 'deployed' if result else 'failed'})
+        return result
 
-    dep = yaml.safe_load_all(spec)
 
-    result = True
+def deploy_instance(k8s_client, template, template_variables, labels=None):
+    """
+    Deploys the objects of a challenge instance.
+
+    Every object is labelled with its instance and challenge, and the Deployment is
+    applied first so that it can own the other objects through ownerReferences.
+    destroy_instance() then only has to delete the Deployment.
+    """
+    with span('deploy_instance'):
+        dep = template_registry.render_objects(template, template_variables)
+        return deploy_instance_objects(k8s_client, dep, template_variables, labels)
 
+
+def deploy_instance_objects(k8s_client, dep, template_variables, labels=None):
+    """
+    Deploys the already rendered objects of a challenge instance the way
+    deploy_instance() does.
+    """
+    instance_labels = {INSTANCE_LABEL: str(template_variables['instance_id']),
+                       CHALLENGE_LABEL: str(template_variables['challenge_id'])}
+    instance_labels.update(labels or {})
     for yaml_file in dep:
-        api_name = yaml_file['apiVersion']
-        kind = yaml_file['kind']
-
-        if 'cert-manager' in api_name or 'istio' in api_name or kind == 'Job':
-            apply_custom_object_from_yaml(k8s_client, yaml_file)
-        else:
-            try:
-                k8s.utils.create_from_yaml(k8s_client, yaml_objects=[yaml_file])
-            except Exception as general_exception: # pylint: disable=broad-except
-                if '"reason":"AlreadyExists"' not in str(general_exception):
-                    result = False
-                    print("ERROR: ctfd-k8s-challenges: ", general_exception)
+        yaml_file['metadata'].setdefault('labels', {}).update(instance_labels)
+        if yaml_file['kind'] == 'Deployment':
+            pod_metadata = yaml_file['spec']['template'].setdefault('metadata', {})
+            pod_metadata.setdefault('labels', {}).update(instance_labels)
+
+    owners = [yaml_file for yaml_file in dep if yaml_file['kind'] == 'Deployment']
+    if len(owners) != 1:
+        return apply_objects(k8s_client, dep)
+
+    try:
+        with span('apply:Deployment/' + owners[0]['metadata']['name']):
+            owner = apply_object(k8s_client, owners[0])
+    except Exception as general_exception: # pylint: disable=broad-except
+        log_error(general_exception, object='Deployment/' + owners[0]['metadata']['name'])
+        return False
+
+    owner_reference = {'apiVersion': owners[0]['apiVersion'],
+                       'kind': 'Deployment',
+                       'name': owner.metadata.name,
+                       'uid': owner.metadata.uid}
+    dependents = [yaml_file for yaml_file in dep if yaml_file is not owners[0]]
+    for yaml_file in dependents:
+        yaml_file['metadata']['ownerReferences'] = [owner_reference]
+    return apply_objects(k8s_client, dependents)
+
 
+def destroy_instance(k8s_client, namespace, instance_id):
+    """
+    Deletes a challenge instance with one cascading delete of its Deployment.
+    Kubernetes garbage collects the objects it owns in the background.
+    """
+    try:
+        with span('destroy_instance'):
+            get_typed_api(k8s.client.AppsV1Api, k8s_client).delete_namespaced_deployment(
+                'chal-' + str(instance_id), namespace, propagation_policy='Background')
+    except k8s.client.rest.ApiException as general_exception:
+        if general_exception.status != 404:
+            log_error(general_exception, instance_id=instance_id)
+            return False
+    return True
+
+
+def destroy_instances(k8s_client, namespace, label_selector):
+    """
+    Deletes every instance object matching the label selector with one
+    deletecollection per kind.
+    """
+    result = True
+    for api_class, method in INSTANCE_COLLECTIONS:
+        try:
+            getattr(get_typed_api(api_class, k8s_client), method)(
+                namespace, label_selector=label_selector, propagation_policy='Background')
+        except k8s.client.rest.ApiException as general_exception:
+            result = False
+            log_error(general_exception)
     return result
 
 
@@ -61,25 +221,28 @@ def destroy_object(k8s_client, template, template_variables):
     """
     Destroys the given object from kubernetes.
     """
-    spec = template.render(template_variables)
+    with trace('destroy_object', template=template.name,
+               instance_id=template_variables.get('instance_id')) as current:
+        dep = template_registry.render_objects(template, template_variables)
 
-    dep = yaml.safe_load_all(spec)
+        result = True
 
-    result = True
+        for yaml_file in dep:
+            api_name = yaml_file['apiVersion']
+            kind = yaml_file['kind']
+            name = kind + '/' + yaml_file['metadata']['name']
 
-    for yaml_file in dep:
-        api_name = yaml_file['apiVersion']
-        kind = yaml_file['kind']
-
-        if 'cert-manager' in api_name or 'istio' in api_name or kind == 'Job':
-            delete_custom_object_from_yaml(k8s_client, yaml_file)
-        else:
-            try:
-                delete_from_yaml(k8s_client, yaml_objects=[yaml_file])
-            except Exception as general_exception: # pylint: disable=broad-except
-                result = False
-                print("ERROR: ctfd-k8s-challenges: ", general_exception)
-    return result
+            with span('delete:' + name):
+                if 'cert-manager' in api_name or 'istio' in api_name or kind == 'Job':
+                    delete_custom_object_from_yaml(k8s_client, yaml_file)
+                else:
+                    try:
+                        delete_from_yaml(k8s_client, yaml_objects=[yaml_file])
+                    except Exception as general_exception: # pylint: disable=broad-except
+                        result = False
+                        log_error(general_exception, object=name)
+        current.set_fields({'outcome': 'destroyed' if result else 'failed'})
+        return result
 
 def add_ingress_port(k8s_client, config, port):
     """
@@ -87,7 +250,7 @@ def add_ingress_port(k8s_client, config, port):
     This function is kept for compatibility but does nothing.
     """
     result = True
-    print("ctfd-k8s-challenges: Port management not needed with nginx-ingress")
+    log_event('ingress_port_skipped', port=port, reason='handled by nginx-ingress')
     return result
 
 def delete_ingress_port(k8s_client, config, port):
@@ -96,5 +259,5 @@ def delete_ingress_port(k8s_client, config, port):
     This function is kept for compatibility but does nothing.
     """
     result = True
-    print("ctfd-k8s-challenges: Port management not needed with nginx-ingress")
+    log_event('ingress_port_skipped', port=port, reason='handled by nginx-ingress')
     return result
@@ -0,0 +1,321 @@
+"""
+k8s_metrics
+
+Exposes the instance lifecycle in the Prometheus text format.
+
+Latencies and Kubernetes API calls are counted in each worker and added to
+counters in CTFd's cache at most every FLUSH_INTERVAL seconds, so any worker
+can answer a scrape with the totals of all of them.  Only Redis increments
+atomically; with another cache each worker keeps its own totals and serves
+them labelled with its pid, which queries must aggregate away with
+`sum without (pid)`.  Histograms are kept as cumulative bucket counters
+and their sum in milliseconds, as the cache only increments integers.
+Instance counts, port usage and the cleanup lag are read from the database
+when scraped.
+"""
+import os
+import re
+import time
+import threading
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from CTFd.cache import cache                  # pylint: disable=import-error
+from CTFd.utils.dates import unix_time        # pylint: disable=import-error
+from flask import has_app_context             # pylint: disable=import-error
+
+from .k8s_background import uses_redis
+from .k8s_client import client_manager
+from .k8s_database import (get_instance_counts, get_oldest_expiry, get_port_reservation_count,
+                           get_queue_size)
+from .k8s_ports import port_allocator
+
+METRICS_KEY = 'ctfd_k8s_challenge_metrics_{}'
+FLUSH_INTERVAL = 10
+CHALLENGE_TYPES = ('k8s-tcp', 'k8s-web', 'k8s-random-port')
+OPERATIONS = ('create', 'delete', 'extend', 'provision')
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+API_VERBS = ('get', 'list', 'watch', 'create', 'apply', 'patch', 'update', 'delete',
+             'deletecollection')
+# Resource paths the plugin calls, as their kinds.  Anything else counts as Other.
+API_KINDS = {'deployments': 'Deployment', 'services': 'Service', 'ingresses': 'Ingress',
+             'secrets': 'Secret', 'pods': 'Pod', 'jobs': 'Job', 'cronjobs': 'CronJob',
+             'daemonsets': 'DaemonSet', 'horizontalpodautoscalers': 'HorizontalPodAutoscaler',
+             'configmaps': 'ConfigMap', 'persistentvolumeclaims': 'PersistentVolumeClaim',
+             'namespaces': 'Namespace', 'certificates': 'Certificate',
+             'virtualservices': 'VirtualService', 'destinationrules': 'DestinationRule'}
+API_KIND_LABELS = tuple(sorted(set(API_KINDS.values()))) + ('Other',)
+INSTANCE_STATES = ('pending', 'running', 'failed', 'deleting', 'expired')
+APPLY_CONTENT_TYPE = 'application/apply-patch+yaml'
+
+_lock = threading.Lock()
+_pending = {'counts': {}, 'flushed': 0}
+# This worker's totals when the cache cannot share them.
+_totals = {}
+
+
+def counters_shared():
+    """
+    Returns True if the cache adds to counters atomically, which only Redis does.
+    The filesystem and simple caches read and then write a counter, so increments
+    of two workers can overwrite each other.
+    """
+    return uses_redis()
+
+
+def _count(key, amount=1):
+    """
+    Adds to a counter of this worker and flushes the counters every FLUSH_INTERVAL seconds.
+    """
+    now = time.monotonic()
+    with _lock:
+        _pending['counts'][key] = _pending['counts'].get(key, 0) + amount
+        # Threads outside of an app context cannot reach the cache, so they leave it to others
+        if now - _pending['flushed'] < FLUSH_INTERVAL or not has_app_context():
+            return
+        counts = _pending['counts']
+        _pending.update({'counts': {}, 'flushed': now})
+    _flush(counts)
+
+
+def _flush(counts):
+    """
+    Adds counts to the counters shared by every worker, or to this worker's totals.
+    """
+    if not counters_shared():
+        with _lock:
+            for key, amount in counts.items():
+                _totals[key] = _totals.get(key, 0) + amount
+        return
+    for key, amount in counts.items():
+        if amount:
+            cache.cache.inc(METRICS_KEY.format(key), amount)
+
+
+def flush_metrics():
+    """
+    Adds this worker's counts to the shared counters now.
+    """
+    with _lock:
+        counts = _pending['counts']
+        _pending.update({'counts': {}, 'flushed': time.monotonic()})
+    _flush(counts)
+
+
+def observe_latency(operation, challenge_type, seconds):
+    """
+    Records how long an instance operation took.
+    """
+    series = 'latency_' + operation + '_' + str(challenge_type)
+    for bucket in LATENCY_BUCKETS:
+        if seconds <= bucket:
+            _count(series + '_le_' + str(bucket))
+    _count(series + '_count')
+    _count(series + '_sum_ms', int(seconds * 1000))
+
+
+class LatencyTimer:
+    """
+    Records the time spent in a with block as the latency of an operation.
+    The challenge type can be set inside the block once it is known.
+    """
+
+    def __init__(self, operation, challenge_type=None):
+        self.operation = operation
+        self.challenge_type = challenge_type
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.challenge_type in CHALLENGE_TYPES:
+            observe_latency(self.operation, self.challenge_type, time.monotonic() - self.start)
+        return False
+
+
+def get_api_call(method, url, headers):
+    """
+    Returns the verb and kind of a Kubernetes API request.
+    """
+    parsed = urlsplit(url)
+    parts = [part for part in parsed.path.split('/') if part]
+    # /api/v1/... and /apis/<group>/<version>/...
+    parts = parts[2:] if parts[:1] == ['api'] else parts[3:]
+    watching = parts[:1] == ['watch'] or 'watch=true' in parsed.query.lower()
+    if parts[:1] == ['watch']:
+        parts = parts[1:]
+    if parts[:1] == ['namespaces'] and len(parts) > 2:
+        parts = parts[2:]
+    kind = API_KINDS.get(parts[0], 'Other') if parts else 'Other'
+    named = len(parts) > 1
+
+    method = method.upper()
+    if method == 'GET':
+        verb = 'watch' if watching else ('get' if named else 'list')
+    elif method == 'POST':
+        verb = 'create'
+    elif method == 'PATCH':
+        content_type = (headers or {}).get('Content-Type', '')
+        verb = 'apply' if content_type == APPLY_CONTENT_TYPE else 'patch'
+    elif method == 'PUT':
+        verb = 'update'
+    elif method == 'DELETE':
+        verb = 'delete' if named else 'deletecollection'
+    else:
+        verb = method.lower()
+    return verb, kind
+
+
+def count_api_request(method, url, headers, failed):
+    """
+    Counts a Kubernetes API request, and an error if it failed.
+    """
+    verb, kind = get_api_call(method, url, headers)
+    if verb not in API_VERBS:
+        return
+    _count('api_calls_' + verb + '_' + kind)
+    if failed:
+        _count('api_errors_' + verb + '_' + kind)
+
+
+client_manager.add_request_listener(count_api_request)
+
+
+def _format_labels(labels):
+    """
+    Formats a label set, escaping the values.
+    """
+    if not labels:
+        return ''
+    escaped = ['{}="{}"'.format(name, re.sub(r'(["\\])', r'\\\1', str(value)).replace('\n', r'\n'))
+               for name, value in labels.items()]
+    return '{' + ','.join(escaped) + '}'
+
+
+def _sample(lines, name, labels, value):
+    """
+    Appends one sample.
+    """
+    value = value if isinstance(value, int) else repr(float(value))
+    lines.append(name + _format_labels(labels) + ' ' + str(value))
+
+
+def _header(lines, name, metric_type, description):
+    """
+    Appends the HELP and TYPE lines of a metric.
+    """
+    lines.append('# HELP ' + name + ' ' + description)
+    lines.append('# TYPE ' + name + ' ' + metric_type)
+
+
+def _get_counters():
+    """
+    Returns the shared counters of every latency and API series.
+    """
+    keys = []
+    for operation in OPERATIONS:
+        for challenge_type in CHALLENGE_TYPES:
+            series = 'latency_' + operation + '_' + challenge_type
+            keys.extend(series + '_le_' + str(bucket) for bucket in LATENCY_BUCKETS)
+            keys.extend((series + '_count', series + '_sum_ms'))
+    for verb in API_VERBS:
+        for kind in API_KIND_LABELS:
+            keys.extend(('api_calls_' + verb + '_' + kind, 'api_errors_' + verb + '_' + kind))
+    if not counters_shared():
+        with _lock:
+            return {key: _totals.get(key, 0) for key in keys}
+    values = cache.get_many(*[METRICS_KEY.format(key) for key in keys])
+    return {key: int(value or 0) for key, value in zip(keys, values)}
+
+
+def _render_latencies(lines, counters, worker_labels):
+    """
+    Appends the latency histograms.
+    """
+    name = 'ctfd_k8s_instance_operation_seconds'
+    _header(lines, name, 'histogram',
+            'Time taken to create, delete, extend or provision an instance.')
+    for operation in OPERATIONS:
+        for challenge_type in CHALLENGE_TYPES:
+            series = 'latency_' + operation + '_' + challenge_type
+            count = counters[series + '_count']
+            if not count:
+                continue
+            labels = dict(worker_labels, operation=operation, challenge_type=challenge_type)
+            for bucket in LATENCY_BUCKETS:
+                _sample(lines, name + '_bucket', dict(labels, le=str(bucket)),
+                        counters[series + '_le_' + str(bucket)])
+            _sample(lines, name + '_bucket', dict(labels, le='+Inf'), count)
+            _sample(lines, name + '_sum', labels, counters[series + '_sum_ms'] / 1000)
+            _sample(lines, name + '_count', labels, count)
+
+
+def _render_api_calls(lines, counters, worker_labels):
+    """
+    Appends the Kubernetes API call and error counters.
+    """
+    for prefix, name, description in (
+            ('api_calls_', 'ctfd_k8s_api_requests_total', 'Kubernetes API requests made.'),
+            ('api_errors_', 'ctfd_k8s_api_errors_total', 'Kubernetes API requests that failed.')):
+        _header(lines, name, 'counter', description)
+        for verb in API_VERBS:
+            for kind in API_KIND_LABELS:
+                value = counters[prefix + verb + '_' + kind]
+                if value:
+                    _sample(lines, name, dict(worker_labels, verb=verb, kind=kind), value)
+
+
+def _render_instances(lines, now):
+    """
+    Appends the instance gauges read from the tracker.
+    """
+    name = 'ctfd_k8s_instances'
+    _header(lines, name, 'gauge',
+            'Tracked instances per challenge by state; expired ones are not deleted yet.')
+    for challenge_id, challenge_name, challenge_type, state, count in get_instance_counts(now):
+        if state in INSTANCE_STATES:
+            _sample(lines, name, {'challenge_id': challenge_id, 'challenge': challenge_name,
+                                  'challenge_type': challenge_type, 'state': state}, count)
+
+    _header(lines, 'ctfd_k8s_admission_queue_length', 'gauge',
+            'Instances waiting for admission.')
+    _sample(lines, 'ctfd_k8s_admission_queue_length', None, get_queue_size())
+
+    oldest = get_oldest_expiry(now)
+    _header(lines, 'ctfd_k8s_cleanup_lag_seconds', 'gauge',
+            'Seconds since the oldest expired instance that is still tracked expired.')
+    _sample(lines, 'ctfd_k8s_cleanup_lag_seconds', None, now - oldest if oldest else 0)
+
+
+def _render_ports(lines):
+    """
+    Appends the random port pool gauges.
+    """
+    used = get_port_reservation_count()
+    size = port_allocator.end - port_allocator.start + 1
+    for name, metric_type, description, value in (
+            ('ctfd_k8s_port_pool_size', 'gauge', 'Ports random port instances can use.', size),
+            ('ctfd_k8s_port_pool_used', 'gauge', 'Ports reserved by instances.', used),
+            ('ctfd_k8s_port_pool_utilization', 'gauge', 'Share of the port pool in use.',
+             used / size if size else 0)):
+        _header(lines, name, metric_type, description)
+        _sample(lines, name, None, value)
+
+
+def render_metrics():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    flush_metrics()
+    now = unix_time(datetime.utcnow())
+    counters = _get_counters()
+    # Counters that only this worker knows about are told apart by its pid
+    worker_labels = {} if counters_shared() else {'pid': os.getpid()}
+    lines = []
+    _render_latencies(lines, counters, worker_labels)
+    _render_api_calls(lines, counters, worker_labels)
+    _render_instances(lines, now)
+    _render_ports(lines)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,125 @@
+"""
+k8s_ports
+
+Allocates the external ports used by random port challenge instances.
+
+Each worker keeps the free ports in an indexed free list so allocating and
+releasing are O(1). The database holds the authoritative reservation with the
+port as its primary key, so two workers can never hand out the same port.
+"""
+import random
+import threading
+from datetime import datetime
+
+from CTFd.utils.dates import unix_time        # pylint: disable=import-error
+
+from .k8s_database import (get_tracked_ports, get_port_reservations, reserve_port,
+                           release_port_reservation)
+
+PORT_RANGE_START = 40000
+PORT_RANGE_END = 50000
+# Reservations younger than this may belong to an instance that is not in the tracker yet.
+RESERVATION_GRACE_PERIOD = 300
+
+
+class PortExhaustedError(Exception):
+    """
+    Raised when every port in the range is reserved.
+    """
+
+
+class PortAllocator:
+    """
+    An indexed free list of ports backed by database reservations.
+    """
+
+    def __init__(self, start=PORT_RANGE_START, end=PORT_RANGE_END):
+        self.start = start
+        self.end = end
+        self._lock = threading.Lock()
+        self._free = []
+        self._index = {}
+        self._reset(set())
+
+    def _reset(self, used_ports):
+        """
+        Rebuilds the free list from the set of ports in use.
+        """
+        self._free = [port for port in range(self.start, self.end + 1) if port not in used_ports]
+        random.shuffle(self._free)
+        self._index = {port: index for index, port in enumerate(self._free)}
+
+    def _take(self, port):
+        """
+        Removes a port from the free list by swapping it with the last entry.
+        """
+        index = self._index.pop(port, None)
+        if index is None:
+            return
+        last = self._free.pop()
+        if last != port:
+            self._free[index] = last
+            self._index[last] = index
+
+    def _put(self, port):
+        """
+        Adds a port back to the free list.
+        """
+        if self.start <= port <= self.end and port not in self._index:
+            self._index[port] = len(self._free)
+            self._free.append(port)
+
+    def rebuild(self):
+        """
+        Rebuilds the free list from the tracker and the reservations.
+        Reservations missing for tracked instances are created and stale ones are dropped.
+        """
+        tracked_ports = get_tracked_ports('k8s-random-port')
+        used_ports = set(tracked_ports)
+        stale_before = unix_time(datetime.utcnow()) - RESERVATION_GRACE_PERIOD
+
+        for reservation in get_port_reservations():
+            if reservation.port in tracked_ports or reservation.timestamp > stale_before:
+                used_ports.add(reservation.port)
+            else:
+                release_port_reservation(reservation.port)
+
+        reserved_ports = {reservation.port for reservation in get_port_reservations()}
+        for port, instance_id in tracked_ports.items():
+            if port not in reserved_ports:
+                reserve_port(port, instance_id)
+
+        with self._lock:
+            self._reset(used_ports)
+
+    def allocate(self, instance_id):
+        """
+        Reserves a free port for the instance and returns it.
+        """
+        rebuilt = False
+        while True:
+            with self._lock:
+                port = self._free[-1] if self._free else None
+                if port is not None:
+                    self._take(port)
+
+            if port is None:
+                if rebuilt:
+                    raise PortExhaustedError(
+                        f"All ports between {self.start} and {self.end} are in use")
+                # Other workers may have released ports since this list was built
+                self.rebuild()
+                rebuilt = True
+            elif reserve_port(port, instance_id):
+                return port
+
+    def release(self, port):
+        """
+        Releases the reservation of a port.
+        """
+        release_port_reservation(port)
+        with self._lock:
+            self._put(port)
+
+
+port_allocator = PortAllocator()
@@ -0,0 +1,155 @@
+"""
+k8s_prepull
+
+Keeps the images of the visible challenges cached on every node.
+
+The plugin manages one DaemonSet in the challenge namespace.  Its pods have a
+container per visible challenge that runs the challenge's image only to sleep,
+so the kubelet pulls every image onto every node the DaemonSet runs on.  The
+containers start side by side, so an image that cannot be pulled holds back none
+of the others.  The DaemonSet is rendered again whenever a challenge is added,
+changed, hidden or rebuilt, and a changed image list rolls out to the nodes.
+"""
+import kubernetes as k8s
+
+from .k8s_client import get_k8s_client, get_k8s_v1_client, get_k8s_apps_client
+from .k8s_manage_objects import (get_template, deploy_object, get_pinned_image,
+                                 get_image_pull_policy, get_registry_data)
+from .k8s_database import get_config, get_challenge_by_id, get_visible_challenge_ids
+from .k8s_trace import log_error
+
+PREPULL_NAME = 'ctfd-k8s-prepull'
+PREPULL_LABEL = 'app=' + PREPULL_NAME
+PREPULL_CHALLENGE_TYPES = ('k8s-tcp', 'k8s-web', 'k8s-random-port')
+# Waiting reasons of a container whose image is not pulled yet but has not failed either.
+NOT_STARTED_REASONS = ('PodInitializing', 'ContainerCreating')
+
+
+def get_prepull_images():
+    """
+    Returns the challenge id, image and pull policy of every visible challenge.
+    """
+    images = []
+    for challenge_id in get_visible_challenge_ids(PREPULL_CHALLENGE_TYPES):
+        challenge = get_challenge_by_id(challenge_id)
+        if challenge is None or not challenge.image:
+            continue
+        images.append({'challenge_id': challenge.id,
+                       'challenge_name': challenge.name,
+                       'image': get_pinned_image(challenge),
+                       'pull_policy': get_image_pull_policy(challenge)})
+    return images
+
+
+def get_prepull_daemon_sets(namespace):
+    """
+    Returns the pre-pull DaemonSets, including the per-challenge ones of older versions.
+    """
+    daemon_sets = get_k8s_apps_client().list_namespaced_daemon_set(namespace)
+    return [daemon_set for daemon_set in daemon_sets.items
+            if daemon_set.metadata.name == PREPULL_NAME or
+            daemon_set.metadata.name.startswith(PREPULL_NAME + '-')]
+
+
+def _delete_ignoring_missing(delete, name, namespace):
+    """
+    Deletes an object and returns False if that failed for any reason but it being gone.
+    """
+    try:
+        delete(name, namespace)
+    except k8s.client.rest.ApiException as general_exception:
+        if general_exception.status != 404:
+            log_error(general_exception)
+            return False
+    return True
+
+
+def delete_prepull_daemon_sets(namespace, keep=()):
+    """
+    Deletes the pre-pull DaemonSets whose names are not in keep.
+    """
+    result = True
+    for daemon_set in get_prepull_daemon_sets(namespace):
+        if daemon_set.metadata.name not in keep:
+            result = _delete_ignoring_missing(get_k8s_apps_client().delete_namespaced_daemon_set,
+                                              daemon_set.metadata.name, namespace) and result
+    return result
+
+
+def delete_prepull(namespace):
+    """
+    Deletes every pre-pull DaemonSet and the pull secret if they exist.
+    """
+    result = delete_prepull_daemon_sets(namespace)
+    return _delete_ignoring_missing(get_k8s_v1_client().delete_namespaced_secret,
+                                    PREPULL_NAME + '-pull', namespace) and result
+
+
+def sync_prepull():
+    """
+    Applies the pre-pull DaemonSet for the current images and deletes the ones
+    older versions deployed per challenge, or deletes it when pre-pulling is
+    turned off.
+    Runs in the background provisioning pool.
+    """
+    config = get_config()
+    if not config.prepull_images:
+        return delete_prepull(config.challenge_namespace)
+
+    options = {'prepull_name': PREPULL_NAME,
+               'challenge_namespace': config.challenge_namespace,
+               'registry_data': get_registry_data(config),
+               'images': get_prepull_images()}
+    deployed = deploy_object(get_k8s_client(), get_template('prepull'), options)
+    return delete_prepull_daemon_sets(config.challenge_namespace, (PREPULL_NAME,)) and deployed
+
+
+def get_container_state(status):
+    """
+    Returns 'pulled' once a container's image is on the node, otherwise
+    why it is still waiting, e.g. ErrImagePull or ImagePullBackOff.
+    """
+    state = status.state
+    if state.terminated is not None or state.running is not None or status.image_id:
+        return 'pulled'
+    if state.waiting is not None and state.waiting.reason not in NOT_STARTED_REASONS:
+        return state.waiting.reason
+    return 'waiting'
+
+
+def get_prepull_status():
+    """
+    Returns the DaemonSet's scheduled node count, how many nodes have every image
+    and, per node, which challenge images are pulled and why the others are not.
+    """
+    config = get_config()
+    try:
+        daemon_set = get_k8s_apps_client().read_namespaced_daemon_set(PREPULL_NAME,
+                                                                     config.challenge_namespace)
+    except k8s.client.rest.ApiException as general_exception:
+        if general_exception.status == 404:
+            return {'enabled': bool(config.prepull_images), 'deployed': False, 'nodes': []}
+        raise
+
+    names = {'chal-' + str(image['challenge_id']): image['challenge_name']
+             for image in get_prepull_images()}
+    pods = get_k8s_v1_client().list_namespaced_pod(config.challenge_namespace,
+                                                   label_selector=PREPULL_LABEL)
+    nodes = []
+    for pod in pods.items:
+        images = {name: 'waiting' for name in names.values()}
+        for status in pod.status.container_statuses or []:
+            if status.name in names:
+                images[names[status.name]] = get_container_state(status)
+        pending = {name: state for name, state in images.items() if state != 'pulled'}
+        nodes.append({'node': pod.spec.node_name,
+                      'ready': not pending,
+                      'pulled': len(names) - len(pending),
+                      'total': len(names),
+                      'pending': pending})
+    nodes.sort(key=lambda node: node['node'] or '')
+    return {'enabled': bool(config.prepull_images),
+            'deployed': True,
+            'desired': daemon_set.status.desired_number_scheduled,
+            'ready': sum(node['ready'] for node in nodes),
+            'nodes': nodes}
@@ -0,0 +1,60 @@
+"""
+k8s_provisioner
+
+Runs Kubernetes work in a bounded background thread pool so it does not block
+the worker serving the request.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .k8s_trace import log_error
+
+DEFAULT_PROVISIONING_WORKERS = 8
+
+
+class Provisioner:
+    """
+    A per process thread pool that runs jobs inside the Flask app context.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.executor = None
+        self.max_workers = DEFAULT_PROVISIONING_WORKERS
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, max_workers=None):
+        """
+        Sets up the thread pool for this process.
+        """
+        self.app = app
+        self.max_workers = max_workers or DEFAULT_PROVISIONING_WORKERS
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues the function to run in the background and returns its future.
+        """
+        if self.executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self.executor is None or self._pid != os.getpid():
+                    # Threads do not survive a fork, so every worker process gets its own pool
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                       thread_name_prefix='ctfd-k8s')
+                    self._pid = os.getpid()
+        return self.executor.submit(self._run, function, *args, **kwargs)
+
+    def _run(self, function, *args, **kwargs):
+        """
+        Runs the function with an app context so it can use the database.
+        """
+        with self.app.app_context():
+            try:
+                return function(*args, **kwargs)
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+        return None
+
+
+provisioner = Provisioner()
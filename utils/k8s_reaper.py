@@ -0,0 +1,115 @@
+"""
+k8s_reaper
+
+Deletes expired challenge instances from inside CTFd.
+
+Every worker keeps a min-heap of the revert times it knows about and sleeps until
+the earliest one, so instances are removed when they expire instead of on the
+next run of the cleanup CronJob. The heap is reloaded from the tracker
+periodically to pick up instances created or extended by other workers.
+Every worker wakes for the same expiries, so a lock in CTFd's cache lets one
+of them delete each round.
+"""
+import time
+import heapq
+import threading
+
+from .k8s_background import BackgroundThread, acquire_lock, release_lock
+from .k8s_database import get_challenge_tracker, get_tracker_ids
+from .k8s_teardown import run_teardown
+from .k8s_trace import log_error
+
+RELOAD_INTERVAL = 60
+LOCK_KEY = 'ctfd_k8s_challenge_reaper_lock'
+# Longer than a round normally takes; the deletion claims keep overlapping rounds apart.
+LOCK_TIMEOUT = 300
+
+
+class ExpiryReaper(BackgroundThread):
+    """
+    A background thread driven by a min-heap of (revert_time, tracker id).
+    """
+    thread_name = 'ctfd-k8s-reaper'
+
+    def __init__(self):
+        super().__init__()
+        self._heap = []
+        self._condition = threading.Condition()
+        self._next_reload = 0
+
+    def init_app(self, app):
+        """
+        Loads the tracker and starts the reaper thread for this process.
+        """
+        self.app = app
+        self.reload()
+        self.ensure_started()
+
+    def schedule(self, tracker_id, revert_time):
+        """
+        Adds an instance's expiry to the heap, waking the reaper if it is now the earliest.
+        """
+        with self._condition:
+            heapq.heappush(self._heap, (int(revert_time), tracker_id))
+            if self._heap[0][1] == tracker_id:
+                self._condition.notify()
+
+    def reload(self):
+        """
+        Rebuilds the heap from the tracker.  Needs an app context.
+        """
+        heap = [(int(challenge.revert_time), challenge.id) for challenge in get_challenge_tracker()]
+        heapq.heapify(heap)
+        with self._condition:
+            self._heap = heap
+            self._next_reload = time.monotonic() + RELOAD_INTERVAL
+            self._condition.notify()
+
+    def _run(self):
+        """
+        Sleeps until the next expiry or reload and then deletes the expired instances.
+        """
+        while True:
+            with self._condition:
+                now = time.time()
+                timeout = self._next_reload - time.monotonic()
+                if self._heap:
+                    # Expired means revert_time < now, so wake just after the second passes
+                    timeout = min(timeout, self._heap[0][0] + 1 - now)
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+
+                reload_due = time.monotonic() >= self._next_reload
+                while self._heap and self._heap[0][0] + 1 <= now:
+                    heapq.heappop(self._heap)
+
+            try:
+                with self.app.app_context():
+                    if reload_due:
+                        self.reload()
+                    reap_expired()
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+                with self._condition:
+                    self._next_reload = time.monotonic() + RELOAD_INTERVAL
+
+
+def reap_expired():
+    """
+    Deletes every expired instance in one teardown batch and waits for it.
+    Returns the number of instances in the batch, 0 if another worker is reaping.
+    """
+    token = acquire_lock(LOCK_KEY, LOCK_TIMEOUT)
+    if token is None:
+        return 0
+    try:
+        tracker_ids = get_tracker_ids(expired=True)
+        if tracker_ids:
+            run_teardown('expired', tracker_ids)
+        return len(tracker_ids)
+    finally:
+        release_lock(LOCK_KEY, token)
+
+
+reaper = ExpiryReaper()
@@ -0,0 +1,191 @@
+"""
+k8s_reconciler
+
+Finds and repairs drift between the tracker and the cluster.
+
+Kubernetes objects can outlive their tracker row when a deploy partly fails, a
+worker dies while creating an instance or a delete error is only printed. The
+reconciler lists every object carrying the instance label with one paginated
+LIST per kind, deletes the objects of instances that are neither tracked nor in
+a warm pool, and marks tracked instances whose Deployment is gone as failed.
+Pending instances are given PENDING_TIMEOUT to create their Deployment first.
+Shared instances belong to their challenge, so a missing one is deployed again.
+"""
+import os
+import time
+from datetime import datetime
+
+import kubernetes as k8s
+
+from CTFd.cache import cache                  # pylint: disable=import-error
+from CTFd.utils.dates import unix_time        # pylint: disable=import-error
+
+from .k8s_background import BackgroundThread
+from .k8s_client import get_k8s_client, get_typed_api
+from .k8s_database import (get_config, get_challenge_tracker, get_warm_instance_ids,
+                           set_challenge_status, get_shared_instance_id, is_shared_instance,
+                           get_shared_challenge_ids)
+from .k8s_manage_objects import INSTANCE_LABEL, destroy_instances
+from .k8s_provisioner import provisioner
+from .k8s_shared import SHARED_CHALLENGE_TYPES, deploy_shared_instance
+from .k8s_teardown import reclaim_stale_deletions
+from .k8s_trace import log_error
+
+DEFAULT_RECONCILE_INTERVAL = 300
+# Objects and rows younger than this may belong to a deploy that is still running.
+GRACE_PERIOD = 120
+# Pending rows older than this without a Deployment were left by a worker that died.
+PENDING_TIMEOUT = 600
+LIST_PAGE_SIZE = 500
+LOCK_KEY = 'ctfd_k8s_challenge_reconcile_lock'
+REPORT_KEY = 'ctfd_k8s_challenge_reconcile_report'
+# Kinds an instance template creates, as (kind, API class, list method).
+INSTANCE_LISTS = (
+    ('Deployment', k8s.client.AppsV1Api, 'list_namespaced_deployment'),
+    ('Service', k8s.client.CoreV1Api, 'list_namespaced_service'),
+    ('Ingress', k8s.client.NetworkingV1Api, 'list_namespaced_ingress'),
+    ('Secret', k8s.client.CoreV1Api, 'list_namespaced_secret'),
+)
+
+
+def list_instance_objects(namespace):
+    """
+    Returns the kinds, object count and newest creation time of every labelled
+    instance in the namespace, keyed by instance id.
+    """
+    instances = {}
+    for kind, api_class, method in INSTANCE_LISTS:
+        list_function = getattr(get_typed_api(api_class), method)
+        continue_token = None
+        while True:
+            kwargs = {'label_selector': INSTANCE_LABEL, 'limit': LIST_PAGE_SIZE}
+            if continue_token:
+                kwargs['_continue'] = continue_token
+            listing = list_function(namespace, **kwargs)
+
+            for obj in listing.items:
+                instance = instances.setdefault(obj.metadata.labels[INSTANCE_LABEL],
+                                                {'kinds': set(), 'objects': 0, 'newest': 0})
+                instance['kinds'].add(kind)
+                instance['objects'] += 1
+                if obj.metadata.creation_timestamp:
+                    instance['newest'] = max(instance['newest'],
+                                             obj.metadata.creation_timestamp.timestamp())
+
+            continue_token = listing.metadata._continue # pylint: disable=protected-access
+            if not continue_token:
+                break
+    return instances
+
+
+def deployment_exists(namespace, instance_id):
+    """
+    Checks for an instance's Deployment by name, which also finds instances
+    deployed before objects were labelled.
+    """
+    try:
+        get_typed_api(k8s.client.AppsV1Api).read_namespaced_deployment(
+            'chal-' + str(instance_id), namespace)
+    except k8s.client.rest.ApiException as general_exception:
+        if general_exception.status == 404:
+            return False
+        raise
+    return True
+
+
+def reconcile():
+    """
+    Deletes orphaned instance objects, marks tracked instances whose objects are
+    missing as failed, including pending ones past PENDING_TIMEOUT, and returns
+    the drift counts.
+    """
+    namespace = get_config().challenge_namespace
+    now = unix_time(datetime.utcnow())
+
+    instances = list_instance_objects(namespace)
+    tracked = get_challenge_tracker()
+    known_ids = {str(challenge.instance_id) for challenge in tracked}
+    known_ids.update(str(instance_id) for instance_id in get_warm_instance_ids())
+    shared_ids = {get_shared_instance_id(challenge_id): challenge_id
+                  for challenge_id in get_shared_challenge_ids(SHARED_CHALLENGE_TYPES)}
+    known_ids.update(shared_ids)
+
+    report = {'time': now,
+              'instances': len(instances),
+              'objects': sum(instance['objects'] for instance in instances.values()),
+              'tracked': len(tracked),
+              'orphaned_instances': 0,
+              'orphaned_objects': 0,
+              'deleted_objects': 0,
+              'missing_instances': 0,
+              'redeployed_shared': 0,
+              'reclaimed_deletions': reclaim_stale_deletions()}
+
+    for instance_id, challenge_id in shared_ids.items():
+        if 'Deployment' not in instances.get(instance_id, {}).get('kinds', ()):
+            provisioner.submit(deploy_shared_instance, challenge_id)
+            report['redeployed_shared'] += 1
+
+    for instance_id, instance in instances.items():
+        if instance_id in known_ids or time.time() - instance['newest'] < GRACE_PERIOD:
+            continue
+        report['orphaned_instances'] += 1
+        report['orphaned_objects'] += instance['objects']
+        if destroy_instances(get_k8s_client(), namespace, INSTANCE_LABEL + '=' + instance_id):
+            report['deleted_objects'] += instance['objects']
+
+    for challenge in tracked:
+        timeout = {'running': GRACE_PERIOD, 'pending': PENDING_TIMEOUT}.get(challenge.status)
+        if (timeout is None or now - challenge.timestamp < timeout or
+                is_shared_instance(challenge.instance_id)):
+            continue
+        if 'Deployment' in instances.get(str(challenge.instance_id), {}).get('kinds', ()):
+            continue
+        if not deployment_exists(namespace, challenge.instance_id):
+            if set_challenge_status(challenge.instance_id, 'failed'):
+                report['missing_instances'] += 1
+
+    cache.set(REPORT_KEY, report, timeout=0)
+    return report
+
+
+def get_reconcile_report():
+    """
+    Returns the drift counts of the last reconcile in any worker, or None.
+    """
+    return cache.get(REPORT_KEY)
+
+
+class Reconciler(BackgroundThread):
+    """
+    A background thread that reconciles every reconcile_interval seconds.
+    Only one worker runs each round.
+    """
+    thread_name = 'ctfd-k8s-reconciler'
+
+    def _run(self):
+        """
+        Sleeps for the configured interval and then reconciles if no other worker has.
+        """
+        while True:
+            interval = DEFAULT_RECONCILE_INTERVAL
+            try:
+                with self.app.app_context():
+                    configured = get_config().reconcile_interval
+                interval = DEFAULT_RECONCILE_INTERVAL if configured is None else configured
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+
+            time.sleep(interval if interval > 0 else DEFAULT_RECONCILE_INTERVAL)
+            if interval <= 0:
+                continue
+
+            try:
+                with self.app.app_context():
+                    if cache.add(LOCK_KEY, os.getpid(), timeout=max(interval - 1, 1)):
+                        reconcile()
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+
+
+reconciler = Reconciler()
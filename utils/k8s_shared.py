@@ -0,0 +1,149 @@
+"""
+k8s_shared
+
+Runs one Deployment per challenge that every player shares.
+
+Stateless challenges do not need an instance per player.  A shared challenge is
+deployed once from its usual template, without a fixed replica count, together
+with a HorizontalPodAutoscaler that scales it between the challenge's replica
+bounds.  Starting the challenge only records the player in the tracker against
+the shared instance, and stopping or expiring it only removes that record.
+"""
+from datetime import datetime, timezone
+
+from .k8s_client import get_k8s_client, get_k8s_apps_client
+from .k8s_manage_objects import (get_template, get_instance_options, deploy_instance_objects,
+                                 destroy_instance)
+from .k8s_database import (get_config, get_challenge_by_id, get_shared_instance_id,
+                           get_shared_challenge_ids, get_shared_player_counts)
+from .k8s_provisioner import provisioner
+from .k8s_templates import template_registry
+from .k8s_watch import instance_states
+from .k8s_warm_pool import POOL_LABEL
+from .k8s_trace import log_error
+
+# Random port instances each hold a port, so only challenges routed by host are shared.
+SHARED_CHALLENGE_TYPES = ('k8s-web', 'k8s-tcp')
+SHARED_TEMPLATE = 'k8s-shared-hpa'
+# The autoscaler needs a CPU request to scale on, so containers without one get this.
+DEFAULT_CPU_REQUEST = '100m'
+TARGET_CPU_UTILIZATION = 70
+
+
+def is_shared_challenge(challenge):
+    """
+    Returns True if the challenge runs one instance for every player.
+    """
+    return (challenge is not None and challenge.type in SHARED_CHALLENGE_TYPES and
+            bool(getattr(challenge, 'shared_instance', 0)))
+
+
+def get_replica_bounds(challenge):
+    """
+    Returns the minimum and maximum replicas of a shared challenge.
+    """
+    min_replicas = max(int(getattr(challenge, 'min_replicas', 0) or 1), 1)
+    max_replicas = max(int(getattr(challenge, 'max_replicas', 0) or 1), min_replicas)
+    return min_replicas, max_replicas
+
+
+def get_shared_options(challenge, config):
+    """
+    Returns the template variables of a challenge's shared instance.
+    """
+    options = get_instance_options(challenge, config, get_shared_instance_id(challenge.id))
+    options['min_replicas'], options['max_replicas'] = get_replica_bounds(challenge)
+    options['target_cpu_utilization'] = TARGET_CPU_UTILIZATION
+    return options
+
+
+def render_shared_objects(options):
+    """
+    Returns the objects of a shared instance: the challenge's own objects with
+    the replica count left to the autoscaler, and the autoscaler itself.
+    """
+    objects = template_registry.render_objects(get_template(options['challenge_type']), options)
+    for yaml_file in objects:
+        if yaml_file['kind'] != 'Deployment':
+            continue
+        # Applying a replica count would undo every scaling decision
+        yaml_file['spec'].pop('replicas', None)
+        for container in yaml_file['spec']['template']['spec'].get('containers', []):
+            requests = container.setdefault('resources', {}).setdefault('requests', {})
+            requests.setdefault('cpu', DEFAULT_CPU_REQUEST)
+    return objects + template_registry.render_objects(get_template(SHARED_TEMPLATE), options)
+
+
+def deploy_shared_instance(challenge_id):
+    """
+    Deploys or updates the shared instance of a challenge.
+    Runs in the background provisioning pool.
+    """
+    challenge = get_challenge_by_id(challenge_id)
+    if not is_shared_challenge(challenge):
+        return False
+    options = get_shared_options(challenge, get_config())
+    deployed = deploy_instance_objects(get_k8s_client(), render_shared_objects(options), options,
+                                       {POOL_LABEL: 'shared'})
+    if not deployed:
+        log_error('failed to deploy the shared instance', challenge=challenge_id)
+    return deployed
+
+
+def destroy_shared_instance(challenge_id):
+    """
+    Deletes the shared instance of a challenge, with its autoscaler.
+    """
+    return destroy_instance(get_k8s_client(), get_config().challenge_namespace,
+                            get_shared_instance_id(challenge_id))
+
+
+def restart_shared_instance(challenge_id):
+    """
+    Replaces the pods of a shared instance one by one, like kubectl rollout restart.
+    """
+    body = {'spec': {'template': {'metadata': {'annotations': {
+        'kubectl.kubernetes.io/restartedAt': datetime.now(timezone.utc).isoformat()}}}}}
+    get_k8s_apps_client().patch_namespaced_deployment(
+        'chal-' + get_shared_instance_id(challenge_id), get_config().challenge_namespace, body)
+
+
+def sync_shared_instance(challenge_id):
+    """
+    Deploys the shared instance of a challenge that is shared and deletes it
+    from one that no longer is.
+    Runs in the background provisioning pool.
+    """
+    if is_shared_challenge(get_challenge_by_id(challenge_id)):
+        return deploy_shared_instance(challenge_id)
+    return destroy_shared_instance(challenge_id)
+
+
+def sync_all_shared_instances():
+    """
+    Queues a deploy of every shared instance.
+    """
+    for challenge_id in get_shared_challenge_ids(SHARED_CHALLENGE_TYPES):
+        provisioner.submit(deploy_shared_instance, challenge_id)
+
+
+def get_shared_instances():
+    """
+    Returns the replica bounds, ready replicas and players of every shared instance.
+    """
+    shared_instances = []
+    players = get_shared_player_counts()
+    for challenge_id in get_shared_challenge_ids(SHARED_CHALLENGE_TYPES):
+        challenge = get_challenge_by_id(challenge_id)
+        instance_id = get_shared_instance_id(challenge_id)
+        state = instance_states.get(instance_id)
+        min_replicas, max_replicas = get_replica_bounds(challenge)
+        shared_instances.append({
+            'challenge_id': challenge_id,
+            'challenge_name': challenge.name,
+            'min_replicas': min_replicas,
+            'max_replicas': max_replicas,
+            'ready_replicas': state['ready_replicas'] if state is not None else None,
+            'players': players.get(instance_id, 0)
+        })
+    return shared_instances
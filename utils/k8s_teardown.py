@@ -0,0 +1,218 @@
+"""
+k8s_teardown
+
+Deletes many challenge instances at once.
+
+A teardown job records the tracker ids it has to delete and the result for each
+one in the database, deletes them on a bounded thread pool and can be polled by
+its job id. Jobs whose worker died are picked up again on startup and only the
+instances without a result are retried.
+"""
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import as_completed
+from datetime import datetime
+
+from CTFd.utils.dates import unix_time        # pylint: disable=import-error
+
+from .k8s_database import (get_config, get_tracked_challenge, claim_challenge_for_deletion,
+                           set_challenge_status, create_teardown_job, get_teardown_job,
+                           save_teardown_progress, get_stale_teardown_jobs,
+                           claim_stale_teardown_job, remove_old_teardown_jobs,
+                           get_stale_deletion_ids, get_tracker_instance_ids,
+                           release_deletion_claim, CLAIMED_ELSEWHERE)
+from .k8s_client import get_k8s_client
+from .k8s_instances import delete_challenge_instance
+from .k8s_manage_objects import destroy_instances, INSTANCE_LABEL, CHALLENGE_LABEL
+from .k8s_provisioner import Provisioner
+from .k8s_warm_pool import POOL_LABEL
+from .k8s_trace import log_event, log_error
+
+DEFAULT_TEARDOWN_CONCURRENCY = 16
+# A running job that has not saved progress for this long is considered abandoned.
+STALE_JOB_SECONDS = 120
+PROGRESS_INTERVAL = 1
+# Instance ids named in one bulk label selector, which keeps it well within URL limits.
+BULK_SELECTOR_BATCH = 50
+JOB_RETENTION_SECONDS = 86400
+# A worker's claim on deleting an instance lapses after this long, in case it died.
+DELETE_LEASE = 300
+
+teardown_pool = Provisioner()
+
+
+def init_teardown(app):
+    """
+    Sets up the teardown pool and resumes jobs left behind by a dead worker.
+    """
+    teardown_pool.init_app(app, get_config().teardown_concurrency or DEFAULT_TEARDOWN_CONCURRENCY)
+    resume_stale_teardown_jobs()
+
+
+def new_teardown_job(scope, tracker_ids):
+    """
+    Records a teardown job and removes finished jobs past their retention.
+    """
+    remove_old_teardown_jobs(unix_time(datetime.utcnow()) - JOB_RETENTION_SECONDS)
+    return create_teardown_job(str(uuid.uuid4()), scope, tracker_ids)
+
+
+def start_teardown_job(scope, tracker_ids):
+    """
+    Starts deleting the given instances in the background and returns the job id.
+    """
+    job = new_teardown_job(scope, tracker_ids)
+    _start_job_thread(job.id, resuming=False)
+    return job.id
+
+
+def run_teardown(scope, tracker_ids):
+    """
+    Deletes the given instances and waits until they are all done.
+    """
+    return run_teardown_job(new_teardown_job(scope, tracker_ids).id)
+
+
+def resume_stale_teardown_jobs():
+    """
+    Takes over every running job that stopped making progress.
+    """
+    stale_before = unix_time(datetime.utcnow()) - STALE_JOB_SECONDS
+    for job in get_stale_teardown_jobs(stale_before):
+        if claim_stale_teardown_job(job.id, job.updated):
+            log_event('teardown_resumed', job=job.id)
+            _start_job_thread(job.id, resuming=True)
+
+
+def reclaim_stale_deletions():
+    """
+    Starts a teardown job for the instances whose deletion claim lapsed.
+    Returns the number of instances.
+    """
+    tracker_ids = get_stale_deletion_ids(unix_time(datetime.utcnow()) - DELETE_LEASE)
+    if tracker_ids:
+        log_event('stale_deletions_restarted', instances=len(tracker_ids))
+        start_teardown_job('stale', tracker_ids)
+    return len(tracker_ids)
+
+
+def _start_job_thread(job_id, resuming):
+    """
+    Runs a teardown job on its own thread so the caller does not wait for it.
+    """
+    app = teardown_pool.app
+
+    def run():
+        with app.app_context():
+            try:
+                run_teardown_job(job_id, resuming)
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+
+    threading.Thread(target=run, name='ctfd-k8s-teardown', daemon=True).start()
+
+
+def run_teardown_job(job_id, resuming=False):
+    """
+    Deletes every instance of the job that has no result yet and records the results.
+    """
+    job = get_teardown_job(job_id)
+    scope = job.scope
+    results = json.loads(job.results or '{}')
+    pending = [tracker_id for tracker_id in json.loads(job.instance_ids)
+               if str(tracker_id) not in results]
+
+    # A resumed job may overlap instances started since, so it deletes them one by one
+    bulk_deleted = False
+    if pending and not resuming:
+        selectors = get_bulk_selectors(scope, get_tracker_instance_ids(pending))
+        # Where a batch fails, every instance is deleted one by one instead
+        bulk_deleted = bool(selectors) and all(
+            destroy_instances(get_k8s_client(), get_config().challenge_namespace, selector)
+            for selector in selectors)
+
+    futures = {teardown_pool.submit(teardown_instance, tracker_id, scope, resuming,
+                                    bulk_deleted): tracker_id
+               for tracker_id in pending}
+
+    last_saved = time.monotonic()
+    for future in as_completed(futures):
+        error = future.result()
+        results[str(futures[future])] = 'Unexpected error' if error is None else error
+        if time.monotonic() - last_saved >= PROGRESS_INTERVAL:
+            save_teardown_progress(job_id, results, 'running')
+            last_saved = time.monotonic()
+
+    save_teardown_progress(job_id, results, 'done')
+    return results
+
+
+def get_bulk_selectors(scope, instance_ids):
+    """
+    Returns label selectors that together match the given instances of a scope,
+    or an empty list if the scope has to be deleted instance by instance.
+    Naming the instances keeps instances started after the job was created out of it.
+    Warm pool instances are left to their pool and shared instances to their challenge.
+    """
+    not_pooled = POOL_LABEL + ' notin (warm,shared)'
+    if scope == 'all':
+        scope_selector = not_pooled
+    elif scope.startswith('challenge:'):
+        scope_selector = CHALLENGE_LABEL + '=' + scope[len('challenge:'):] + ',' + not_pooled
+    else:
+        return []
+    return [INSTANCE_LABEL + ' in (' + ','.join(instance_ids[start:start + BULK_SELECTOR_BATCH]) +
+            '),' + scope_selector
+            for start in range(0, len(instance_ids), BULK_SELECTOR_BATCH)]
+
+
+def teardown_instance(tracker_id, scope, resuming=False, bulk_deleted=False):
+    """
+    Deletes one instance of a teardown job.
+    Returns an empty string on success, CLAIMED_ELSEWHERE if another worker
+    holds the deletion claim, or the reason it failed.
+    """
+    challenge = get_tracked_challenge(tracker_id)
+    if challenge is None:
+        return ''
+    status = challenge.status
+    # Rows already marked deleting belong to this job when it is resumed
+    if (not claim_challenge_for_deletion(tracker_id, unix_time(datetime.utcnow()), DELETE_LEASE)
+            and not resuming):
+        return CLAIMED_ELSEWHERE
+    # Read after the claim, so an extension that won the race keeps the instance
+    if scope == 'expired' and challenge.revert_time > unix_time(datetime.utcnow()):
+        release_deletion_claim(tracker_id, status if status != 'deleting' else 'running')
+        return ''
+
+    try:
+        if delete_challenge_instance(challenge, destroy=not bulk_deleted,
+                                     event='expired' if scope == 'expired' else 'deleted'):
+            return ''
+        error = 'Kubernetes objects could not be deleted'
+    except Exception as general_exception: # pylint: disable=broad-except
+        error = str(general_exception)
+
+    set_challenge_status(challenge.instance_id, 'failed')
+    return error
+
+
+def get_teardown_status(job_id):
+    """
+    Returns the progress of a teardown job, or None if it does not exist.
+    """
+    job = get_teardown_job(job_id)
+    if job is None:
+        return None
+    results = json.loads(job.results or '{}')
+    return {'job_id': job.id,
+            'scope': job.scope,
+            'status': job.status,
+            'total': job.total,
+            'completed': len(results),
+            'succeeded': job.succeeded,
+            'failed': job.failed,
+            'failures': {tracker_id: error for tracker_id, error in results.items()
+                         if error and error != CLAIMED_ELSEWHERE}}
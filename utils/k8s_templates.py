@@ -0,0 +1,134 @@
+"""
+k8s_templates
+
+Implements the template registry.
+
+Every template in templates/ is compiled once and recompiled only when its file changes.
+Rendered objects are cached as skeletons per challenge with placeholders where the
+instance-specific values go, so a new instance only needs those values filled in
+instead of a full Jinja render and YAML parse.
+"""
+import os
+import threading
+
+import yaml
+from jinja2 import Environment, FileSystemLoader
+
+from .k8s_trace import span
+
+TEMPLATE_SUFFIX = '.yml.j2'
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'templates')
+
+# Template variables that change for every instance; everything else is per challenge.
+INSTANCE_FIELDS = ('deployment_name', 'instance_id', 'random_port', 'port', 'user', 'team')
+PLACEHOLDER = '__ctfd_k8s_{0}__'
+
+
+class TemplateRegistry:
+    """
+    Holds the compiled templates and the parsed object skeletons built from them.
+    """
+
+    def __init__(self, template_dir=TEMPLATE_DIR):
+        self.environment = Environment(loader=FileSystemLoader(template_dir), auto_reload=True)
+        self._lock = threading.Lock()
+        self._skeletons = {}
+
+    def load_all(self):
+        """
+        Compiles every template in the template directory.
+        """
+        for template_file in self.environment.list_templates(
+                filter_func=lambda name: name.endswith(TEMPLATE_SUFFIX)):
+            self.environment.get_template(template_file)
+
+    def get(self, template_name):
+        """
+        Returns the compiled template, recompiling it if the file changed on disk.
+        """
+        return self.environment.get_template(template_name + TEMPLATE_SUFFIX)
+
+    def render_objects(self, template, template_variables):
+        """
+        Returns the list of Kubernetes objects the template renders to.
+        """
+        if template.name is None:
+            return render_and_parse(template, template_variables)
+
+        instance_values = {field: template_variables[field] for field in INSTANCE_FIELDS
+                           if field in template_variables}
+        static_key = tuple(sorted((key, repr(value)) for key, value in template_variables.items()
+                                  if key not in instance_values))
+
+        with self._lock:
+            cached_template, skeletons = self._skeletons.get(template.name, (None, None))
+            if cached_template is not template:
+                skeletons = {}
+                self._skeletons[template.name] = (template, skeletons)
+            skeleton = skeletons.get(static_key, False)
+
+        if skeleton is False:
+            objects = render_and_parse(template, template_variables)
+            skeleton = build_skeleton(template, template_variables, instance_values, objects)
+            with self._lock:
+                skeletons[static_key] = skeleton
+            return objects
+
+        if skeleton is None:
+            return render_and_parse(template, template_variables)
+
+        with span('fill_skeleton'):
+            return fill_skeleton(skeleton, instance_values)
+
+
+def render_and_parse(template, template_variables):
+    """
+    Renders the template and parses every YAML document in it.
+    """
+    with span('render'):
+        rendered = template.render(template_variables)
+    with span('parse'):
+        return [obj for obj in yaml.safe_load_all(rendered) if obj]
+
+
+def build_skeleton(template, template_variables, instance_values, objects):
+    """
+    Renders the template with placeholders for the instance fields.
+
+    Returns None if filling the skeleton does not reproduce the real render, e.g. when a
+    custom template applies a filter to an instance field.
+    """
+    placeholder_variables = dict(template_variables)
+    for field in instance_values:
+        placeholder_variables[field] = PLACEHOLDER.format(field)
+
+    try:
+        skeleton = render_and_parse(template, placeholder_variables)
+    except yaml.YAMLError:
+        return None
+
+    if fill_skeleton(skeleton, instance_values) != objects:
+        return None
+    return skeleton
+
+
+def fill_skeleton(node, instance_values):
+    """
+    Returns a copy of the skeleton with the placeholders replaced by the instance values.
+    """
+    if isinstance(node, dict):
+        return {fill_skeleton(key, instance_values): fill_skeleton(value, instance_values)
+                for key, value in node.items()}
+    if isinstance(node, list):
+        return [fill_skeleton(item, instance_values) for item in node]
+    if isinstance(node, str) and '__ctfd_k8s_' in node:
+        for field, value in instance_values.items():
+            placeholder = PLACEHOLDER.format(field)
+            if node == placeholder:
+                return value
+            node = node.replace(placeholder, str(value))
+    return node
+
+
+template_registry = TemplateRegistry()
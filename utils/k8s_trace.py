@@ -0,0 +1,245 @@
+"""
+k8s_trace
+
+Times the phases of creating, deploying and deleting instances.
+
+An operation is wrapped in trace(), and the phases inside it in span().  When
+the outermost trace ends, one JSON line with the operation's fields (instance,
+user, challenge), its duration and the time spent in each phase is logged to
+the ctfd_k8s_challenge logger.  Traces started inside another trace become one
+of its phases, and spans outside of any trace cost a context variable lookup.
+The trace follows the work into the apply thread pool through copy_context().
+
+Admins can also have the next N traced requests profiled by a sampling
+profiler, which adds the most frequent stacks of the request's thread to its
+log line and keeps the last few profiles for /api/v1/k8s/profile.
+"""
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import Counter
+from datetime import datetime, timezone
+
+from CTFd.cache import cache                  # pylint: disable=import-error
+
+PROFILE_REMAINING_KEY = 'ctfd_k8s_challenge_profile_remaining'
+PROFILE_RESULTS_KEY = 'ctfd_k8s_challenge_profile_results'
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_STACK = 40
+PROFILE_TOP_STACKS = 20
+PROFILE_RESULTS = 20
+
+logger = logging.getLogger('ctfd_k8s_challenge')
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current_trace = contextvars.ContextVar('ctfd_k8s_trace', default=None)
+_current_span = contextvars.ContextVar('ctfd_k8s_span', default='')
+
+
+class Trace:
+    """
+    The fields and per-phase durations of one traced operation.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = {key: value for key, value in fields.items() if value is not None}
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add_phase(self, phase, seconds):
+        """
+        Adds time to a phase; a phase entered several times is summed.
+        """
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def set_fields(self, fields):
+        """
+        Adds fields that were not known when the trace started.
+        """
+        with self._lock:
+            self.fields.update({key: value for key, value in fields.items()
+                                if value is not None})
+
+
+def log_event(event, **fields):
+    """
+    Logs one structured JSON line.
+    """
+    record = {'time': datetime.now(timezone.utc).isoformat(), 'event': event}
+    record.update(fields)
+    logger.info(json.dumps(record, default=str))
+
+
+def log_error(error, **fields):
+    """
+    Logs an error as a JSON line, and records it on the current trace if there is one.
+    """
+    current = _current_trace.get()
+    if current is not None:
+        current.set_fields({'error': str(error)})
+    log_event('error', error=str(error), trace=current.name if current else None, **fields)
+
+
+def set_trace_fields(**fields):
+    """
+    Adds fields such as the instance id to the current trace.
+    """
+    current = _current_trace.get()
+    if current is not None:
+        current.set_fields(fields)
+
+
+@contextmanager
+def span(phase):
+    """
+    Times a phase of the current trace.  Nested spans are named parent.child.
+    """
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+    parent = _current_span.get()
+    name = parent + '.' + phase if parent else phase
+    token = _current_span.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add_phase(name, time.perf_counter() - start)
+        _current_span.reset(token)
+
+
+@contextmanager
+def trace(name, profile=False, **fields):
+    """
+    Traces an operation and logs its phases when it ends.  Inside another trace
+    it is a span of that trace and adds its fields to it.
+    Pass profile=True for requests that admins may have profiled.
+    """
+    parent = _current_trace.get()
+    if parent is not None:
+        parent.set_fields({key: value for key, value in fields.items()
+                           if key not in parent.fields})
+        with span(name):
+            yield parent
+        return
+
+    current = Trace(name, fields)
+    trace_token = _current_trace.set(current)
+    span_token = _current_span.set('')
+    profiler = SamplingProfiler.start_if_requested() if profile else None
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception as general_exception:
+        current.set_fields({'error': str(general_exception)})
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        record = dict(current.fields)
+        record['duration_ms'] = round(duration * 1000, 3)
+        record['phases'] = {phase: round(seconds * 1000, 3)
+                            for phase, seconds in current.phases.items()}
+        if profiler is not None:
+            record['profile'] = profiler.stop(name, current.fields)
+        log_event(name, **record)
+
+
+def run_in_context(function):
+    """
+    Returns the function bound to the caller's trace, for running it in another thread.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+def request_profiles(count):
+    """
+    Profiles the next count traced requests, in any worker.
+    """
+    cache.set(PROFILE_REMAINING_KEY, max(int(count), 0), timeout=0)
+
+
+def get_profiles():
+    """
+    Returns the number of requests still to profile and the last profiles.
+    """
+    return {'remaining': max(int(cache.get(PROFILE_REMAINING_KEY) or 0), 0),
+            'profiles': cache.get(PROFILE_RESULTS_KEY) or []}
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval from a helper thread.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ctfd-k8s-profiler',
+                                        daemon=True)
+
+    @classmethod
+    def start_if_requested(cls):
+        """
+        Starts a profiler for the calling thread if admins asked for more profiles.
+        """
+        try:
+            if not cache.get(PROFILE_REMAINING_KEY):
+                return None
+            # Only as many requests as were asked for win the decrement
+            if cache.cache.dec(PROFILE_REMAINING_KEY) < 0:
+                return None
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+            return None
+        profiler = cls(threading.get_ident())
+        profiler._thread.start()
+        return profiler
+
+    def _run(self):
+        """
+        Records the sampled thread's stack as a collapsed 'outer;...;inner' line.
+        """
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id) # pylint: disable=protected-access
+            stack = []
+            while frame is not None and len(stack) < PROFILE_MAX_STACK:
+                code = frame.f_code
+                stack.append(code.co_filename.rsplit('/', 1)[-1] + ':' + code.co_name)
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self, name, fields):
+        """
+        Stops sampling, keeps the profile for admins and returns its top stacks.
+        """
+        self._stopped.set()
+        self._thread.join()
+        profile = {'samples': sum(self.samples.values()),
+                   'interval_ms': self.interval * 1000,
+                   'stacks': dict(self.samples.most_common(PROFILE_TOP_STACKS))}
+        try:
+            results = cache.get(PROFILE_RESULTS_KEY) or []
+            results.append(dict(fields, event=name, time=datetime.now(timezone.utc).isoformat(),
+                                profile=profile))
+            cache.set(PROFILE_RESULTS_KEY, results[-PROFILE_RESULTS:], timeout=0)
+        except Exception as general_exception: # pylint: disable=broad-except
+            log_error(general_exception)
+        return profile
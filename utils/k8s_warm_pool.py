@@ -0,0 +1,138 @@
+"""
+k8s_warm_pool
+
+Keeps a pool of idle, already deployed instances for each challenge so that
+creating an instance only has to claim one instead of waiting for Kubernetes.
+"""
+import uuid
+import threading
+from datetime import datetime
+
+from CTFd.utils.dates import unix_time        # pylint: disable=import-error
+
+from .k8s_client import get_k8s_client, get_k8s_apps_client
+from .k8s_manage_objects import (get_template, get_instance_options, deploy_instance,
+                                 destroy_instance)
+from .k8s_database import (get_config, get_challenge_by_id, get_warm_instances,
+                           get_warm_pool_challenge_ids, reserve_warm_slot,
+                           set_warm_instance_status, take_warm_instance, remove_warm_instance,
+                           record_warm_pool_result)
+from .k8s_provisioner import provisioner
+from .k8s_trace import log_error
+
+# Random port instances each hold a port, so only these types are pooled.
+WARM_POOL_CHALLENGE_TYPES = ('k8s-web', 'k8s-tcp')
+POOL_LABEL = 'ctfd-k8s-challenge/pool'
+USER_LABEL = 'ctfd-k8s-challenge/user'
+# A slot still pending after this many seconds belongs to a deploy whose worker died.
+WARM_DEPLOY_TIMEOUT = 600
+
+_refill_lock = threading.Lock()
+
+
+def get_warm_pool_size(challenge):
+    """
+    Returns the configured warm pool size of a challenge.
+    Shared challenges have nothing to pool.
+    """
+    if (challenge is None or challenge.type not in WARM_POOL_CHALLENGE_TYPES or
+            getattr(challenge, 'shared_instance', 0)):
+        return 0
+    return int(getattr(challenge, 'warm_pool_size', 0) or 0)
+
+
+def claim_warm_instance(challenge):
+    """
+    Takes a ready instance from the challenge's warm pool.
+    Returns None if the challenge has no pool or the pool is empty.
+    """
+    if not get_warm_pool_size(challenge):
+        return None
+
+    warm_instance = take_warm_instance(challenge.id)
+    record_warm_pool_result(challenge, warm_instance is not None)
+    provisioner.submit(refill_warm_pool, challenge.id)
+
+    return warm_instance
+
+
+def label_claimed_instance(options):
+    """
+    Relabels a claimed instance's Deployment with the user that owns it.
+    The Ingress host is derived from the instance id, which is kept on claim.
+    """
+    body = {'metadata': {'labels': {POOL_LABEL: 'claimed',
+                                    USER_LABEL: str(options['user'])}}}
+    get_k8s_apps_client().patch_namespaced_deployment(options['deployment_name'],
+                                                      options['challenge_namespace'], body)
+
+
+def refill_warm_pool(challenge_id):
+    """
+    Deploys instances into the challenge's empty pool slots and removes any
+    instances above the configured size.  Slots pending for longer than
+    WARM_DEPLOY_TIMEOUT are freed and deployed again.
+    """
+    with _refill_lock:
+        config = get_config()
+        challenge = get_challenge_by_id(challenge_id)
+        pool_size = get_warm_pool_size(challenge)
+        now = unix_time(datetime.utcnow())
+
+        warm_instances = get_warm_instances(challenge_id)
+        used_slots = set()
+        for warm_instance in warm_instances:
+            stale = (warm_instance.status == 'pending' and
+                     now - warm_instance.timestamp > WARM_DEPLOY_TIMEOUT)
+            if stale or (warm_instance.slot >= pool_size and warm_instance.status == 'ready'):
+                destroy_warm_instance(warm_instance.instance_id, config)
+            else:
+                used_slots.add(warm_instance.slot)
+
+        for slot in range(pool_size):
+            if slot in used_slots:
+                continue
+            options = get_instance_options(challenge, config, str(uuid.uuid4()))
+            if reserve_warm_slot(options, slot):
+                deploy_warm_instance(options)
+
+
+def deploy_warm_instance(options):
+    """
+    Deploys a single warm instance into its reserved slot.
+    """
+    challenge_template = get_template(options['challenge_type'])
+    if deploy_instance(get_k8s_client(), challenge_template, options, {POOL_LABEL: 'warm'}):
+        if set_warm_instance_status(options['instance_id'], 'ready'):
+            return True
+    else:
+        log_error('failed to deploy warm instance', challenge=options['challenge_id'])
+
+    destroy_instance(get_k8s_client(), options['challenge_namespace'], options['instance_id'])
+    remove_warm_instance(options['instance_id'])
+    return False
+
+
+def destroy_warm_instance(instance_id, config):
+    """
+    Deletes a warm instance from Kubernetes and from the pool.
+    """
+    remove_warm_instance(instance_id)
+    return destroy_instance(get_k8s_client(), config.challenge_namespace, instance_id)
+
+
+def drain_warm_pool(challenge_id):
+    """
+    Deletes every warm instance of a challenge.
+    """
+    config = get_config()
+    for warm_instance in get_warm_instances(challenge_id):
+        destroy_warm_instance(warm_instance.instance_id, config)
+
+
+def refill_all_warm_pools():
+    """
+    Queues a refill for every challenge that has a warm pool.
+    """
+    for challenge_id in get_warm_pool_challenge_ids(WARM_POOL_CHALLENGE_TYPES):
+        provisioner.submit(refill_warm_pool, challenge_id)
@@ -0,0 +1,218 @@
+"""
+k8s_watch
+
+Keeps the state of every challenge instance's Deployment and pods in memory.
+
+Each worker runs one watch on Deployments and one on Pods in the challenge
+namespace, limited to objects with the instance label, so readiness can be
+answered without calling the apiserver. A dropped watch resumes from the last
+resourceVersion it saw and only lists again when that version has expired.
+"""
+import os
+import time
+import threading
+
+import kubernetes as k8s
+
+from .k8s_client import get_k8s_v1_client, get_k8s_apps_client
+from .k8s_database import get_config
+from .k8s_manage_objects import INSTANCE_LABEL
+from .k8s_trace import log_error
+
+WATCH_TIMEOUT = 300
+RETRY_INTERVAL = 5
+
+
+def get_pod_state(pod):
+    """
+    Returns the parts of a pod's status the plugin reports.
+    """
+    ready = None
+    for condition in pod.status.conditions or []:
+        if condition.type == 'Ready':
+            ready = condition
+    is_ready = ready is not None and ready.status == 'True'
+    return {'phase': pod.status.phase,
+            'ready': is_ready,
+            'ready_time': (int(ready.last_transition_time.timestamp())
+                           if is_ready and ready.last_transition_time else None),
+            'restarts': sum(status.restart_count for status in pod.status.container_statuses or []),
+            'node': pod.spec.node_name,
+            'created': pod.metadata.creation_timestamp}
+
+
+class InstanceStateCache:
+    """
+    The latest Deployment and pod state of every instance, fed by two watches.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._objects = {'pods': {}, 'deployments': {}}
+        self._synced = set()
+        self._threads = []
+        self._pid = None
+        self._ready_listeners = []
+
+    def init_app(self, app):
+        """
+        Starts the watches for this process.
+        """
+        self.app = app
+        self.ensure_started()
+
+    def ensure_started(self):
+        """
+        Starts the watch threads if they are not running in this process.
+        """
+        if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+            return
+        with self._lock:
+            if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+                return
+            if self._pid != os.getpid():
+                # State copied from the parent process stops updating after a fork
+                self._objects = {'pods': {}, 'deployments': {}}
+                self._synced = set()
+                self._pid = os.getpid()
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            running = {thread.name for thread in self._threads}
+            for kind in self._objects:
+                name = 'ctfd-k8s-watch-' + kind
+                if name not in running:
+                    thread = threading.Thread(target=self._watch, args=(kind,), name=name,
+                                              daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def add_ready_listener(self, listener):
+        """
+        Calls the listener with the instance id whenever an instance becomes ready.
+        It runs on the watch thread inside an app context.
+        """
+        self._ready_listeners.append(listener)
+
+    def get(self, instance_id):
+        """
+        Returns the state of an instance, or None while the watches have not synced yet.
+        """
+        instance_id = str(instance_id)
+        with self._lock:
+            if len(self._synced) < len(self._objects):
+                return None
+            pods = list(self._objects['pods'].get(instance_id, {}).values())
+            ready_replicas = self._objects['deployments'].get(instance_id, {}).get(None)
+
+        state = {'phase': None, 'ready': False, 'ready_time': None, 'restarts': 0,
+                 'node': None, 'ready_replicas': ready_replicas or 0}
+        if pods:
+            # Prefer a ready pod, then the newest one, e.g. during a restart
+            pod = max(pods, key=lambda pod: (pod['ready'], pod['created'] is not None,
+                                             pod['created']))
+            state.update({key: pod[key] for key in ('phase', 'ready', 'ready_time',
+                                                     'restarts', 'node')})
+        return state
+
+    def _list_function(self, kind):
+        """
+        Returns the list call the watch of a kind is built on.
+        """
+        if kind == 'pods':
+            return get_k8s_v1_client().list_namespaced_pod
+        return get_k8s_apps_client().list_namespaced_deployment
+
+    @staticmethod
+    def _key(kind, obj):
+        """
+        Returns the instance id and the name an object is stored under.
+        Pods are kept by name as an instance can briefly have several.
+        """
+        instance_id = (obj.metadata.labels or {}).get(INSTANCE_LABEL)
+        return instance_id, obj.metadata.name if kind == 'pods' else None
+
+    @staticmethod
+    def _state(kind, obj):
+        """
+        Returns the state stored for an object.
+        """
+        if kind == 'pods':
+            return get_pod_state(obj)
+        return obj.status.ready_replicas or 0
+
+    def _replace(self, kind, items):
+        """
+        Replaces every object of a kind with a fresh listing.
+        """
+        objects = {}
+        for obj in items:
+            instance_id, name = self._key(kind, obj)
+            objects.setdefault(instance_id, {})[name] = self._state(kind, obj)
+        with self._lock:
+            self._objects[kind] = objects
+            self._synced.add(kind)
+
+    def _apply_event(self, kind, event):
+        """
+        Updates the cache from a single watch event.
+        """
+        if event['type'] not in ('ADDED', 'MODIFIED', 'DELETED'):
+            return
+        instance_id, name = self._key(kind, event['object'])
+        with self._lock:
+            instance_objects = self._objects[kind].setdefault(instance_id, {})
+            was_ready = kind == 'pods' and any(pod['ready'] for pod in instance_objects.values())
+            if event['type'] == 'DELETED':
+                instance_objects.pop(name, None)
+                if not instance_objects:
+                    del self._objects[kind][instance_id]
+            else:
+                instance_objects[name] = self._state(kind, event['object'])
+            became_ready = (kind == 'pods' and not was_ready and
+                            any(pod['ready'] for pod in instance_objects.values()))
+
+        if became_ready:
+            with self.app.app_context():
+                for listener in self._ready_listeners:
+                    try:
+                        listener(instance_id)
+                    except Exception as general_exception: # pylint: disable=broad-except
+                        log_error(general_exception)
+
+    def _watch(self, kind):
+        """
+        Lists and then watches one kind forever, resuming from the last resourceVersion.
+        """
+        resource_version = None
+        while True:
+            try:
+                with self.app.app_context():
+                    namespace = get_config().challenge_namespace
+                list_function = self._list_function(kind)
+
+                if resource_version is None:
+                    listing = list_function(namespace, label_selector=INSTANCE_LABEL)
+                    self._replace(kind, listing.items)
+                    resource_version = listing.metadata.resource_version
+
+                watch = k8s.watch.Watch()
+                for event in watch.stream(list_function, namespace,
+                                          label_selector=INSTANCE_LABEL,
+                                          resource_version=resource_version,
+                                          allow_watch_bookmarks=True,
+                                          timeout_seconds=WATCH_TIMEOUT):
+                    self._apply_event(kind, event)
+                    resource_version = watch.resource_version or resource_version
+            except k8s.client.rest.ApiException as general_exception:
+                if general_exception.status == 410:
+                    # The version is too old to resume from, so list again
+                    resource_version = None
+                else:
+                    log_error(general_exception)
+                    time.sleep(RETRY_INTERVAL)
+            except Exception as general_exception: # pylint: disable=broad-except
+                log_error(general_exception)
+                time.sleep(RETRY_INTERVAL)
+
+
+instance_states = InstanceStateCache()